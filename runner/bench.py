@@ -0,0 +1,430 @@
+"""
+Micro-benchmarks del solver con datos sintéticos (sin Supabase).
+
+Uso:
+  python bench.py                                   # tamaños 100,1000,10000 -> JSON a stdout
+  python bench.py --sizes 100,1000,10000,50000 --repeat 3 --out bench.json
+  python bench.py --only prep,trim,top_up --sizes 50000
+  python bench.py --payload '{"knobs": {"batch_n_iters_hard": 200}}'
+  python bench.py --only parse_num,parse_num_vec --sizes 10000,100000   # ETL (importa main.py)
+  python bench.py --check-exact 150                  # motor exacto == fuerza bruta (zonas chicas)
+
+Cada resultado trae ms de cada repetición + min/mediana, para comparar entre commits.
+
+La equivalencia parse_num_series == parse_num se testea en test_main.py.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+import solver
+from solver import (
+    LotPool,
+    _prep_base,
+    build_batch,
+    build_varios_trim,
+    preprocess_all,
+    resolve_params,
+    solve,
+    solve_one_pile,
+    top_up_pile,
+)
+
+BENCHES = ["prep", "trim", "top_up", "solve_one_pile", "build_batch", "solve"]
+# ETL: no van por defecto (necesitan las dependencias de main.py: fastapi, supabase)
+ETL_BENCHES = ["parse_num", "parse_num_vec"]
+
+# solve completo es caro: por defecto solo hasta este tamaño (ver --solve-max)
+SOLVE_MAX_LOTS = 1000
+
+
+# =========================
+# DATOS SINTÉTICOS (mismo esquema que stg_lotes_daily)
+# =========================
+def gen_lotes(n: int, seed: int = 0) -> pd.DataFrame:
+    """
+    n lotes con las columnas de stg_lotes_daily (ETL_COLS + loaded_at). Incluye lo que el
+    solver tiene que filtrar: ~3% de una carga vieja, ~2% sin tms, ~15% con rec < 85
+    (rechazos) y ~5% sin reactivos.
+    """
+    rng = np.random.default_rng(seed)
+
+    tms = (rng.gamma(2.0, 4.0, n) + 0.2).round(3)
+    hum = rng.uniform(3.0, 12.0, n).round(2)
+    tmh = (tms / (1.0 - hum / 100.0)).round(3)
+    au_g = rng.lognormal(3.0, 0.5, n).round(3)
+    ag_g = rng.uniform(0.0, 50.0, n).round(2)
+    rec = np.clip(rng.normal(88.0, 5.0, n), 50.0, 99.0).round(2)
+    cn = rng.uniform(2.0, 10.0, n).round(2)
+    oh = rng.uniform(2.0, 10.0, n).round(2)
+
+    df = pd.DataFrame({
+        "codigo": [f"L{i:07d}" for i in range(n)],
+        "zona": rng.choice(["Norte", "Sur", "Centro", "Oeste"], n),
+        "tmh": tmh,
+        "humedad_pct": hum,
+        "tms": tms,
+        "au_oz_tc": (au_g / 34.2857).round(4),
+        "au_gr_ton": au_g,
+        "au_fino": (au_g * tms).round(3),
+        "ag_oz_tc": (ag_g / 34.2857).round(4),
+        "ag_gr_ton": ag_g,
+        "ag_fino": (ag_g * tms).round(3),
+        "cu_pct": rng.uniform(0.0, 1.0, n).round(3),
+        "nacn_kg_t": cn,
+        "naoh_kg_t": oh,
+        "rec_pct": rec,
+        "loaded_at": "2026-01-02T10:00:00+00:00",
+    })
+
+    old = rng.random(n) < 0.03
+    df.loc[old, "loaded_at"] = "2026-01-01T10:00:00+00:00"
+    df.loc[rng.random(n) < 0.02, "tms"] = None
+    no_reag = rng.random(n) < 0.05
+    df.loc[no_reag, "nacn_kg_t"] = None
+    df.loc[no_reag, "naoh_kg_t"] = None
+    return df
+
+
+def gen_sheet(n: int, seed: int = 0) -> pd.DataFrame:
+    """
+    n filas como las lee el ETL desde Sheets (todo string): columnas numéricas con coma o
+    punto decimal, miles europeos / US, "%", espacios, vacíos, "nan" y basura.
+    """
+    rng = np.random.default_rng(seed)
+    from main import ETL_NUM_COLS  # solo para estos benches (necesita las deps de main.py)
+
+    def fmt(x: float, kind: int) -> Optional[str]:
+        if kind == 0:
+            return f"{x:.2f}"                                                 # 1234.56
+        if kind == 1:
+            return f"{x:.2f}".replace(".", ",")                               # 1234,56
+        if kind == 2:
+            return f"{x:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")  # 1.234,56
+        if kind == 3:
+            return f"{x:,.2f}"                                                # 1,234.56
+        if kind == 4:
+            return f" {x:.1f} %"                                              # " 85.5 %"
+        if kind == 5:
+            return f"{x:.1f}%".replace(".", ",")                              # 85,5%
+        if kind == 6:
+            return str(int(x))                                                # 1234
+        if kind == 7:
+            return ""
+        if kind == 8:
+            return None
+        if kind == 9:
+            return "nan"
+        return "s/d"                                                          # basura
+
+    probs = np.array([0.25, 0.2, 0.1, 0.1, 0.05, 0.05, 0.1, 0.05, 0.05, 0.02, 0.03])
+    data: Dict[str, List[Optional[str]]] = {}
+    for c in ETL_NUM_COLS:
+        vals = rng.lognormal(3.0, 1.5, n)
+        kinds = rng.choice(len(probs), n, p=probs / probs.sum())
+        data[c] = [fmt(float(v), int(k)) for v, k in zip(vals, kinds)]
+    return pd.DataFrame(data, dtype=str)
+
+
+def _exact_case(rng: np.random.Generator, m: int) -> Any:
+    # zona chica con tms de 1 decimal (las sumas float no dan exacto el target)
+    tms = rng.integers(20, 420, m) / 10.0
+    g = rng.uniform(1.0, 80.0, m).round(2)
+    r = rng.uniform(80.0, 99.0, m).round(1)
+    cn = rng.uniform(0.5, 3.5, m).round(2)
+    oh = rng.uniform(0.5, 3.5, m).round(2)
+    arr = {
+        "tms": tms, "r": r, "tmh": tms,
+        "gtms": g * tms, "rtms": r * tms, "cntms": cn * tms, "ohtms": oh * tms,
+        "bad_reag": np.zeros(m, dtype=bool), "lowrec_f": np.zeros(m),
+    }
+    cfg = {
+        "tms_max": 110.0, "tms_target": 100.0, "tms_min": 90.0,
+        "gmin": float(rng.choice([0.0, 10.0, 20.0])), "gmax": 1e9,
+        "gmin_exclusive": False, "gmax_inclusive": True,
+        "rec_min": 85.0, "enforce_reagents": bool(rng.integers(0, 2)),
+        "reag_min": 1.0, "reag_max": 3.0,
+    }
+    return arr, cfg
+
+
+def check_exact(cases: int = 150, seed: int = 0, max_lots: int = 12) -> int:
+    """
+    Motor exacto vs fuerza bruta (todos los subconjuntos rankeados con _pile_key) en zonas
+    chicas: con búsqueda completa tiene que dar la misma key. AssertionError si no.
+    """
+    rng = np.random.default_rng(seed)
+    for case in range(int(cases)):
+        m = int(rng.integers(4, max_lots + 1))
+        arr, cfg = _exact_case(rng, m)
+
+        ref = None
+        for mask in range(1, 1 << m):
+            picked = [i for i in range(m) if (mask >> i) & 1]
+            key = solver._pile_key(arr, cfg, picked)
+            if key is not None and (ref is None or key < ref):
+                ref = key
+
+        got, _, _, complete, _ = solver._exact_pile(arr, cfg, 10 ** 7)
+        if not complete or got != ref:
+            raise AssertionError(f"exacto != fuerza bruta (caso {case}, {m} lotes): {got} vs {ref} (completo={complete})")
+    return int(cases)
+
+
+# =========================
+# BENCHES (cada uno recibe el contexto ya preparado y retorna un resumen chico)
+# =========================
+def _ctx(n: int, seed: int, payload: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    df = gen_lotes(n, seed)
+    params = resolve_params(dict(payload or {}))
+    eligible, _ = preprocess_all(df, params)
+    pool = LotPool(eligible)
+    return {"df": df, "params": params, "payload": payload, "pool": pool, "seed": seed, "n": n}
+
+
+def _batch_kw(params: Dict[str, Any]) -> Dict[str, Any]:
+    return dict(
+        tms_max=float(params["bat_tms_max"]),
+        tms_target=float(params["bat_tms_target"]),
+        tms_min=float(params["bat_tms_min"]),
+        gmin=float(params["bat_pile_g_min"]),
+        gmax=1e9,
+        gmin_exclusive=False,
+        gmax_inclusive=True,
+        rec_min=float(params["pile_rec_min"]),
+        enforce_reagents=True,
+        reag_min=float(params["reag_min"]),
+        reag_max=float(params["reag_max"]),
+        n_iters=int(params["batch_n_iters_hard"]),
+        max_steps=int(params["batch_max_steps"]),
+        cand_sample=int(params["batch_cand_sample"]),
+        reseeds_per_iter=int(params["batch_reseeds"]),
+        pair_topk=int(params["batch_pair_topk"]),
+        pair_pool=int(params["batch_pair_pool"]),
+        workers=int(params["batch_workers"]),
+        patience=int(params["batch_patience"]),
+        stop_gap=float(params["batch_stop_gap"]),
+        engine=str(params["batch_engine"]),
+        exact_max_lots=int(params["batch_exact_max_lots"]),
+        exact_max_nodes=int(params["batch_exact_max_nodes"]),
+    )
+
+
+def bench_prep(c: Dict[str, Any]) -> Dict[str, Any]:
+    base = _prep_base(c["df"], c["params"])
+    return {"rows": int(len(base))}
+
+
+def bench_trim(c: Dict[str, Any]) -> Dict[str, Any]:
+    p = c["params"]
+    pool = c["pool"]
+    gmin, gmax = p["var_g_tries"][0]
+    out = build_varios_trim(
+        pool, pool.live_idx(),
+        gmin=float(gmin), gmax=float(gmax),
+        enforce_reagents=True,
+        rec_min=float(p["pile_rec_min"]),
+        tms_max=float(p["var_tms_max"]),
+        tms_target=float(p["var_tms_target"]),
+        tms_min=float(p["var_tms_min"]),
+        reag_min=float(p["reag_min"]),
+        reag_max=float(p["reag_max"]),
+    )
+    return {"lots": int(out.size)}
+
+
+def bench_top_up(c: Dict[str, Any]) -> Dict[str, Any]:
+    # pila chica de arranque (los 5 lotes de más ley) + top-up con el resto hasta var_tms_max
+    p = c["params"]
+    pool = c["pool"]
+    live = pool.live_idx()
+    start = live[np.argsort(-pool.g[live], kind="stable")[:5]]
+    out = top_up_pile(
+        pool, start, live,
+        rec_min=float(p["pile_rec_min"]),
+        tms_max=float(p["var_tms_max"]),
+        tms_target=float(p["var_tms_target"]),
+        gmin=0.0,
+        gmax=1e9,
+        gmin_exclusive=False,
+        gmax_inclusive=True,
+        enforce_reagents=False,
+        reag_min=float(p["reag_min"]),
+        reag_max=float(p["reag_max"]),
+    )
+    return {"lots": int(out.size)}
+
+
+def bench_solve_one_pile(c: Dict[str, Any]) -> Dict[str, Any]:
+    st: Dict[str, Any] = {}
+    out = solve_one_pile(c["pool"], c["pool"].live_idx(), seed=c["seed"], stats=st, **_batch_kw(c["params"]))
+    return {"lots": int(out.size), "restarts": int(st.get("restarts", 0))}
+
+
+def bench_build_batch(c: Dict[str, Any]) -> Dict[str, Any]:
+    st: Dict[str, Any] = {}
+    out = build_batch(c["pool"], c["pool"].live_idx(), c["params"], seed=c["seed"], stats=st)
+    return {"lots": int(out.size), "restarts": int(st.get("restarts", 0))}
+
+
+def bench_solve(c: Dict[str, Any]) -> Dict[str, Any]:
+    info: Dict[str, Any] = {}
+    p1, p2, p3, rej = solve(c["df"], dict(c["payload"] or {}), info=info)
+    return {
+        "rows": [int(len(p1)), int(len(p2)), int(len(p3)), int(len(rej))],
+        "restarts": int((info.get("restarts") or {}).get("total", 0)),
+    }
+
+
+def _setup_sheet(c: Dict[str, Any]) -> None:
+    if "sheet" not in c:
+        c["sheet"] = gen_sheet(int(c["n"]), c["seed"])
+
+
+def bench_parse_num(c: Dict[str, Any]) -> Dict[str, Any]:
+    # lo de antes: parse_num celda a celda con Series.map
+    from main import parse_num
+
+    sheet = c["sheet"]
+    out = {col: sheet[col].map(parse_num) for col in sheet.columns}
+    return {"cells": int(sheet.size), "nan": int(sum(int(v.isna().sum()) for v in out.values()))}
+
+
+def bench_parse_num_vec(c: Dict[str, Any]) -> Dict[str, Any]:
+    from main import parse_num_series
+
+    sheet = c["sheet"]
+    out = {col: parse_num_series(sheet[col]) for col in sheet.columns}
+    return {
+        "cells": int(sheet.size),
+        "nan": int(sum(int(v.isna().sum()) for v in out.values())),
+    }
+
+
+BENCH_FNS: Dict[str, Callable[[Dict[str, Any]], Dict[str, Any]]] = {
+    "prep": bench_prep,
+    "trim": bench_trim,
+    "top_up": bench_top_up,
+    "solve_one_pile": bench_solve_one_pile,
+    "build_batch": bench_build_batch,
+    "solve": bench_solve,
+    "parse_num": bench_parse_num,
+    "parse_num_vec": bench_parse_num_vec,
+}
+
+# preparación fuera del tiempo medido (solo para los benches que la necesitan)
+BENCH_SETUP: Dict[str, Callable[[Dict[str, Any]], None]] = {
+    "parse_num": _setup_sheet,
+    "parse_num_vec": _setup_sheet,
+}
+
+
+# =========================
+# RUNNER
+# =========================
+def _git_rev() -> Optional[str]:
+    try:
+        here = os.path.dirname(os.path.abspath(__file__))
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=here, capture_output=True, text=True, timeout=5)
+        return out.stdout.strip() or None
+    except Exception:
+        return None
+
+
+def run_bench(
+    sizes: List[int],
+    only: List[str],
+    repeat: int = 3,
+    seed: int = 0,
+    payload: Optional[Dict[str, Any]] = None,
+    solve_max: int = SOLVE_MAX_LOTS,
+) -> Dict[str, Any]:
+    results: List[Dict[str, Any]] = []
+    for n in sizes:
+        c = _ctx(n, seed, payload)
+        for name in only:
+            if name == "solve" and n > solve_max:
+                results.append({"bench": name, "size": n, "skipped": f"size > solve_max ({solve_max})"})
+                continue
+            fn = BENCH_FNS[name]
+            if name in BENCH_SETUP:
+                BENCH_SETUP[name](c)
+            ms: List[float] = []
+            out: Dict[str, Any] = {}
+            for _ in range(max(1, int(repeat))):
+                t0 = time.perf_counter()
+                out = fn(c)
+                ms.append(round((time.perf_counter() - t0) * 1000.0, 3))
+            results.append({
+                "bench": name,
+                "size": n,
+                "ms": ms,
+                "min_ms": min(ms),
+                "median_ms": float(np.median(ms)),
+                "out": out,
+            })
+            print(f"[bench] n={n:>6} {name:<15} min={min(ms):>10.1f} ms", file=sys.stderr)
+
+    return {
+        "meta": {
+            "ts": datetime.now(timezone.utc).isoformat(),
+            "git": _git_rev(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "cpus": os.cpu_count(),
+            "seed": seed,
+            "repeat": repeat,
+            "payload": payload or {},
+            "solver_file": os.path.basename(solver.__file__),
+        },
+        "results": results,
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Benchmarks del solver con datos sintéticos")
+    ap.add_argument("--sizes", default="100,1000,10000", help="tamaños separados por coma (p.ej. 100,1000,10000,50000)")
+    ap.add_argument("--only", default=",".join(BENCHES), help="benches separados por coma: " + ",".join(BENCHES + ETL_BENCHES))
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--payload", default=None, help="JSON de payload (igual que /run) para resolve_params/solve")
+    ap.add_argument("--solve-max", type=int, default=SOLVE_MAX_LOTS, help="tamaño máximo para el bench de solve completo")
+    ap.add_argument("--out", default=None, help="archivo JSON de salida (default: stdout)")
+    ap.add_argument("--check-exact", type=int, default=0, metavar="N", help="solo verifica el motor exacto contra fuerza bruta en N zonas chicas")
+    a = ap.parse_args(argv)
+
+    if a.check_exact > 0:
+        n_ok = check_exact(a.check_exact, seed=a.seed)
+        print(json.dumps({"check_exact": n_ok, "seed": a.seed}))
+        return 0
+
+    sizes = [int(x) for x in a.sizes.split(",") if x.strip()]
+    only = [x.strip() for x in a.only.split(",") if x.strip()]
+    unknown = [x for x in only if x not in BENCH_FNS]
+    if unknown:
+        ap.error(f"benches desconocidos: {unknown}")
+    payload = json.loads(a.payload) if a.payload else None
+
+    report = run_bench(sizes, only, repeat=a.repeat, seed=a.seed, payload=payload, solve_max=a.solve_max)
+
+    text = json.dumps(report, indent=2)
+    if a.out:
+        with open(a.out, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,11 +1,23 @@
 from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import Response
 from supabase import create_client, Client
 import pandas as pd
 import numpy as np
 import math
-from datetime import datetime, date
-
-from solver import solve  # solver.py (retorna p1, p2, p3, rej_lowrec)
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from datetime import datetime, date, timezone
+from starlette.concurrency import run_in_threadpool
+
+from solver import solve, solve_sweep, sweep_variants, resolve_params, staging_filters, Timings  # solver.py (retorna p1, p2, p3, rej_lowrec)
+import metrics
 
 app = FastAPI()
 
@@ -71,6 +83,12 @@ def health():
     return {"ok": True}
 
 
+@app.get("/metrics")
+def get_metrics():
+    # formato texto Prometheus; sin auth, igual que /health (solo contadores/latencias)
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
 def auth(req: Request):
     if RUNNER_SECRET:
         got = req.headers.get("x-runner-secret", "")
@@ -107,6 +125,20 @@ def _to_native(x):
     return x
 
 
+# -------------------------
+# Helpers SUPABASE (latencia + errores por op/tabla en /metrics)
+# -------------------------
+def sb_exec(op: str, table_name: str, query):
+    t0 = time.perf_counter()
+    try:
+        return query.execute()
+    except Exception:
+        metrics.SUPABASE_ERRORS.inc(op=op, table=table_name)
+        raise
+    finally:
+        metrics.SUPABASE_SECONDS.observe(time.perf_counter() - t0, op=op, table=table_name)
+
+
 # -------------------------
 # Helpers SOLVER
 # -------------------------
@@ -143,30 +175,391 @@ def prep_payload_rej(df_rej: pd.DataFrame) -> list[dict]:
     return payload
 
 
+def read_prev_piles() -> dict:
+    # warm start: asignación del run anterior (solo lo que usa el solver).
+    # Paginado y ordenado (select_all): cortado por max-rows una pila podía volver con solo parte de sus lotes
+    out = {}
+    for key, table_name in [("p2", "res_pila_2"), ("p3", "res_pila_3")]:
+        out[key] = select_all(table_name, "pile_code,codigo", ["pile_code", "id"])
+    return out
+
+
 def delete_all(table_name: str):
     # para tablas con id (res_pila_1/2/3)
-    supabase.table(table_name).delete().neq("id", -1).execute()
+    sb_exec("delete", table_name, supabase.table(table_name).delete().neq("id", -1))
 
 
 def delete_by_loaded_at(table_name: str):
     # para tablas tipo staging sin id, con loaded_at
-    supabase.table(table_name).delete().gte("loaded_at", "1900-01-01T00:00:00Z").execute()
+    sb_exec("delete", table_name, supabase.table(table_name).delete().gte("loaded_at", "1900-01-01T00:00:00Z"))
 
 
-def insert_chunks(table_name: str, payload: list[dict], chunk_size: int = 500) -> int:
+def insert_chunks(table_name: str, payload: list[dict], chunk_size: int = 500, parallel: int = 1) -> int:
     if not payload:
         return 0
+    if parallel <= 1:
+        total = 0
+        for i in range(0, len(payload), chunk_size):
+            chunk = payload[i:i + chunk_size]
+            resp = sb_exec("insert", table_name, supabase.table(table_name).insert(chunk))
+            total += len(resp.data or [])
+    else:
+        total = _insert_groups_parallel(table_name, chunk_groups(payload, chunk_size), parallel)
+    metrics.ROWS_INSERTED.inc(total, table=table_name)
+    return total
+
+
+# -------------------------
+# Escrituras concurrentes (tablas en paralelo + hasta WRITE_PER_TABLE chunks en vuelo por tabla)
+# -------------------------
+# El cliente de Supabase (postgrest) ya usa 1 httpx.Client con keep-alive y pool de conexiones;
+# se comparte entre threads, así que no hace falta otro cliente HTTP.
+WRITE_PER_TABLE = max(1, int(os.environ.get("RUNNER_WRITE_PER_TABLE", "2")))
+WRITE_TABLES_MAX = 4  # res_pila_1/2/3 + rechazos
+
+_WRITE_TABLE_EXECUTOR = ThreadPoolExecutor(max_workers=WRITE_TABLES_MAX, thread_name_prefix="runner-write")
+_WRITE_CHUNK_EXECUTOR = ThreadPoolExecutor(max_workers=WRITE_TABLES_MAX * WRITE_PER_TABLE, thread_name_prefix="runner-chunk")
+
+
+def chunk_groups(payload: list[dict], chunk_size: int, key: str = "pile_code") -> list[list[list[dict]]]:
+    """
+    Chunks de <= chunk_size filas sin partir pilas (la UI ordena por pile_code, id).
+    Cada grupo se inserta en serie; grupos distintos pueden ir en paralelo.
+    Una pila más grande que chunk_size queda sola en su grupo (sus chunks en orden).
+    """
+    groups = []
+    cur = []
+    i, n = 0, len(payload)
+    while i < n:
+        j = i + 1
+        k = payload[i].get(key)
+        if k is not None:
+            while j < n and payload[j].get(key) == k:
+                j += 1
+        run = payload[i:j]
+        if len(run) > chunk_size:
+            if cur:
+                groups.append([cur])
+                cur = []
+            groups.append([run[a:a + chunk_size] for a in range(0, len(run), chunk_size)])
+        elif len(cur) + len(run) > chunk_size:
+            groups.append([cur])
+            cur = list(run)
+        else:
+            cur.extend(run)
+        i = j
+    if cur:
+        groups.append([cur])
+    return groups
+
+
+def _insert_group(table_name: str, chunks: list[list[dict]]) -> int:
     total = 0
-    for i in range(0, len(payload), chunk_size):
-        chunk = payload[i:i + chunk_size]
-        resp = supabase.table(table_name).insert(chunk).execute()
+    for chunk in chunks:
+        resp = sb_exec("insert", table_name, supabase.table(table_name).insert(chunk))
         total += len(resp.data or [])
     return total
 
 
+def _insert_groups_parallel(table_name: str, groups: list, parallel: int) -> int:
+    sem = threading.BoundedSemaphore(parallel)
+    futs = []
+    for g in groups:
+        sem.acquire()
+        f = _WRITE_CHUNK_EXECUTOR.submit(_insert_group, table_name, g)
+        f.add_done_callback(lambda _f: sem.release())
+        futs.append(f)
+    # espera todos antes de propagar un error (no deja inserts colgando)
+    errors = [f.exception() for f in futs]
+    for e in errors:
+        if e is not None:
+            raise e
+    return sum(f.result() for f in futs)
+
+
+# -------------------------
+# Escrituras por diff (solo se borran/insertan los grupos que cambiaron)
+# -------------------------
+# 1 = lee lo actual y reescribe solo pilas (res_pila_*) / códigos (rechazos) distintos; 0 = delete+insert completo
+DIFF_WRITES = int(os.environ.get("RUNNER_DIFF_WRITES", "1")) > 0
+SELECT_PAGE = 1000   # max-rows por request de PostgREST
+DELETE_IN_CHUNK = 100  # valores por filtro in.(...) (largo de URL)
+# números: iguales si coinciden con esta tolerancia relativa (float4 guarda ~7 dígitos)
+DIFF_REL_TOL = 1e-6
+DIFF_ABS_TOL = 1e-9
+
+
+def _parse_scales(raw: str) -> dict:
+    # "au_fino=2,tms=3" -> {"au_fino": 2, "tms": 3}: decimales de columnas numeric(p,s)
+    out = {}
+    for part in (raw or "").split(","):
+        col, _, dec = part.partition("=")
+        if col.strip() and dec.strip().lstrip("-").isdigit():
+            out[col.strip()] = int(dec)
+    return out
+
+
+# columnas que la tabla guarda con escala fija (numeric(p,s)): se comparan redondeadas a esos decimales
+DIFF_SCALES = _parse_scales(os.environ.get("RUNNER_DIFF_SCALES", ""))
+
+# tabla -> columnas comparadas, clave de grupo, si importa el orden (UI: pile_code, id), orden de
+# lectura (clave única: sin ORDER BY las páginas de .range() pueden repetir/saltear filas) y delete completo
+TABLE_SPECS = {
+    "res_pila_1": {"cols": OUTPUT_COLS, "key": "pile_code", "ordered": True, "order": ["id"], "delete": delete_all},
+    "res_pila_2": {"cols": OUTPUT_COLS, "key": "pile_code", "ordered": True, "order": ["id"], "delete": delete_all},
+    "res_pila_3": {"cols": OUTPUT_COLS, "key": "pile_code", "ordered": True, "order": ["id"], "delete": delete_all},
+    REJ_TABLE: {"cols": REJ_COLS, "key": "codigo", "ordered": False, "order": ["codigo", "loaded_at"], "delete": delete_by_loaded_at},
+}
+
+
+def select_all(table_name: str, cols: str, order: list) -> list[dict]:
+    # paginado con .range(): `order` tiene que ser una clave única para que las páginas sean estables.
+    # La 1ra página trae el conteo exacto (como read_staging): un max-rows menor que SELECT_PAGE no corta
+    rows = []
+    total = None
+    while total is None or len(rows) < total:
+        q = supabase.table(table_name).select(cols, count="exact" if total is None else None)
+        for c in order:
+            q = q.order(c)
+        resp = sb_exec("select", table_name, q.range(len(rows), len(rows) + SELECT_PAGE - 1))
+        page = resp.data or []
+        if total is None:
+            total = int(resp.count) if resp.count is not None else len(page)
+        if not page:
+            break
+        rows.extend(page)
+    if len(rows) != total:
+        raise RuntimeError(f"{table_name}: se leyeron {len(rows)} filas de {total} (¿cambió durante la lectura?)")
+    metrics.ROWS_READ.inc(len(rows), table=table_name)
+    return rows
+
+
+def _norm_cell(col: str, v):
+    # misma fila leída de Postgres vs armada por prep_payload => misma tupla
+    v = _to_native(v)
+    if v is None or v == "":
+        return None
+    if col == "loaded_at":
+        try:
+            ts = pd.Timestamp(v)
+            return (ts.tz_convert("UTC") if ts.tzinfo else ts).isoformat()
+        except Exception:
+            return str(v)
+    if isinstance(v, bool):
+        return v
+    if isinstance(v, (int, float)):
+        return round(float(v), DIFF_SCALES[col]) if col in DIFF_SCALES else float(v)
+    return str(v)
+
+
+def _cell_eq(a, b) -> bool:
+    # floats con tolerancia: lo que vuelve de Postgres (float4, numeric) no es bit a bit lo calculado
+    if isinstance(a, float) and isinstance(b, float):
+        return math.isclose(a, b, rel_tol=DIFF_REL_TOL, abs_tol=DIFF_ABS_TOL)
+    return a == b
+
+
+def _rows_eq(cur: list, new: list) -> bool:
+    if cur is None or len(cur) != len(new):
+        return False
+    return all(len(x) == len(y) and all(_cell_eq(a, b) for a, b in zip(x, y)) for x, y in zip(cur, new))
+
+
+def _row_sort_key(t: tuple) -> str:
+    # orden de filas sin importar el ruido de precisión en los floats
+    return repr(tuple(f"{x:.4g}" if isinstance(x, float) else x for x in t))
+
+
+def _group_rows(rows: list[dict], cols: list, key: str, ordered: bool) -> dict:
+    groups = {}
+    for r in rows:
+        groups.setdefault(_norm_cell(key, r.get(key)), []).append(tuple(_norm_cell(c, r.get(c)) for c in cols))
+    if not ordered:
+        groups = {k: sorted(v, key=_row_sort_key) for k, v in groups.items()}
+    return groups
+
+
+def _first_diff_col(cur: list, new: list, cols: list):
+    # diagnóstico: primera columna distinta entre 2 grupos (p.ej. una escala que no coincide)
+    for x, y in zip(cur or [], new):
+        for c, a, b in zip(cols, x, y):
+            if not _cell_eq(a, b):
+                return {"col": c, "table": a, "new": b}
+    return None
+
+
+def delete_groups(table_name: str, key: str, values: list) -> int:
+    deleted = 0
+    for i in range(0, len(values), DELETE_IN_CHUNK):
+        part = values[i:i + DELETE_IN_CHUNK]
+        resp = sb_exec("delete", table_name, supabase.table(table_name).delete().in_(key, part))
+        deleted += len(resp.data or [])
+    return deleted
+
+
+def diff_write(table_name: str, payload: list[dict]) -> dict:
+    """
+    Lee la tabla, compara por grupo (pila o código) contra `payload` y solo borra/inserta los
+    grupos distintos. Una pila que cambia se reescribe entera (conserva el orden por id).
+    Si no queda nada igual, hace el delete+insert completo de siempre.
+    """
+    spec = TABLE_SPECS[table_name]
+    cols, key, ordered = spec["cols"], spec["key"], spec["ordered"]
+
+    cur = select_all(table_name, ",".join(cols), spec["order"])
+    cur_g = _group_rows(cur, cols, key, ordered)
+    new_g = _group_rows(payload, cols, key, ordered)
+
+    changed = {k for k, v in new_g.items() if not _rows_eq(cur_g.get(k), v)}
+    gone = [k for k in cur_g if k not in new_g]
+    kept_rows = sum(len(v) for k, v in new_g.items() if k not in changed)
+
+    if kept_rows == 0:
+        common = [k for k in new_g if k in cur_g]
+        if common:
+            # grupos con la misma clave que cambiaron todos: avisar (si es precisión, ver RUNNER_DIFF_SCALES)
+            k0 = common[0]
+            print(json.dumps({"event": "diff_write_full", "table": table_name, "groups": len(new_g), "same_key": len(common),
+                              "first_diff": _first_diff_col(cur_g[k0], new_g[k0], cols)}, default=str), flush=True)
+        spec["delete"](table_name)
+        n = insert_chunks(table_name, payload, parallel=WRITE_PER_TABLE)
+        return {"rows": n, "inserted": n, "deleted": len(cur), "kept": 0, "full": True}
+
+    # valores crudos de la clave tal cual están en la tabla (para el filtro in.(...))
+    raw = {}
+    for r in cur:
+        raw.setdefault(_norm_cell(key, r.get(key)), r.get(key))
+    to_delete = [raw[k] for k in list(changed) + gone if k in raw]
+    deleted = delete_groups(table_name, key, to_delete)
+
+    rows_ins = [r for r in payload if _norm_cell(key, r.get(key)) in changed]
+    n = insert_chunks(table_name, rows_ins, parallel=WRITE_PER_TABLE)
+    return {"rows": kept_rows + n, "inserted": n, "deleted": deleted, "kept": kept_rows, "full": False}
+
+
+def _replace_table(table_name: str, payload: list[dict], progress=None) -> tuple:
+    t0 = time.perf_counter()
+    if DIFF_WRITES:
+        st = diff_write(table_name, payload)
+    else:
+        TABLE_SPECS[table_name]["delete"](table_name)
+        n = insert_chunks(table_name, payload, parallel=WRITE_PER_TABLE)
+        st = {"rows": n, "inserted": n, "deleted": None, "kept": 0, "full": True}
+    ms = round((time.perf_counter() - t0) * 1000.0, 3)
+    report(progress, "write", **{f"inserted_{table_name}": st["inserted"]})
+    return st, ms
+
+
+def write_tables(plan: list, progress=None) -> tuple:
+    """
+    plan = [(tabla, filas), ...]. Cada tabla: diff (o delete) -> inserts (en orden);
+    tablas distintas en paralelo. Retorna ({tabla: stats}, {tabla: ms}) con
+    stats = {"rows" (filas del resultado en la tabla), "inserted", "deleted", "kept", "full"}.
+    """
+    futs = [(t, _WRITE_TABLE_EXECUTOR.submit(_replace_table, t, rows, progress)) for t, rows in plan]
+    errors = [f.exception() for _, f in futs]
+    for e in errors:
+        if e is not None:
+            raise e
+    stats = {t: f.result()[0] for t, f in futs}
+    ms = {t: f.result()[1] for t, f in futs}
+    return stats, ms
+
+
+# -------------------------
+# Lectura de staging (solo columnas usadas, páginas en paralelo, conteo verificado)
+# -------------------------
+# lo que usa _prep_base + lo que sale en los outputs / rechazos (sin id ni columnas extra)
+STG_READ_COLS = ETL_COLS + ["loaded_at"]
+READ_WORKERS = max(1, int(os.environ.get("RUNNER_READ_WORKERS", "4")))
+
+_READ_EXECUTOR = ThreadPoolExecutor(max_workers=READ_WORKERS, thread_name_prefix="runner-read")
+
+
+def latest_loaded_at():
+    # última carga (sin nulos: en DESC Postgres los pone primero)
+    q = supabase.table(STG_TABLE).select("loaded_at").gte("loaded_at", "1900-01-01T00:00:00Z").order("loaded_at", desc=True).limit(1)
+    data = sb_exec("select", STG_TABLE, q).data or []
+    return data[0].get("loaded_at") if data else None
+
+
+def _pushdown_zone_ok(z: str) -> bool:
+    # ilike sin comodines == igualdad sin mayúsculas; solo valores que no hay que escapar en or=(...)
+    return z != "" and all(c.isalnum() or c in " _-" for c in z) and z.casefold() == z.lower()
+
+
+def pushdown_groups(filters: dict) -> list[str]:
+    """Filtros de solver.staging_filters -> grupos or(...) de PostgREST (se combinan con AND)."""
+    groups = []
+    zones = filters.get("zones") or []
+    if zones and all(_pushdown_zone_ok(z) for z in zones):
+        groups.append("or(" + ",".join(f"zona.ilike.{z}" for z in zones) + ")")
+    if filters.get("tms_min"):
+        groups.append(f"or(tms.gte.{float(filters['tms_min'])!r},tms.is.null,tms.lte.0)")
+    if filters.get("rec"):
+        rec = filters["rec"]
+        groups.append(f"or(rec_pct.gte.{float(rec['gte'])!r},rec_pct.lt.{float(rec['lt'])!r})")
+    return groups
+
+
+def _stg_query(latest=None, groups=(), count: str = ""):
+    q = supabase.table(STG_TABLE).select(",".join(STG_READ_COLS), count=count or None)
+    if latest is not None:
+        q = q.eq("loaded_at", latest)
+    if len(groups) == 1:
+        q = q.or_(groups[0][len("or("):-1])
+    elif groups:
+        # or=(and(or(..),or(..))): 1 solo parámetro con todos los grupos en AND
+        q = q.or_("and(" + ",".join(groups) + ")")
+    # orden total y estable: las páginas por rango no se pisan ni dejan huecos
+    return q.order("codigo").order("loaded_at")
+
+
+def _stg_page(latest, groups, start: int, end: int) -> list[dict]:
+    return sb_exec("select", STG_TABLE, _stg_query(latest, groups).range(start, end)).data or []
+
+
+def read_staging(params: dict = None, info: dict = None) -> pd.DataFrame:
+    """
+    stg_lotes_daily completo aunque PostgREST corte en max-rows: la 1ra página trae el conteo
+    exacto, el resto se pide en paralelo por rangos. Falla si no llegan todas las filas.
+
+    Siempre trae solo la última carga (loaded_at); con `params` además empuja a la query los
+    filtros de zona / lot_tms_min / rec que el solver aplicaría igual (ver staging_filters).
+    `info["pushdown"]` = filtros usados.
+    """
+    latest = latest_loaded_at()
+    groups = pushdown_groups(staging_filters(params)) if params is not None else []
+    if info is not None:
+        info["pushdown"] = {"loaded_at": latest, "filters": groups}
+
+    first = sb_exec("select", STG_TABLE, _stg_query(latest, groups, count="exact").range(0, SELECT_PAGE - 1))
+    pages = [first.data or []]
+    total = int(first.count) if first.count is not None else len(pages[0])
+
+    # si el servidor tiene un max-rows menor que SELECT_PAGE, se pagina con ese tamaño
+    size = len(pages[0]) if 0 < len(pages[0]) < min(SELECT_PAGE, total) else SELECT_PAGE
+    futs = [_READ_EXECUTOR.submit(_stg_page, latest, groups, a, a + size - 1) for a in range(len(pages[0]), total, size)]
+    pages.extend(f.result() for f in futs)
+
+    n = sum(len(p) for p in pages)
+    if n != total:
+        raise RuntimeError(f"{STG_TABLE}: se leyeron {n} filas de {total} (¿cambió durante la lectura?)")
+    metrics.ROWS_READ.inc(n, table=STG_TABLE)
+
+    # DataFrame por columnas (sin pasar por 1 dict por fila en pandas)
+    return pd.DataFrame({c: [r.get(c) for p in pages for r in p] for c in STG_READ_COLS})
+
+
 # -------------------------
 # Helpers ETL
 # -------------------------
+def report(progress, stage: str, **extra):
+    # progress: callback opcional (modo job); en modo síncrono es None
+    if progress is not None:
+        progress(stage, **extra)
+
+
 def json_safe(v):
     if v is None:
         return None
@@ -234,9 +627,38 @@ def parse_num(v):
     return pd.to_numeric(s, errors="coerce")
 
 
-def run_etl_from_sheets() -> dict:
+# parse_num_series: 1 str.translate por caso (borra "%" / espacios y arregla separadores)
+_NUM_PLAIN = str.maketrans("", "", "% ")
+_NUM_COMMA_DEC = str.maketrans({"%": None, " ": None, ".": None, ",": "."})
+_NUM_DOT_DEC = str.maketrans("", "", "% ,")
+
+
+def parse_num_series(col: pd.Series) -> pd.Series:
+    """
+    parse_num para una columna entera (SPEED: operaciones .str + 1 solo to_numeric).
+    Mismos casos: "12,34", "1.234,56" (europeo), "1,234.56" (US), "%", vacío/"nan" -> NaN.
+    """
+    s = col.astype(str).str.strip()
+
+    # la última separación es coma ("1.234,56" o "12,34"): puntos = miles, coma = decimal
+    comma_dec = s.str.contains(r",[^.]*$", regex=True)
+    # hay coma pero el último separador es punto ("1,234.56"): comas = miles
+    dot_dec = s.str.contains(",", regex=False) & ~comma_dec
+
+    out = s.str.translate(_NUM_PLAIN)
+    if comma_dec.any():
+        out[comma_dec] = s[comma_dec].str.translate(_NUM_COMMA_DEC)
+    if dot_dec.any():
+        out[dot_dec] = s[dot_dec].str.translate(_NUM_DOT_DEC)
+
+    # "", "nan" y basura no numérica -> NaN (igual que parse_num)
+    return pd.to_numeric(out, errors="coerce")
+
+
+def run_etl_from_sheets(progress=None) -> dict:
     # 1) Leer CSV (todo string)
     df = pd.read_csv(SHEETS_CSV_URL, dtype=str)
+    report(progress, "read_csv")
     df.columns = [str(c).strip() for c in df.columns]
 
     missing = [c for c in ETL_COLS if c not in df.columns]
@@ -245,9 +667,9 @@ def run_etl_from_sheets() -> dict:
 
     df = df[ETL_COLS].copy()
 
-    # 2) Parse numérico robusto
+    # 2) Parse numérico robusto (vectorizado por columna; mismo resultado que parse_num)
     for c in ETL_NUM_COLS:
-        df[c] = df[c].map(parse_num)
+        df[c] = parse_num_series(df[c])
 
     # 3) Limpieza mínima
     df["codigo"] = df["codigo"].astype(str).str.strip()
@@ -263,89 +685,482 @@ def run_etl_from_sheets() -> dict:
 
     # 4) JSON-safe records
     records = [{k: json_safe(v) for k, v in row.items()} for row in df.to_dict(orient="records")]
+    report(progress, "parse", rows_read=int(len(df)))
 
-    # 5) Borrar staging completo (MVP)
-    supabase.table(STG_TABLE).delete().gte("loaded_at", "1900-01-01T00:00:00Z").execute()
+    with table_locks(STG_TABLE):
+        # 5) Borrar staging completo (MVP)
+        delete_by_loaded_at(STG_TABLE)
+        report(progress, "delete")
 
-    # 6) Insert por chunks
-    inserted = 0
-    for i in range(0, len(records), ETL_CHUNK):
-        batch = records[i:i + ETL_CHUNK]
-        resp = supabase.table(STG_TABLE).insert(batch).execute()
-        inserted += len(resp.data or [])
+        # 6) Insert por chunks
+        inserted = insert_chunks(STG_TABLE, records, chunk_size=ETL_CHUNK)
+        report(progress, "insert", rows_inserted=inserted)
 
     return {"rows_read": int(len(df)), "rows_inserted": int(inserted)}
 
 
+def log_timings(event: str, timings: dict):
+    # 1 línea JSON por request (fácil de filtrar/parsear en los logs del contenedor)
+    print(json.dumps({"event": event, "timings": timings}, default=str), flush=True)
+
+
+def observe_request(endpoint: str, t0: float, out: dict) -> dict:
+    status = "ok" if out.get("ok") else "error"
+    metrics.REQUESTS.inc(endpoint=endpoint, status=status)
+    metrics.REQUEST_SECONDS.observe(time.perf_counter() - t0, endpoint=endpoint, status=status)
+    return out
+
+
+def observe_solve(info: dict, outputs: dict):
+    # fases del solver (ms -> s), pilas por output y restarts ejecutados
+    for phase, ms in ((info.get("timings") or {}).get("ms") or {}).items():
+        metrics.SOLVER_PHASE_SECONDS.observe(float(ms) / 1000.0, phase=phase)
+    for key, d in outputs.items():
+        n = int(d["pile_code"].nunique()) if d is not None and not d.empty and "pile_code" in d.columns else 0
+        metrics.SOLVER_PILES.inc(n, output=key)
+    metrics.SOLVER_RESTARTS.inc(int((info.get("restarts") or {}).get("total", 0)))
+
+
 # =========================
-# ENDPOINTS
+# SINGLE-FLIGHT + LOCKS DE ESCRITURA
 # =========================
-@app.post("/etl")
-async def etl(req: Request):
-    auth(req)
-    try:
-        try:
-            _ = await req.json()
-        except:
-            pass
+RESULT_TABLES = ["res_pila_1", "res_pila_2", "res_pila_3", REJ_TABLE]
 
-        info = run_etl_from_sheets()
-        return {"ok": True, **info}
+# 1 lock por tabla; siempre se toman en orden fijo (sin deadlocks entre /run y /etl)
+_TABLE_LOCKS = {t: threading.Lock() for t in sorted(RESULT_TABLES + [STG_TABLE])}
+
+# run_key -> Future con el resultado del /run en curso
+_INFLIGHT: dict = {}
+_INFLIGHT_LOCK = threading.Lock()
+
+
+@contextmanager
+def table_locks(*tables: str):
+    with ExitStack() as stack:
+        for t in sorted(set(tables)):
+            stack.enter_context(_TABLE_LOCKS[t])
+        yield
+
+
+def staging_snapshot_id() -> str:
+    # identidad barata del staging: último loaded_at + cantidad de filas (el ETL reemplaza todo).
+    # Sin nulos (como latest_loaded_at): en DESC Postgres los pone primero y el id quedaría "None|n"
+    q = (supabase.table(STG_TABLE).select("loaded_at", count="exact")
+         .gte("loaded_at", "1900-01-01T00:00:00Z").order("loaded_at", desc=True).limit(1))
+    resp = sb_exec("select", STG_TABLE, q)
+    last = (resp.data or [{}])[0].get("loaded_at")
+    return f"{last}|{resp.count}"
+
+
+def run_key(payload: dict, snapshot_id: str) -> str:
+    params = resolve_params(dict(payload))
+    blob = json.dumps({"params": params, "snapshot": snapshot_id}, sort_keys=True, default=str)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+# =========================
+# CACHE DE RESULTADOS (LRU por contenido del staging + params resueltos)
+# =========================
+RESULT_CACHE_SIZE = max(0, int(os.environ.get("RUNNER_RESULT_CACHE_SIZE", "8")))
+
+
+class ResultCache:
+    """
+    LRU chico en memoria: key -> payloads ya serializados (p1/p2/p3/rej) + info del solve.
+    Los valores no se mutan nunca (se comparten entre requests).
+    """
+    def __init__(self, max_items: int):
+        self.max_items = int(max_items)
+        self._items: "OrderedDict[str, dict]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            val = self._items.get(key)
+            if val is not None:
+                self._items.move_to_end(key)
+            return val
+
+    def put(self, key: str, val: dict):
+        if self.max_items <= 0:
+            return
+        with self._lock:
+            self._items[key] = val
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+
+RESULT_CACHE = ResultCache(RESULT_CACHE_SIZE)
+
+def frame_digest(df: pd.DataFrame) -> str:
+    # hash por fila (pandas, vectorizado) ordenado => independiente del orden de lectura
+    h = np.sort(pd.util.hash_pandas_object(df, index=False).to_numpy())
+    return hashlib.sha256(h.tobytes()).hexdigest()
+
+
+def rows_digest(rows: list) -> str:
+    # independiente del orden en que PostgREST devuelva las filas
+    h = hashlib.sha256()
+    for line in sorted(json.dumps(r, sort_keys=True, default=str) for r in rows):
+        h.update(line.encode("utf-8"))
+        h.update(b"\n")
+    return h.hexdigest()
+
+
+def result_key(params: dict, df: pd.DataFrame, prev) -> str:
+    last = df["loaded_at"].dropna().astype(str).max() if "loaded_at" in df.columns and df["loaded_at"].notna().any() else None
+    blob = json.dumps({
+        "params": params,
+        "staging": {"max_loaded_at": last, "rows": int(len(df)), "digest": frame_digest(df)},
+        # warm_start: el resultado depende también de las pilas previas
+        "prev": rows_digest([r for k in sorted(prev or {}) for r in prev[k]]) if prev else None,
+    }, sort_keys=True, default=str)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+def do_etl(progress=None) -> dict:
+    t0 = time.perf_counter()
+    try:
+        info = run_etl_from_sheets(progress)
+        return observe_request("etl", t0, {"ok": True, **info})
 
     except Exception as e:
         # ✅ SIEMPRE JSON
-        return {"ok": False, "error": str(e)}
+        return observe_request("etl", t0, {"ok": False, "error": str(e)})
 
 
-@app.post("/run")
-async def run(req: Request):
-    auth(req)
+def do_run(payload: dict, progress=None) -> dict:
+    # bloqueante (Supabase + solve): se llama desde un thread, nunca en el event loop
+    t0 = time.perf_counter()
     try:
-        # 0) leer payload UI (si viene). Si no viene o es inválido, queda {}
-        payload = {}
+        # single-flight: mismos params resueltos + mismo staging => 1 sola ejecución compartida
+        with table_locks(STG_TABLE):
+            key = run_key(payload, staging_snapshot_id())
+        with _INFLIGHT_LOCK:
+            fut = _INFLIGHT.get(key)
+            leader = fut is None
+            if leader:
+                fut = Future()
+                _INFLIGHT[key] = fut
+
+        if not leader:
+            report(progress, "coalesced")
+            out = fut.result()
+            return observe_request("run", t0, {**out, "coalesced": True})
+
         try:
-            payload = await req.json()
-            if not isinstance(payload, dict):
-                payload = {}
-        except:
-            payload = {}
-
-        # 1) leer input
-        resp = supabase.table(STG_TABLE).select("*").execute()
-        rows = resp.data or []
-        if not rows:
-            return {"ok": False, "error": "stg_lotes_daily vacío"}
-
-        df = pd.DataFrame(rows)
-
-        # 2) correr solver (con payload opcional)
-        p1, p2, p3, rej_lowrec = solve(df, payload)
-
-        # 3) preparar payloads (✅ convierte loaded_at a ISO)
-        payload_1 = prep_payload(p1)
-        payload_2 = prep_payload(p2)
-        payload_3 = prep_payload(p3)
-        payload_rej = prep_payload_rej(rej_lowrec)
-
-        # 4) delete + insert (pila outputs)
-        delete_all("res_pila_1")
-        delete_all("res_pila_2")
-        delete_all("res_pila_3")
-
-        ins1 = insert_chunks("res_pila_1", payload_1)
-        ins2 = insert_chunks("res_pila_2", payload_2)
-        ins3 = insert_chunks("res_pila_3", payload_3)
-
-        # 5) delete + insert (rechazos por baja rec)
-        delete_by_loaded_at(REJ_TABLE)
-        ins_rej = insert_chunks(REJ_TABLE, payload_rej)
-
-        return {
-            "ok": True,
-            "inserted": {"p1": ins1, "p2": ins2, "p3": ins3, "rej_lowrec": ins_rej},
-            "payload_used": payload,  # debug
-        }
+            out = run_pipeline(payload, progress)
+        except Exception as e:
+            out = {"ok": False, "error": str(e)}
+        finally:
+            with _INFLIGHT_LOCK:
+                _INFLIGHT.pop(key, None)
+        fut.set_result(out)
+        return observe_request("run", t0, {**out, "coalesced": False})
 
     except Exception as e:
         # ✅ SIEMPRE JSON (evita "Runner no devolvió JSON")
-        return {"ok": False, "error": str(e)}
+        return observe_request("run", t0, {"ok": False, "error": str(e)})
+
+
+def run_pipeline(payload: dict, progress=None) -> dict:
+    # tiempos por fase (se devuelven en "timings" y van al log en 1 línea)
+    tm = Timings()
+
+    def lap(stage: str, **extra):
+        tm.lap(stage)
+        report(progress, stage, **extra)
+
+    # 1) leer input (el ETL no puede estar a mitad de reemplazar el staging);
+    #    la query ya filtra última carga / zonas / lot_tms_min / rec según params
+    params = resolve_params(dict(payload))
+    read_info = {}
+    with table_locks(STG_TABLE):
+        df = read_staging(params, info=read_info)
+    lap("select", rows_read=int(len(df)))
+    if df.empty and not read_info["pushdown"]["filters"]:
+        return {"ok": False, "error": "stg_lotes_daily vacío"}
+
+    # 2) warm_start parte de las pilas guardadas
+    prev = read_prev_piles() if params.get("warm_start") else None
+    lap("select_prev")
+
+    # 3) cache: mismo staging (contenido) + mismos params => mismo resultado, sin solve
+    key = result_key(params, df, prev)
+    cached = RESULT_CACHE.get(key)
+    hit = cached is not None
+    metrics.RESULT_CACHE.inc(result="hit" if hit else "miss")
+    lap("cache_lookup", cache_hit=hit)
+
+    if cached is None:
+        info = {}
+        p1, p2, p3, rej_lowrec = solve(df, payload, info=info, prev=prev)
+        lap("solve", restarts=(info.get("restarts") or {}).get("total"))
+        observe_solve(info, {"p1": p1, "p2": p2, "p3": p3})
+
+        # preparar payloads (✅ convierte loaded_at a ISO)
+        cached = {
+            "p1": prep_payload(p1),
+            "p2": prep_payload(p2),
+            "p3": prep_payload(p3),
+            "rej_lowrec": prep_payload_rej(rej_lowrec),
+            "info": {k: info.get(k) for k in ("restarts", "prep", "truncated", "warm", "timings")},
+        }
+        lap("serialize")
+        # un solve cortado por time_budget_ms no es reproducible: no se cachea
+        if not any((info.get("truncated") or {}).values()):
+            RESULT_CACHE.put(key, cached)
+    info = cached["info"]
+
+    # runs con params distintos resuelven en paralelo, pero escriben de a 1 (sin mezclar resultados)
+    with table_locks(*RESULT_TABLES):
+        lap("write_lock")
+
+        # 4) delete + insert: pilas (res_pila_1/2/3) y rechazos por baja rec, tablas en paralelo.
+        # Siempre contra lo que hay en las tablas (otro worker, un write cortado o una edición a
+        # mano las pueden haber cambiado): el diff deja intactas las pilas / códigos que no cambiaron.
+        wst, tables_ms = write_tables([
+            ("res_pila_1", cached["p1"]),
+            ("res_pila_2", cached["p2"]),
+            ("res_pila_3", cached["p3"]),
+            (REJ_TABLE, cached["rej_lowrec"]),
+        ], progress)
+        lap("write")
+
+    # "inserted" = filas del resultado en cada tabla (contrato de la UI); el detalle va en "diff"
+    inserted = {"p1": wst["res_pila_1"]["rows"], "p2": wst["res_pila_2"]["rows"], "p3": wst["res_pila_3"]["rows"], "rej_lowrec": wst[REJ_TABLE]["rows"]}
+    diff = wst
+    # written = alguna tabla cambió (deleted None = reemplazo completo)
+    written = any(st["inserted"] or st["deleted"] is None or st["deleted"] for st in wst.values())
+
+    timings = {
+        "ms": tm.ms,
+        "total_ms": tm.total(),
+        "write_tables_ms": tables_ms,  # en paralelo: "write" ~ la tabla más lenta, no la suma
+        "solver": info.get("timings") if not hit else None,
+    }
+    log_timings("run", timings)
+
+    return {
+        "ok": True,
+        "inserted": inserted,
+        "cache": {"hit": hit, "written": written},
+        "diff": diff,
+        "pushdown": read_info.get("pushdown"),
+        "restarts": info.get("restarts"),
+        "prep": info.get("prep"),
+        "truncated": info.get("truncated"),
+        "warm": info.get("warm"),
+        "timings": timings,
+        "payload_used": payload,  # debug
+    }
+
+
+def do_sweep(body: dict, progress=None) -> dict:
+    """
+    body = {"payload": {...base como /run}, "variants": [{override}, ...], "grid": {param: [valores]}}
+    Lee el staging 1 vez, resuelve todas las variantes y retorna la tabla comparativa. No escribe.
+    """
+    t0 = time.perf_counter()
+    try:
+        tm = Timings()
+        base_payload = body.get("payload") if isinstance(body.get("payload"), dict) else {}
+        overrides = sweep_variants(body.get("variants"), body.get("grid"))
+        report(progress, "variants", variants=len(overrides))
+
+        with table_locks(STG_TABLE):
+            df = read_staging()
+        tm.lap("select")
+        report(progress, "select", rows_read=int(len(df)))
+        if df.empty:
+            return observe_request("sweep", t0, {"ok": False, "error": "stg_lotes_daily vacío"})
+
+        info = {}
+        results = solve_sweep(df, overrides, base_payload, info=info)
+        tm.lap("solve")
+        report(progress, "solve")
+
+        timings = {"ms": tm.ms, "total_ms": tm.total(), "solver": info.get("ms")}
+        log_timings("sweep", timings)
+        return observe_request("sweep", t0, {
+            "ok": True,
+            "variants": len(results),
+            "results": results,
+            "timings": timings,
+        })
+
+    except Exception as e:
+        return observe_request("sweep", t0, {"ok": False, "error": str(e)})
+
+
+# =========================
+# JOBS (POST /jobs/run|etl|sweep -> id; GET /jobs/{id} -> estado/progreso/resultado)
+# =========================
+RUN_STAGES = [
+    "select", "select_prev", "cache_lookup", "solve", "serialize", "write_lock", "write",
+]
+ETL_STAGES = ["read_csv", "parse", "delete", "insert"]
+SWEEP_STAGES = ["variants", "select", "solve"]
+
+# threads (no procesos): el trabajo es I/O a Supabase + solve(), que ya paraleliza en su propio pool
+JOB_WORKERS = max(1, int(os.environ.get("RUNNER_JOB_WORKERS", "2")))
+JOBS_KEEP = max(1, int(os.environ.get("RUNNER_JOBS_KEEP", "100")))
+# jobs esperando worker: más que esto => 429 (el executor encola sin límite)
+JOBS_MAX_QUEUED = max(1, int(os.environ.get("RUNNER_JOBS_MAX_QUEUED", "20")))
+
+_JOB_EXECUTOR = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="runner-job")
+_JOBS: dict = {}
+_JOBS_LOCK = threading.Lock()
+
+
+def _now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _job_update(job_id: str, **fields):
+    with _JOBS_LOCK:
+        job = _JOBS.get(job_id)
+        if job is not None:
+            job.update(fields)
+
+
+def _job_progress(job_id: str, stages: list):
+    def progress(stage: str, **extra):
+        with _JOBS_LOCK:
+            job = _JOBS.get(job_id)
+            if job is None:
+                return
+            prog = job["progress"]
+            prog["stage"] = stage
+            prog["step"] = stages.index(stage) + 1 if stage in stages else prog["step"]
+            prog["counts"].update(extra)
+    return progress
+
+
+def _job_main(job_id: str, kind: str, fn, *args):
+    _job_update(job_id, status="running", started_at=_now_iso())
+    try:
+        out = fn(*args)
+    except Exception as e:
+        out = {"ok": False, "error": str(e)}
+    _job_update(job_id, status="done" if out.get("ok") else "error", finished_at=_now_iso(), result=out)
+
+
+def _prune_jobs():
+    # solo se descartan jobs terminados, los más viejos primero
+    done = [j for j in _JOBS.values() if j["status"] in ("done", "error")]
+    extra = len(done) - JOBS_KEEP
+    if extra > 0:
+        for j in sorted(done, key=lambda j: j["created_at"])[:extra]:
+            _JOBS.pop(j["id"], None)
+
+
+# kind -> (función bloqueante, etapas para el progreso)
+_JOB_KINDS = {
+    "run": (do_run, RUN_STAGES),
+    "etl": (do_etl, ETL_STAGES),
+    "sweep": (do_sweep, SWEEP_STAGES),
+}
+
+
+def submit_job(kind: str, payload: dict) -> dict:
+    job_id = uuid.uuid4().hex
+    fn, stages = _JOB_KINDS[kind]
+    job = {
+        "id": job_id,
+        "kind": kind,
+        "status": "queued",
+        "created_at": _now_iso(),
+        "started_at": None,
+        "finished_at": None,
+        "progress": {"stage": None, "step": 0, "steps": len(stages), "counts": {}},
+        "result": None,
+    }
+    with _JOBS_LOCK:
+        queued = sum(1 for j in _JOBS.values() if j["status"] == "queued")
+        if queued >= JOBS_MAX_QUEUED:
+            raise HTTPException(
+                status_code=429,
+                detail=f"demasiados jobs en cola ({queued}/{JOBS_MAX_QUEUED})",
+                headers={"Retry-After": "30"},
+            )
+        _prune_jobs()
+        _JOBS[job_id] = job
+
+    progress = _job_progress(job_id, stages)
+    if kind == "etl":
+        _JOB_EXECUTOR.submit(_job_main, job_id, kind, fn, progress)
+    else:
+        _JOB_EXECUTOR.submit(_job_main, job_id, kind, fn, payload, progress)
+    return {"id": job_id, "status": "queued"}
+
+
+def get_job(job_id: str):
+    with _JOBS_LOCK:
+        job = _JOBS.get(job_id)
+        return json.loads(json.dumps(job, default=str)) if job is not None else None
+
+
+async def read_payload(req: Request) -> dict:
+    # payload UI (si viene). Si no viene o es inválido, queda {}
+    try:
+        payload = await req.json()
+        return payload if isinstance(payload, dict) else {}
+    except:
+        return {}
+
+
+# =========================
+# ENDPOINTS
+# =========================
+@app.post("/etl")
+async def etl(req: Request):
+    auth(req)
+    _ = await read_payload(req)
+    # síncrono para la UI, pero fuera del event loop (/health sigue respondiendo)
+    return await run_in_threadpool(do_etl)
+
+
+@app.post("/run")
+async def run(req: Request):
+    auth(req)
+    payload = await read_payload(req)
+    return await run_in_threadpool(do_run, payload)
+
+
+@app.post("/sweep")
+async def sweep(req: Request):
+    auth(req)
+    body = await read_payload(req)
+    return await run_in_threadpool(do_sweep, body)
+
+
+@app.post("/jobs/etl")
+async def etl_job(req: Request):
+    auth(req)
+    _ = await read_payload(req)
+    return {"ok": True, "job": submit_job("etl", {})}
+
+
+@app.post("/jobs/run")
+async def run_job(req: Request):
+    auth(req)
+    payload = await read_payload(req)
+    return {"ok": True, "job": submit_job("run", payload)}
+
+
+@app.post("/jobs/sweep")
+async def sweep_job(req: Request):
+    auth(req)
+    body = await read_payload(req)
+    return {"ok": True, "job": submit_job("sweep", body)}
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str, req: Request):
+    auth(req)
+    job = get_job(job_id)
+    if job is None:
+        return {"ok": False, "error": f"job no encontrado: {job_id}"}
+    return {"ok": True, "job": job}
@@ -0,0 +1,140 @@
+"""
+Métricas en proceso con formato de texto Prometheus (sin cliente ni collector externo).
+
+  REQUESTS.inc(endpoint="run", status="ok")
+  REQUEST_SECONDS.observe(1.23, endpoint="run", status="ok")
+  render()  -> texto para GET /metrics
+
+Counters e histogramas con labels; todo protegido con 1 lock (uvicorn corre handlers sync en threads).
+"""
+import math
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+_LOCK = threading.Lock()
+_REGISTRY: List["_Metric"] = []
+
+# segundos: desde llamadas cortas a Supabase hasta solves largos
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def _fmt(v: float) -> str:
+    if math.isinf(v):
+        return "+Inf" if v > 0 else "-Inf"
+    if float(v).is_integer():
+        return str(int(v))
+    return repr(float(v))
+
+
+def _esc(v: str) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{n}="{_esc(v)}"' for n, v in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{_esc(extra[1])}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        with _LOCK:
+            _REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def _lines(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help_text, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        if amount < 0:
+            return
+        k = self._key(labels)
+        with _LOCK:
+            self._values[k] = self._values.get(k, 0.0) + float(amount)
+
+    def _lines(self) -> List[str]:
+        return [f"{self.name}{_labels(self.labelnames, k)} {_fmt(v)}" for k, v in sorted(self._values.items())]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(float(b) for b in buckets))
+        # por serie: [conteos por bucket..., sum, count]
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        v = float(value)
+        if math.isnan(v):
+            return
+        k = self._key(labels)
+        with _LOCK:
+            row = self._values.get(k)
+            if row is None:
+                row = [0.0] * (len(self.buckets) + 2)
+                self._values[k] = row
+            for i, b in enumerate(self.buckets):
+                if v <= b:
+                    row[i] += 1
+            row[-2] += v
+            row[-1] += 1
+
+    def _lines(self) -> List[str]:
+        out: List[str] = []
+        for k, row in sorted(self._values.items()):
+            for i, b in enumerate(self.buckets):
+                out.append(f"{self.name}_bucket{_labels(self.labelnames, k, ('le', _fmt(b)))} {_fmt(row[i])}")
+            out.append(f"{self.name}_bucket{_labels(self.labelnames, k, ('le', '+Inf'))} {_fmt(row[-1])}")
+            out.append(f"{self.name}_sum{_labels(self.labelnames, k)} {_fmt(row[-2])}")
+            out.append(f"{self.name}_count{_labels(self.labelnames, k)} {_fmt(row[-1])}")
+        return out
+
+
+def render() -> str:
+    lines: List[str] = []
+    with _LOCK:
+        for m in _REGISTRY:
+            lines.append(f"# HELP {m.name} {m.help}")
+            lines.append(f"# TYPE {m.name} {m.kind}")
+            lines.extend(m._lines())
+    return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+# =========================
+# MÉTRICAS DEL RUNNER
+# =========================
+REQUESTS = Counter("runner_requests_total", "Requests a /run, /etl y /sweep por resultado.", ["endpoint", "status"])
+REQUEST_SECONDS = Histogram("runner_request_seconds", "Latencia de /run, /etl y /sweep.", ["endpoint", "status"])
+
+SOLVER_PHASE_SECONDS = Histogram("solver_phase_seconds", "Duración de cada fase del solver.", ["phase"])
+SOLVER_PILES = Counter("solver_piles_total", "Pilas producidas por output.", ["output"])
+SOLVER_RESTARTS = Counter("solver_restarts_total", "Restarts greedy ejecutados por el solver.")
+
+RESULT_CACHE = Counter("runner_result_cache_total", "Lookups al cache de resultados de /run.", ["result"])
+
+ROWS_READ = Counter("runner_rows_read_total", "Filas leídas por tabla.", ["table"])
+ROWS_INSERTED = Counter("runner_rows_inserted_total", "Filas insertadas por tabla.", ["table"])
+
+SUPABASE_SECONDS = Histogram("supabase_request_seconds", "Latencia de llamadas a Supabase.", ["op", "table"])
+SUPABASE_ERRORS = Counter("supabase_errors_total", "Llamadas a Supabase que fallaron.", ["op", "table"])
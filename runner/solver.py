@@ -1,5 +1,10 @@
 import math
-from typing import Any, Dict, List, Tuple, Optional
+import multiprocessing as mp
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, Callable, Dict, List, Tuple, Optional
 
 import numpy as np
 import pandas as pd
@@ -7,6 +12,24 @@ import pandas as pd
 # =========================
 # PARAMS
 # =========================
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.environ.get(name, default))
+    except:
+        return default
+
+
+def _past_deadline(deadline: Optional[float]) -> bool:
+    # deadline en reloj time.monotonic() (sirve igual dentro de los workers)
+    return deadline is not None and time.monotonic() >= deadline
+
+
+def _note_deadline_stop(stats: Optional[Dict[str, Any]]) -> None:
+    # un loop cortó trabajo pendiente por el deadline (=> info["truncated"] de su fase)
+    if stats is not None:
+        stats["deadline_stops"] = int(stats.get("deadline_stops", 0)) + 1
+
+
 DEFAULT_PARAMS: Dict[str, Any] = {
     "lot_rec_min": 85.0,
     "pile_rec_min": 85.0,
@@ -40,11 +63,38 @@ DEFAULT_PARAMS: Dict[str, Any] = {
     "batch_pair_topk": 10,
     "batch_pair_pool": 16,
 
+    # PARALELISMO (bloques de restarts por pila; 1 = serie, igual que siempre)
+    "batch_workers": _env_int("SOLVER_BATCH_WORKERS", 1),
+    # 1 = fase hard y soft de cada intento en paralelo (workers); se queda con hard si es factible
+    "batch_speculative": _env_int("SOLVER_BATCH_SPECULATIVE", 0),
+    # intentos de seed de cada pila batch (MAX_SEED_TRIES) en paralelo; 1 = en serie
+    "batch_seed_workers": _env_int("SOLVER_SEED_WORKERS", 1),
+
+    # CONVERGENCIA (corta restarts: sin mejora en `patience` o under==0 y gap<=stop_gap; <0 = off)
+    "batch_patience": 300,
+    "batch_stop_gap": 0.0,
+
+    # MOTOR: "greedy" (restarts), "exact" (branch-and-bound) o "auto" (exacto si hay <= exact_max_lots lotes)
+    "batch_engine": "auto",
+    "batch_exact_max_lots": 24,
+    "batch_exact_max_nodes": 100000,
+
+    # PRESUPUESTO DE TIEMPO (ms, 0 = sin límite): se reparte entre varios / batch / mix y cada
+    # fase devuelve lo mejor que tenga al vencer su parte
+    "time_budget_ms": 0.0,
+
+    # WARM START (1 = parte de las pilas del run anterior: conserva las que siguen válidas y
+    # siembra con la pila anterior los restarts de las que hay que rehacer)
+    "warm_start": 0,
+
     # SEEDS
     "seed_batch_base": 100,
     "seed_mix_batch": 888,
 }
 
+# tope de batch_exact_max_lots que acepta resolve_params (payload/knobs)
+EXACT_MAX_LOTS_CAP = 40
+
 
 def _to_float(x: Any, default: float) -> float:
     try:
@@ -166,6 +216,7 @@ def resolve_params(payload: Optional[Dict[str, Any]]) -> Dict[str, Any]:
         "bat_tms_max", "bat_tms_target", "bat_tms_min",
         "bat_lot_g_min", "bat_pile_g_min", "bat_pile_g_max",
         "reag_min", "reag_max",
+        "batch_stop_gap", "time_budget_ms",
     ]:
         if k in payload:
             p[k] = _to_float(payload.get(k), p[k])
@@ -232,7 +283,9 @@ def resolve_params(payload: Optional[Dict[str, Any]]) -> Dict[str, Any]:
         "batch_n_iters_hard", "batch_n_iters_soft",
         "batch_max_steps", "batch_cand_sample",
         "batch_reseeds", "batch_pair_topk", "batch_pair_pool",
-        "seed_batch_base", "seed_mix_batch",
+        "batch_workers", "batch_patience", "batch_speculative", "batch_seed_workers",
+        "batch_exact_max_lots", "batch_exact_max_nodes",
+        "seed_batch_base", "seed_mix_batch", "warm_start",
     ]
     for k in int_keys:
         if k in payload:
@@ -244,9 +297,16 @@ def resolve_params(payload: Optional[Dict[str, Any]]) -> Dict[str, Any]:
             "batch_n_iters_hard", "batch_n_iters_soft",
             "batch_max_steps", "batch_cand_sample",
             "batch_reseeds", "batch_pair_topk", "batch_pair_pool",
+            "batch_workers", "batch_patience", "batch_speculative", "batch_seed_workers",
+            "batch_exact_max_lots", "batch_exact_max_nodes", "warm_start",
         ]:
             if k in kx:
                 p[k] = _to_int(kx.get(k), p[k])
+        for k in ["batch_stop_gap", "time_budget_ms"]:
+            if k in kx:
+                p[k] = _to_float(kx.get(k), p[k])
+        if "batch_engine" in kx:
+            p["batch_engine"] = kx.get("batch_engine")
 
     if isinstance(payload.get("seeds"), dict):
         sx = payload["seeds"]
@@ -269,8 +329,26 @@ def resolve_params(payload: Optional[Dict[str, Any]]) -> Dict[str, Any]:
     if not isinstance(p.get("var_g_tries"), list) or len(p["var_g_tries"]) == 0:
         p["var_g_tries"] = list(DEFAULT_PARAMS["var_g_tries"])
 
+    if "batch_engine" in payload:
+        p["batch_engine"] = payload.get("batch_engine")
+    eng = str(p.get("batch_engine") or "").strip().lower()
+    p["batch_engine"] = eng if eng in ("greedy", "exact", "auto") else DEFAULT_PARAMS["batch_engine"]
+
+    if int(p["batch_workers"]) < 1:
+        p["batch_workers"] = 1
+    p["batch_speculative"] = 1 if int(p["batch_speculative"]) > 0 else 0
+    if int(p["batch_seed_workers"]) < 1:
+        p["batch_seed_workers"] = 1
+    # "auto" con muchos lotes = búsqueda exponencial cortada por nodos: se limita el umbral
+    p["batch_exact_max_lots"] = max(0, min(int(p["batch_exact_max_lots"]), EXACT_MAX_LOTS_CAP))
+    if int(p["batch_exact_max_nodes"]) < 1:
+        p["batch_exact_max_nodes"] = 1
+    p["warm_start"] = 1 if int(p["warm_start"]) > 0 else 0
+
     if float(p.get("bat_lot_g_min", 0.0) or 0.0) < 0:
         p["bat_lot_g_min"] = 0.0
+    if float(p["time_budget_ms"]) < 0:
+        p["time_budget_ms"] = 0.0
 
     p["zones"] = _parse_str_list(p.get("zones"))
     return p
@@ -294,10 +372,55 @@ def _classify_rec_series(rec: pd.Series) -> pd.Series:
     return pd.Series(out, index=rec.index, dtype="object")
 
 
+def staging_filters(params: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Filtros de _prep_base / _eligible_from_base que se pueden empujar a la query del staging
+    sin perder filas que necesitan el solve o los rechazos (el prep los vuelve a aplicar igual):
+      "zones":   zonas pedidas (comparación sin mayúsculas; el ETL ya guarda zona sin espacios)
+      "tms_min": lot_tms_min; también hay que traer tms nulo/<= 0 (se recalcula con tmh)
+      "rec":     {"gte": eff, "lt": REJ_REC_CEIL} solo si eff > REJ_REC_CEIL (si no, sirven todas)
+    """
+    out: Dict[str, Any] = {}
+    zones = _parse_str_list(params.get("zones", None))
+    if zones:
+        out["zones"] = [str(z).strip() for z in zones if str(z).strip() != ""]
+
+    lot_tms_min = float(params.get("lot_tms_min", 0.0) or 0.0)
+    if lot_tms_min > 0:
+        out["tms_min"] = lot_tms_min
+
+    eff = min(float(params.get("lot_rec_min", 85.0)), float(params.get("pile_rec_min", 85.0)))
+    if eff > REJ_REC_CEIL:
+        out["rec"] = {"gte": eff, "lt": REJ_REC_CEIL}
+    return out
+
+
 # =========================
 # PREP / PREPROCESS (SPEED: menos apply, cod normalizado 1 vez)
 # =========================
-def _prep_base(df: pd.DataFrame, params: Dict[str, Any]) -> pd.DataFrame:
+def _filter_zones(d: pd.DataFrame, params: Dict[str, Any], rows: Dict[str, int]) -> pd.DataFrame:
+    zones_list = _parse_str_list(params.get("zones", None))
+    if not zones_list:
+        return d
+    zset = {str(z).strip().casefold() for z in zones_list if str(z).strip() != ""}
+    d = d[d["zona"].astype(str).str.strip().str.casefold().isin(zset)].copy()
+    rows["zones"] = int(len(d))
+    return d
+
+
+def _filter_lot_tms(d: pd.DataFrame, params: Dict[str, Any], rows: Dict[str, int]) -> pd.DataFrame:
+    lot_tms_min = float(params.get("lot_tms_min", 0.0) or 0.0)
+    if lot_tms_min <= 0:
+        return d
+    d = d[d["tms"] >= lot_tms_min].copy()
+    rows["lot_tms_min"] = int(len(d))
+    return d
+
+
+def _prep_base(df: pd.DataFrame, params: Dict[str, Any], stats: Optional[Dict[str, Any]] = None) -> pd.DataFrame:
+    # stats["rows"]: filas que sobreviven cada etapa (diagnóstico)
+    rows: Dict[str, int] = stats.setdefault("rows", {}) if stats is not None else {}
+    rows["input"] = 0 if df is None else int(len(df))
     if df is None or df.empty:
         return pd.DataFrame()
 
@@ -308,6 +431,7 @@ def _prep_base(df: pd.DataFrame, params: Dict[str, Any]) -> pd.DataFrame:
         d["loaded_at"] = pd.to_datetime(d["loaded_at"], utc=True, errors="coerce")
         last_load = d["loaded_at"].max()
         d = d[d["loaded_at"] == last_load].copy()
+    rows["latest_load"] = int(len(d))
 
     # Ensure columns early (evita checks repetidos)
     if "zona" not in d.columns:
@@ -329,6 +453,7 @@ def _prep_base(df: pd.DataFrame, params: Dict[str, Any]) -> pd.DataFrame:
 
     # Hard required fields
     d = d.dropna(subset=["codigo", "au_gr_ton", "rec_pct"]).copy()
+    rows["required"] = int(len(d))
     if d.empty:
         return pd.DataFrame()
 
@@ -336,14 +461,9 @@ def _prep_base(df: pd.DataFrame, params: Dict[str, Any]) -> pd.DataFrame:
     d["_cod"] = d["codigo"].astype(str)
 
     # Zone filter
-    zones_list = _parse_str_list(params.get("zones", None))
-    if zones_list:
-        zset = {str(z).strip().casefold() for z in zones_list if str(z).strip() != ""}
-        d["_zona_norm"] = d["zona"].astype(str).str.strip().str.casefold()
-        d = d[d["_zona_norm"].isin(zset)].copy()
-        d = d.drop(columns=["_zona_norm"], errors="ignore")
-        if d.empty:
-            return pd.DataFrame()
+    d = _filter_zones(d, params, rows)
+    if d.empty:
+        return pd.DataFrame()
 
     # Numeric casting (SPEED: loop en vez de apply)
     num_cols = [
@@ -371,15 +491,14 @@ def _prep_base(df: pd.DataFrame, params: Dict[str, Any]) -> pd.DataFrame:
     # positive constraints
     d = d.dropna(subset=["tms", "tmh_eff"]).copy()
     d = d[(d["tms"] > 0) & (d["tmh_eff"] > 0)].copy()
+    rows["tms_positive"] = int(len(d))
     if d.empty:
         return pd.DataFrame()
 
     # lot_tms_min filter
-    lot_tms_min = float(params.get("lot_tms_min", 0.0) or 0.0)
-    if lot_tms_min > 0:
-        d = d[d["tms"] >= lot_tms_min].copy()
-        if d.empty:
-            return pd.DataFrame()
+    d = _filter_lot_tms(d, params, rows)
+    if d.empty:
+        return pd.DataFrame()
 
     # Ensure fines (vectorizado)
     mask_auf = d["au_fino"].isna()
@@ -396,8 +515,30 @@ def _prep_base(df: pd.DataFrame, params: Dict[str, Any]) -> pd.DataFrame:
     return d
 
 
-def preprocess(df: pd.DataFrame, params: Dict[str, Any]) -> pd.DataFrame:
-    d = _prep_base(df, params)
+def prep_shared(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    La parte de _prep_base que no depende de params (última carga, casteo, TMS, finos).
+    Para correr varias variantes (sweep) sobre 1 solo prep: preprocess_all(..., base=...).
+    """
+    return _prep_base(df, {})
+
+
+def _filter_base(base: pd.DataFrame, params: Dict[str, Any], stats: Optional[Dict[str, Any]] = None) -> pd.DataFrame:
+    # filtros por fila de _prep_base que dependen de params (conmutan con el resto del prep)
+    rows: Dict[str, int] = stats.setdefault("rows", {}) if stats is not None else {}
+    rows["shared"] = 0 if base is None else int(len(base))
+    if base is None or base.empty:
+        return pd.DataFrame()
+    d = _filter_zones(base, params, rows)
+    if d.empty:
+        return pd.DataFrame()
+    d = _filter_lot_tms(d, params, rows)
+    if d.empty:
+        return pd.DataFrame()
+    return d
+
+
+def _eligible_from_base(d: pd.DataFrame, params: Dict[str, Any]) -> pd.DataFrame:
     if d is None or d.empty:
         return pd.DataFrame()
 
@@ -410,8 +551,7 @@ def preprocess(df: pd.DataFrame, params: Dict[str, Any]) -> pd.DataFrame:
     return d
 
 
-def build_rejects_lowrec(df: pd.DataFrame, params: Dict[str, Any]) -> pd.DataFrame:
-    d = _prep_base(df, params)
+def _rejects_from_base(d: pd.DataFrame) -> pd.DataFrame:
     if d is None or d.empty:
         return pd.DataFrame()
 
@@ -441,6 +581,117 @@ def build_rejects_lowrec(df: pd.DataFrame, params: Dict[str, Any]) -> pd.DataFra
     return d[cols].copy()
 
 
+def preprocess(df: pd.DataFrame, params: Dict[str, Any]) -> pd.DataFrame:
+    return _eligible_from_base(_prep_base(df, params), params)
+
+
+def build_rejects_lowrec(df: pd.DataFrame, params: Dict[str, Any]) -> pd.DataFrame:
+    return _rejects_from_base(_prep_base(df, params))
+
+
+def preprocess_all(
+    df: pd.DataFrame,
+    params: Dict[str, Any],
+    stats: Optional[Dict[str, Any]] = None,
+    base: Optional[pd.DataFrame] = None,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    1 sola pasada de _prep_base para ambos outputs: (lotes elegibles, rechazos por baja rec).
+    Si se pasa `stats`, deja filas por etapa en stats["rows"] y tiempos (ms) en stats["ms"].
+    Con `base` (salida de prep_shared) solo se aplican los filtros que dependen de params.
+    """
+    st = stats if stats is not None else {}
+    t0 = time.perf_counter()
+    base = _prep_base(df, params, st) if base is None else _filter_base(base, params, st)
+    t1 = time.perf_counter()
+    eligible = _eligible_from_base(base, params)
+    t2 = time.perf_counter()
+    rejects = _rejects_from_base(base)
+    t3 = time.perf_counter()
+
+    st.setdefault("rows", {}).update({"eligible": int(len(eligible)), "rejects": int(len(rejects))})
+    st["ms"] = {
+        "base": round((t1 - t0) * 1000.0, 3),
+        "eligible": round((t2 - t1) * 1000.0, 3),
+        "rejects": round((t3 - t2) * 1000.0, 3),
+        "total": round((t3 - t0) * 1000.0, 3),
+    }
+    return eligible, rejects
+
+
+# =========================
+# LOT POOL (columnar: arrays contiguos + máscara alive, 1 sola vez por solve)
+# =========================
+class LotPool:
+    """
+    Vista columnar de la salida de preprocess. Los builders (varios / top-up / batch)
+    trabajan con arrays de índices (posiciones) sobre este pool; los DataFrame solo se
+    materializan con `take` para los outputs finales.
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        d = df if df is not None else pd.DataFrame()
+        for c in ["codigo", "tmh_eff", "tms", "au_gr_ton", "rec_pct", "au_fino", "nacn_kg_t", "naoh_kg_t"]:
+            if c not in d.columns:
+                d = d.assign(**{c: np.nan})
+        if "_cod" not in d.columns:
+            d = d.assign(_cod=d["codigo"].astype(str))
+        self.frame = d
+
+        self.cod = d["_cod"].to_numpy(object)
+        self.tms = d["tms"].to_numpy(float)
+        self.tmh = d["tmh_eff"].to_numpy(float)
+        self.g = d["au_gr_ton"].to_numpy(float)
+        self.r = d["rec_pct"].to_numpy(float)
+        self.cn = d["nacn_kg_t"].to_numpy(float)
+        self.oh = d["naoh_kg_t"].to_numpy(float)
+
+        fino = d["au_fino"].to_numpy(float)
+        self.au_fino = np.where(np.isnan(fino), self.g * self.tms, fino)
+
+        self.valid = (
+            d["codigo"].notna().to_numpy()
+            & ~np.isnan(self.g) & ~np.isnan(self.r)
+            & (self.tms > 0) & (self.tmh > 0)
+        )
+        self.has_reag = ~np.isnan(self.cn) & ~np.isnan(self.oh)
+        self.alive = np.ones(len(d), dtype=bool)
+
+    def __len__(self) -> int:
+        return int(self.tms.size)
+
+    def reset(self) -> None:
+        self.alive = np.ones(len(self), dtype=bool)
+
+    def live_idx(self) -> np.ndarray:
+        return np.where(self.alive & self.valid)[0]
+
+    def kill_codes(self, idx: np.ndarray) -> None:
+        # mismo criterio que antes (por _cod): si un código se repite, salen todas sus filas
+        if len(idx):
+            self.alive &= ~np.isin(self.cod, self.cod[idx])
+
+    def subset(self, idx: np.ndarray) -> "LotPool":
+        """Pool liviano (sin frame) con las filas `idx` en ese orden; para mandar a un worker."""
+        idx = np.asarray(idx, dtype=np.int64)
+        out = LotPool.__new__(LotPool)
+        out.frame = None
+        for name in ["cod", "tms", "tmh", "g", "r", "cn", "oh", "au_fino", "valid", "has_reag", "alive"]:
+            setattr(out, name, getattr(self, name)[idx])
+        return out
+
+    def take(self, idx: np.ndarray, pile_type: Optional[str] = None) -> pd.DataFrame:
+        if idx is None or len(idx) == 0:
+            return pd.DataFrame()
+        out = self.frame.iloc[np.asarray(idx, dtype=np.int64)].copy()
+        if pile_type is not None:
+            out["pile_type"] = pile_type
+        return out
+
+
+_EMPTY_IDX = np.zeros(0, dtype=np.int64)
+
+
 # =========================
 # METRICS / HELPERS (SPEED: asume numeric ya limpio)
 # =========================
@@ -488,6 +739,17 @@ def reag_ok(avg_x: float, lo: float, hi: float) -> bool:
     return (avg_x >= lo - 1e-9) and (avg_x <= hi + 1e-9)
 
 
+def grade_ok_vec(avg_g: np.ndarray, gmin: float, gmax: float, gmin_exclusive: bool, gmax_inclusive: bool) -> np.ndarray:
+    # igual que grade_ok (NaN => False porque las comparaciones dan False)
+    lo_ok = (avg_g > gmin + 1e-9) if gmin_exclusive else (avg_g >= gmin - 1e-9)
+    hi_ok = (avg_g <= gmax + 1e-9) if gmax_inclusive else (avg_g < gmax - 1e-9)
+    return lo_ok & hi_ok
+
+
+def reag_ok_vec(avg_x: np.ndarray, lo: float, hi: float) -> np.ndarray:
+    return (avg_x >= lo - 1e-9) & (avg_x <= hi + 1e-9)
+
+
 def dist_to_band_scalar(x: float, lo: float, hi: float) -> float:
     if math.isnan(x):
         return 1e9
@@ -502,8 +764,9 @@ def dist_to_band_scalar(x: float, lo: float, hi: float) -> float:
 # TOP-UP (SPEED: evita concat por iter, acumula indices)
 # =========================
 def top_up_pile(
-    pile: pd.DataFrame,
-    pool: pd.DataFrame,
+    pool: "LotPool",
+    pile_idx: np.ndarray,
+    cand_idx: np.ndarray,
     *,
     rec_min: float,
     tms_max: float,
@@ -515,46 +778,59 @@ def top_up_pile(
     enforce_reagents: bool,
     reag_min: float,
     reag_max: float,
-) -> pd.DataFrame:
-    if pile is None or pile.empty or pool is None or pool.empty:
-        return pile
+) -> np.ndarray:
+    if pile_idx is None or len(pile_idx) == 0 or cand_idx is None or len(cand_idx) == 0:
+        return pile_idx
 
-    cur = pile.copy()
-    used = set(cur.get("_cod", cur["codigo"].astype(str)).tolist())
+    pile_idx = np.asarray(pile_idx, dtype=np.int64)
+    cand = np.asarray(cand_idx, dtype=np.int64)
+    cand = cand[pool.valid[cand]]
+    if cand.size == 0:
+        return pile_idx
 
-    cand = pool.dropna(subset=["codigo", "tms", "au_gr_ton", "rec_pct", "tmh_eff"]).copy()
-    cand = cand[(cand["tms"] > 0) & (cand["tmh_eff"] > 0)].copy()
-    if cand.empty:
-        return cur
-
-    cand["_cod"] = cand.get("_cod", cand["codigo"].astype(str))
-    cand = cand[~cand["_cod"].isin(used)].copy()
-    if cand.empty:
-        return cur
+    cand = cand[~np.isin(pool.cod[cand], pool.cod[pile_idx])]
+    if cand.size == 0:
+        return pile_idx
 
     if enforce_reagents:
-        cand = cand.dropna(subset=["nacn_kg_t", "naoh_kg_t"]).copy()
-        if cand.empty:
-            return cur
+        cand = cand[pool.has_reag[cand]]
+        if cand.size == 0:
+            return pile_idx
 
-    tms = cand["tms"].to_numpy(float)
-    g   = cand["au_gr_ton"].to_numpy(float)
-    r   = cand["rec_pct"].to_numpy(float)
-    cn  = cand["nacn_kg_t"].to_numpy(float)
-    oh  = cand["naoh_kg_t"].to_numpy(float)
-    codes = cand["_cod"].to_numpy(object)
+    tms = pool.tms[cand]
+    g   = pool.g[cand]
+    r   = pool.r[cand]
+    cn  = pool.cn[cand]
+    oh  = pool.oh[cand]
 
     # orden preferente: rec desc, tms desc
     order = np.lexsort((-tms, -r))
 
     # acumulados actuales
-    cur_tms = float(cur["tms"].fillna(0).sum())
-    cur_gtms = float((cur["au_gr_ton"].fillna(0).to_numpy(float) * cur["tms"].fillna(0).to_numpy(float)).sum())
-    cur_rtms = float((cur["rec_pct"].fillna(0).to_numpy(float) * cur["tms"].fillna(0).to_numpy(float)).sum())
-    cur_cntms = float((cur["nacn_kg_t"].fillna(0).to_numpy(float) * cur["tms"].fillna(0).to_numpy(float)).sum())
-    cur_ohtms = float((cur["naoh_kg_t"].fillna(0).to_numpy(float) * cur["tms"].fillna(0).to_numpy(float)).sum())
+    p_tms = np.nan_to_num(pool.tms[pile_idx])
+    cur_tms = float(p_tms.sum())
+    cur_gtms = float((np.nan_to_num(pool.g[pile_idx]) * p_tms).sum())
+    cur_rtms = float((np.nan_to_num(pool.r[pile_idx]) * p_tms).sum())
+    cur_cntms = float((np.nan_to_num(pool.cn[pile_idx]) * p_tms).sum())
+    cur_ohtms = float((np.nan_to_num(pool.oh[pile_idx]) * p_tms).sum())
+
+    # SPEED: se trabaja en el orden preferente y se evalúan todos los vivos por pick en
+    # una pasada numpy. Misma elección que el barrido secuencial: el primero (en orden)
+    # que toca el target (gap <= 1e-6) o, si no hay, el primer mínimo de (gap, -new_tms).
+    tms_o = tms[order]
+    g_o = g[order]
+    r_o = r[order]
+    cn_o = cn[order]
+    oh_o = oh[order]
+
+    alive = (tms_o > 0) & np.isfinite(g_o) & np.isfinite(r_o)
+    if enforce_reagents:
+        alive &= np.isfinite(cn_o) & np.isfinite(oh_o)
+    gtms_o = g_o * tms_o
+    rtms_o = r_o * tms_o
+    cntms_o = cn_o * tms_o
+    ohtms_o = oh_o * tms_o
 
-    alive = np.ones(len(cand), dtype=bool)
     picked_idx = []
 
     max_iters = int(len(cand) + 5)
@@ -565,47 +841,34 @@ def top_up_pile(
         if cur_tms >= min(tms_target, tms_max) - 1e-6:
             break
 
-        best_j = -1
-        best_key = None
-
-        for j in order:
-            if not alive[j]:
-                continue
-            tms_j = tms[j]
-            if tms_j <= 0 or tms_j > cap + 1e-9:
-                continue
-
-            gj = g[j]; rj = r[j]
-            if not math.isfinite(gj) or not math.isfinite(rj):
-                continue
-            if enforce_reagents and (not math.isfinite(cn[j]) or not math.isfinite(oh[j])):
-                continue
-
-            new_tms = cur_tms + tms_j
-            new_g = (cur_gtms + gj * tms_j) / new_tms
-            new_r = (cur_rtms + rj * tms_j) / new_tms
+        live = np.where(alive & (tms_o <= cap + 1e-9))[0]
+        if live.size == 0:
+            break
 
-            if new_r < rec_min - 1e-9:
-                continue
-            if not grade_ok(new_g, gmin, gmax, gmin_exclusive=gmin_exclusive, gmax_inclusive=gmax_inclusive):
-                continue
+        new_tms = cur_tms + tms_o[live]
+        new_g = (cur_gtms + gtms_o[live]) / new_tms
+        new_r = (cur_rtms + rtms_o[live]) / new_tms
 
-            if enforce_reagents:
-                new_cn = (cur_cntms + cn[j] * tms_j) / new_tms
-                new_oh = (cur_ohtms + oh[j] * tms_j) / new_tms
-                if (not reag_ok(new_cn, reag_min, reag_max)) or (not reag_ok(new_oh, reag_min, reag_max)):
-                    continue
+        ok = (new_r >= rec_min - 1e-9) & grade_ok_vec(new_g, gmin, gmax, gmin_exclusive, gmax_inclusive)
+        if enforce_reagents:
+            new_cn = (cur_cntms + cntms_o[live]) / new_tms
+            new_oh = (cur_ohtms + ohtms_o[live]) / new_tms
+            ok &= reag_ok_vec(new_cn, reag_min, reag_max) & reag_ok_vec(new_oh, reag_min, reag_max)
+        if not ok.any():
+            break
 
-            gap = abs(new_tms - tms_target)
-            key = (gap, -new_tms)
-            if best_key is None or key < best_key:
-                best_key = key
-                best_j = j
-                if gap <= 1e-6:
-                    break
+        live = live[ok]
+        new_tms = new_tms[ok]
+        gap = np.abs(new_tms - tms_target)
 
-        if best_j < 0:
-            break
+        hit = np.flatnonzero(gap <= 1e-6)
+        if hit.size:
+            k = int(hit[0])
+        else:
+            # lexsort estable => a igual llave gana el primero en orden
+            k = int(np.lexsort((-new_tms, gap))[0])
+        jo = int(live[k])
+        best_j = int(order[jo])
 
         picked_idx.append(best_j)
 
@@ -615,21 +878,22 @@ def top_up_pile(
         cur_cntms += float((0.0 if not math.isfinite(cn[best_j]) else cn[best_j]) * tms[best_j])
         cur_ohtms += float((0.0 if not math.isfinite(oh[best_j]) else oh[best_j]) * tms[best_j])
 
-        alive[best_j] = False
-        used.add(str(codes[best_j]))
+        alive[jo] = False
 
     if picked_idx:
-        add = cand.iloc[picked_idx].copy()
-        cur = pd.concat([cur, add.drop(columns=["_cod"], errors="ignore")], ignore_index=True)
-
-    return cur
+        return np.concatenate([pile_idx, cand[np.asarray(picked_idx, dtype=np.int64)]])
+    return pile_idx
 
 
 # =========================
 # VARIOS (TRIM) + 2-ETAPAS REC
 # =========================
+_TRIM_BLOCK = 32
+_TRIM_FIRST_BLOCKS = 4
+
 def build_varios_trim(
-    lots: pd.DataFrame,
+    pool: "LotPool",
+    idx: np.ndarray,
     gmin: float,
     gmax: float,
     enforce_reagents: bool,
@@ -639,44 +903,36 @@ def build_varios_trim(
     tms_min: float,
     reag_min: float,
     reag_max: float,
-) -> pd.DataFrame:
-    if lots is None or lots.empty:
-        return pd.DataFrame()
-
-    d = lots.copy()
-    need_cols = ["codigo", "zona", "tmh_eff", "tms", "au_gr_ton", "rec_pct", "au_fino", "nacn_kg_t", "naoh_kg_t", "_cod"]
-    for c in need_cols:
-        if c not in d.columns:
-            d[c] = np.nan
+) -> np.ndarray:
+    if idx is None or len(idx) == 0:
+        return _EMPTY_IDX
 
-    d = d.dropna(subset=["codigo", "tms", "au_gr_ton", "rec_pct", "tmh_eff"]).copy()
-    d = d[(d["tms"] > 0) & (d["tmh_eff"] > 0)].copy()
-    if d.empty:
-        return pd.DataFrame()
+    idx = np.asarray(idx, dtype=np.int64)
+    idx = idx[pool.valid[idx]]
+    if idx.size == 0:
+        return _EMPTY_IDX
 
     if enforce_reagents:
-        d = d.dropna(subset=["nacn_kg_t", "naoh_kg_t"]).copy()
-        if d.empty:
-            return pd.DataFrame()
+        idx = idx[pool.has_reag[idx]]
+        if idx.size == 0:
+            return _EMPTY_IDX
 
-    # arrays (SPEED)
-    tms = d["tms"].to_numpy(float)
-    g = d["au_gr_ton"].to_numpy(float)
-    r = d["rec_pct"].to_numpy(float)
-    cn = d["nacn_kg_t"].to_numpy(float)
-    oh = d["naoh_kg_t"].to_numpy(float)
+    lot_idx = idx
 
-    au_fino = d["au_fino"]
-    if au_fino.isna().any():
-        d["au_fino"] = d["au_fino"].fillna(d["au_gr_ton"] * d["tms"])
-    au_fino_arr = d["au_fino"].fillna(0.0).to_numpy(float)
+    # arrays (SPEED)
+    tms = pool.tms[idx]
+    g = pool.g[idx]
+    r = pool.r[idx]
+    cn = pool.cn[idx]
+    oh = pool.oh[idx]
+    au_fino_arr = pool.au_fino[idx]
 
     gtms = g * tms
     rtms = r * tms
     cntms = cn * tms
     ohtms = oh * tms
 
-    n = len(d)
+    n = lot_idx.size
     keep = np.ones(n, dtype=bool)
 
     def compute_penalty(tms_tot, gtms_tot, rtms_tot, cntms_tot, ohtms_tot) -> float:
@@ -706,48 +962,7 @@ def build_varios_trim(
             + (10.0 * abs(tms_tot - tms_target))
         )
 
-    tms_tot = float(tms.sum())
-    gtms_tot = float(gtms.sum())
-    rtms_tot = float(rtms.sum())
-    cntms_tot = float(cntms.sum())
-    ohtms_tot = float(ohtms.sum())
-
-    cur_pen = compute_penalty(tms_tot, gtms_tot, rtms_tot, cntms_tot, ohtms_tot)
-
-    max_iters = n + 5
-    it = 0
-
-    while it < max_iters:
-        it += 1
-
-        if tms_tot > 0:
-            g_avg = gtms_tot / tms_tot
-            r_avg = rtms_tot / tms_tot
-            ok = (
-                (tms_tot <= tms_max + 1e-9)
-                and (tms_tot >= tms_min - 1e-9)
-                and grade_ok(g_avg, gmin, gmax, gmin_exclusive=False, gmax_inclusive=True)
-                and (r_avg >= rec_min - 1e-9)
-            )
-            if enforce_reagents:
-                cn_avg = cntms_tot / tms_tot
-                oh_avg = ohtms_tot / tms_tot
-                ok = ok and reag_ok(cn_avg, reag_min, reag_max) and reag_ok(oh_avg, reag_min, reag_max)
-
-            if ok:
-                break
-
-        idx = np.where(keep)[0]
-        if idx.size == 0:
-            return pd.DataFrame()
-
-        new_tms = tms_tot - tms[idx]
-        can_remove = (new_tms >= (tms_min - 1e-9)) & (new_tms > 0)
-        if not np.any(can_remove):
-            return pd.DataFrame()
-
-        idx = idx[can_remove]
-
+    def pen_vec(idx: np.ndarray) -> np.ndarray:
         tms2 = tms_tot - tms[idx]
         gtms2 = gtms_tot - gtms[idx]
         rtms2 = rtms_tot - rtms[idx]
@@ -790,20 +1005,140 @@ def build_varios_trim(
             + (2e5 * reag_dist2 if enforce_reagents else 0.0)
             + (10.0 * np.abs(tms2 - tms_target))
         )
+        return pen2
+
+    # SPEED: cotas por bloque. Los lotes se agrupan en bloques de _TRIM_BLOCK (orden por
+    # rec, luego TMS) y cada bloque guarda min/max de sus vivos. pen2 es suma de términos
+    # >= 0 y cada promedio (X - x*t) / (T - t) es monótono en x y en t, así que su rango
+    # en el bloque sale de las 4 esquinas => cota inferior de pen2 por bloque. Solo se
+    # evalúan exacto los bloques cuya cota no supera la mejor penalidad vista (mismo
+    # resultado que evaluar todos).
+    blk_order = np.lexsort((tms, r))
+    n_blk = (n + _TRIM_BLOCK - 1) // _TRIM_BLOCK
+    blk_of = np.empty(n, dtype=np.int64)
+    blk_of[blk_order] = np.arange(n, dtype=np.int64) // _TRIM_BLOCK
+    feats = [tms, g, r] + ([cn, oh] if enforce_reagents else [])
+    blk_lo = np.empty((len(feats), n_blk))
+    blk_hi = np.empty((len(feats), n_blk))
+    blk_alive = np.zeros(n_blk, dtype=np.int64)
+
+    def refresh_block(b: int) -> None:
+        mem = blk_order[b * _TRIM_BLOCK:(b + 1) * _TRIM_BLOCK]
+        mem = mem[keep[mem]]
+        blk_alive[b] = mem.size
+        if mem.size == 0:
+            return
+        for f, x in enumerate(feats):
+            xm = x[mem]
+            blk_lo[f, b] = xm.min()
+            blk_hi[f, b] = xm.max()
+
+    for b in range(n_blk):
+        refresh_block(b)
+
+    def ratio_range(x_tot, f, t_lo, t_hi):
+        x_lo, x_hi = blk_lo[f], blk_hi[f]
+        c = [
+            (x_tot - x_lo * t_lo) / (tms_tot - t_lo),
+            (x_tot - x_lo * t_hi) / (tms_tot - t_hi),
+            (x_tot - x_hi * t_lo) / (tms_tot - t_lo),
+            (x_tot - x_hi * t_hi) / (tms_tot - t_hi),
+        ]
+        return np.minimum(np.minimum(c[0], c[1]), np.minimum(c[2], c[3])), np.maximum(np.maximum(c[0], c[1]), np.maximum(c[2], c[3]))
+
+    def band_gap(v_lo, v_hi, lo, hi):
+        return np.maximum(0.0, np.maximum(lo - v_hi, v_lo - hi))
+
+    def block_bounds() -> np.ndarray:
+        t_lo = blk_lo[0]
+        # solo cuentan lotes removibles: new_tms >= tms_min - 1e-9 y new_tms > 0
+        t_cap = tms_tot - max(tms_min - 1e-9, 0.0)
+        t_hi = np.minimum(blk_hi[0], t_cap)
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            lb = 1e12 * np.maximum(0.0, tms_min - (tms_tot - t_lo))
+            lb = lb + 1e6 * np.maximum(0.0, tms_tot - t_hi - tms_max)
+            lb = lb + 10.0 * band_gap(tms_tot - t_hi, tms_tot - t_lo, tms_target, tms_target)
+            g_lo, g_hi = ratio_range(gtms_tot, 1, t_lo, t_hi)
+            lb = lb + 5e5 * band_gap(g_lo, g_hi, gmin, gmax)
+            r_lo, r_hi = ratio_range(rtms_tot, 2, t_lo, t_hi)
+            lb = lb + 5e5 * np.maximum(0.0, rec_min - r_hi)
+            if enforce_reagents:
+                cn_lo, cn_hi = ratio_range(cntms_tot, 3, t_lo, t_hi)
+                oh_lo, oh_hi = ratio_range(ohtms_tot, 4, t_lo, t_hi)
+                lb = lb + 2e5 * (band_gap(cn_lo, cn_hi, reag_min, reag_max) + band_gap(oh_lo, oh_hi, reag_min, reag_max))
+        lb = np.where(np.isfinite(lb), lb, -np.inf)
+        lb[(blk_alive == 0) | (t_hi < t_lo)] = np.inf
+        return lb
+
+    def block_members(blks: np.ndarray) -> np.ndarray:
+        if blks.size == 0:
+            return _EMPTY_IDX
+        pos = (blks[:, None] * _TRIM_BLOCK + np.arange(_TRIM_BLOCK)[None, :]).ravel()
+        mem = blk_order[pos[pos < n]]
+        mem = mem[keep[mem]]
+        new_tms = tms_tot - tms[mem]
+        return mem[(new_tms >= (tms_min - 1e-9)) & (new_tms > 0)]
+
+    tms_tot = float(tms.sum())
+    gtms_tot = float(gtms.sum())
+    rtms_tot = float(rtms.sum())
+    cntms_tot = float(cntms.sum())
+    ohtms_tot = float(ohtms.sum())
+
+    cur_pen = compute_penalty(tms_tot, gtms_tot, rtms_tot, cntms_tot, ohtms_tot)
+
+    max_iters = n + 5
+    it = 0
+
+    while it < max_iters:
+        it += 1
+
+        if tms_tot > 0:
+            g_avg = gtms_tot / tms_tot
+            r_avg = rtms_tot / tms_tot
+            ok = (
+                (tms_tot <= tms_max + 1e-9)
+                and (tms_tot >= tms_min - 1e-9)
+                and grade_ok(g_avg, gmin, gmax, gmin_exclusive=False, gmax_inclusive=True)
+                and (r_avg >= rec_min - 1e-9)
+            )
+            if enforce_reagents:
+                cn_avg = cntms_tot / tms_tot
+                oh_avg = ohtms_tot / tms_tot
+                ok = ok and reag_ok(cn_avg, reag_min, reag_max) and reag_ok(oh_avg, reag_min, reag_max)
+
+            if ok:
+                break
+
+        lb = block_bounds()
+        blk_rank = np.argsort(lb, kind="stable")
+        first = blk_rank[:_TRIM_FIRST_BLOCKS]
+        idx = block_members(first[lb[first] < np.inf])
+        pen2 = pen_vec(idx)
+        best = float(pen2.min()) if idx.size else np.inf
+        rest = blk_rank[_TRIM_FIRST_BLOCKS:]
+        rest = block_members(rest[lb[rest] <= best + 1e-9 * abs(best) + 1e-6])
+        if rest.size:
+            idx = np.concatenate([idx, rest])
+            pen2 = np.concatenate([pen2, pen_vec(rest)])
+        if idx.size == 0:
+            return _EMPTY_IDX
 
         fine_loss = au_fino_arr[idx]
         tms_loss = tms[idx]
 
-        ord_idx = np.lexsort((fine_loss, tms_loss, pen2))
+        # mismo desempate que antes (orden de lote como última llave)
+        ord_idx = np.lexsort((idx, fine_loss, tms_loss, pen2))
         j = int(idx[int(ord_idx[0])])
 
         new_pen = float(pen2[int(ord_idx[0])])
 
         need_cut = tms_tot > tms_max + 1e-9
         if (not need_cut) and (new_pen >= cur_pen - 1e-6):
-            return pd.DataFrame()
+            return _EMPTY_IDX
 
         keep[j] = False
+        refresh_block(int(blk_of[j]))
         tms_tot -= float(tms[j])
         gtms_tot -= float(gtms[j])
         rtms_tot -= float(rtms[j])
@@ -812,33 +1147,22 @@ def build_varios_trim(
 
         cur_pen = new_pen
 
-    out = d.loc[keep].copy()
-    if out.empty:
-        return pd.DataFrame()
-
-    out["pile_type"] = "varios"
+    out = lot_idx[keep]
+    if out.size == 0:
+        return _EMPTY_IDX
     return out
 
 
-def build_varios(lots: pd.DataFrame, params: Dict[str, Any]) -> pd.DataFrame:
-    if lots is None or lots.empty:
-        return pd.DataFrame()
+def build_varios(pool: "LotPool", idx: np.ndarray, params: Dict[str, Any], stats: Optional[Dict[str, Any]] = None) -> np.ndarray:
+    if idx is None or len(idx) == 0:
+        return _EMPTY_IDX
 
     pile_rec_min = float(params["pile_rec_min"])
 
-    eligible = lots.copy()
-    m = (
-        eligible["codigo"].notna()
-        & eligible["tms"].notna()
-        & eligible["au_gr_ton"].notna()
-        & eligible["rec_pct"].notna()
-        & eligible["tmh_eff"].notna()
-        & (eligible["tms"] > 0)
-        & (eligible["tmh_eff"] > 0)
-    )
-    eligible = eligible[m].copy()
-    if eligible.empty:
-        return pd.DataFrame()
+    eligible = np.asarray(idx, dtype=np.int64)
+    eligible = eligible[pool.valid[eligible]]
+    if eligible.size == 0:
+        return _EMPTY_IDX
 
     g_tries = params.get("var_g_tries", DEFAULT_PARAMS["var_g_tries"])
     tms_max = float(params["var_tms_max"])
@@ -847,12 +1171,16 @@ def build_varios(lots: pd.DataFrame, params: Dict[str, Any]) -> pd.DataFrame:
     reag_min = float(params["reag_min"])
     reag_max = float(params["reag_max"])
 
-    def _try(eligible_in: pd.DataFrame, enforce_reagents: bool) -> Tuple[pd.DataFrame, Optional[float], Optional[float], bool]:
-        if eligible_in is None or eligible_in.empty:
-            return pd.DataFrame(), None, None, enforce_reagents
+    def _try(eligible_in: np.ndarray, enforce_reagents: bool) -> Tuple[np.ndarray, Optional[float], Optional[float], bool]:
+        if eligible_in is None or eligible_in.size == 0:
+            return _EMPTY_IDX, None, None, enforce_reagents
         for (gmin, gmax) in g_tries:
+            if _past_deadline(params.get("deadline")):
+                _note_deadline_stop(stats)
+                break
             p = build_varios_trim(
-                lots=eligible_in,
+                pool,
+                eligible_in,
                 gmin=float(gmin),
                 gmax=float(gmax),
                 enforce_reagents=enforce_reagents,
@@ -863,182 +1191,208 @@ def build_varios(lots: pd.DataFrame, params: Dict[str, Any]) -> pd.DataFrame:
                 reag_min=reag_min,
                 reag_max=reag_max,
             )
-            if p is not None and not p.empty:
+            if p.size:
                 return p, float(gmin), float(gmax), enforce_reagents
-        return pd.DataFrame(), None, None, enforce_reagents
+        return _EMPTY_IDX, None, None, enforce_reagents
 
+    r_el = pool.r[eligible]
     pref_rec = max(float(DEFAULT_PARAMS["pile_rec_min"]), float(pile_rec_min))
-    eligible_pref = eligible[eligible["rec_pct"] >= pref_rec].copy()
-
-    p, gmin_used, gmax_used, enf_used = _try(eligible_pref, enforce_reagents=True)
-    if not p.empty:
-        pool_poor = eligible[(eligible["rec_pct"] >= pile_rec_min) & (eligible["rec_pct"] < pref_rec)].copy()
-        p = top_up_pile(
-            p, pool_poor,
-            rec_min=pile_rec_min,
-            tms_max=tms_max,
-            tms_target=tms_target,
-            gmin=float(gmin_used),
-            gmax=float(gmax_used),
-            gmin_exclusive=False,
-            gmax_inclusive=True,
-            enforce_reagents=bool(enf_used),
-            reag_min=reag_min,
-            reag_max=reag_max,
-        )
-        return p
-
-    p, gmin_used, gmax_used, enf_used = _try(eligible_pref, enforce_reagents=False)
-    if not p.empty:
-        pool_poor = eligible[(eligible["rec_pct"] >= pile_rec_min) & (eligible["rec_pct"] < pref_rec)].copy()
-        p = top_up_pile(
-            p, pool_poor,
-            rec_min=pile_rec_min,
-            tms_max=tms_max,
-            tms_target=tms_target,
-            gmin=float(gmin_used),
-            gmax=float(gmax_used),
-            gmin_exclusive=False,
-            gmax_inclusive=True,
-            enforce_reagents=bool(enf_used),
-            reag_min=reag_min,
-            reag_max=reag_max,
-        )
-        return p
-
-    eligible_hi = eligible[eligible["rec_pct"] >= pile_rec_min].copy()
-    p, _, _, _ = _try(eligible_hi, enforce_reagents=True)
-    if not p.empty:
-        return p
-    p, _, _, _ = _try(eligible_hi, enforce_reagents=False)
-    if not p.empty:
-        return p
+    eligible_pref = eligible[r_el >= pref_rec]
+    pool_poor = eligible[(r_el >= pile_rec_min) & (r_el < pref_rec)]
+
+    for enforce in (True, False):
+        p, gmin_used, gmax_used, enf_used = _try(eligible_pref, enforce_reagents=enforce)
+        if p.size:
+            return top_up_pile(
+                pool, p, pool_poor,
+                rec_min=pile_rec_min,
+                tms_max=tms_max,
+                tms_target=tms_target,
+                gmin=float(gmin_used),
+                gmax=float(gmax_used),
+                gmin_exclusive=False,
+                gmax_inclusive=True,
+                enforce_reagents=bool(enf_used),
+                reag_min=reag_min,
+                reag_max=reag_max,
+            )
 
-    p, _, _, _ = _try(eligible, enforce_reagents=True)
-    if not p.empty:
-        return p
-    p, _, _, _ = _try(eligible, enforce_reagents=False)
-    if not p.empty:
-        return p
+    eligible_hi = eligible[r_el >= pile_rec_min]
+    for cand in (eligible_hi, eligible):
+        for enforce in (True, False):
+            p, _, _, _ = _try(cand, enforce_reagents=enforce)
+            if p.size:
+                return p
 
-    return pd.DataFrame()
+    return _EMPTY_IDX
 
 
 # =========================
 # SOLVER (BATCH) (SPEED: métricas internas por arrays, orden sin sort_values)
 # =========================
-def solve_one_pile(
-    lots: pd.DataFrame,
-    pile_type: str,
-    tms_max: float,
-    tms_target: float,
-    tms_min: float,
-    gmin: float,
-    gmax: float,
-    gmin_exclusive: bool,
-    gmax_inclusive: bool,
-    rec_min: float,
-    enforce_reagents: bool,
-    reag_min: float,
-    reag_max: float,
-    n_iters: int,
-    max_steps: int,
-    cand_sample: int,
-    reseeds_per_iter: int,
-    seed: int,
-    pair_topk: int,
-    pair_pool: int,
-) -> pd.DataFrame:
-    if lots is None or lots.empty:
-        return pd.DataFrame()
+def grade_pen_vec(new_g: np.ndarray, gmin: float, gmax: float, gmin_exclusive: bool, gmax_inclusive: bool) -> np.ndarray:
+    pen = np.zeros_like(new_g, dtype=float)
+    nanmask = np.isnan(new_g)
+    if nanmask.any():
+        pen[nanmask] = 1e6
 
-    d = lots.copy()
-    d = d.dropna(subset=["codigo", "tms", "au_gr_ton", "rec_pct", "tmh_eff"]).copy()
-    d = d[(d["tms"] > 0) & (d["tmh_eff"] > 0)].copy()
-    if d.empty:
-        return pd.DataFrame()
+    if gmin_exclusive:
+        m = (~nanmask) & (new_g <= gmin + 1e-9)
+        pen[m] = (gmin - new_g[m]) + 1e-6
+    else:
+        m = (~nanmask) & (new_g < gmin - 1e-9)
+        pen[m] = (gmin - new_g[m])
 
-    if enforce_reagents:
-        d = d.dropna(subset=["nacn_kg_t", "naoh_kg_t"]).copy()
-        if d.empty:
-            return pd.DataFrame()
+    if gmax_inclusive:
+        m = (~nanmask) & (new_g > gmax + 1e-9)
+        pen[m] = np.maximum(pen[m], (new_g[m] - gmax))
+    else:
+        m = (~nanmask) & (new_g >= gmax - 1e-9)
+        pen[m] = np.maximum(pen[m], (new_g[m] - gmax) + 1e-6)
 
-    # arrays base
-    tms_arr = d["tms"].to_numpy(float)
-    g_arr   = d["au_gr_ton"].to_numpy(float)
-    r_arr   = d["rec_pct"].to_numpy(float)
-    cn_arr  = d["nacn_kg_t"].to_numpy(float)
-    oh_arr  = d["naoh_kg_t"].to_numpy(float)
-    tmh_arr = d["tmh_eff"].to_numpy(float)
+    return pen
 
-    gtms  = g_arr  * tms_arr
-    rtms  = r_arr  * tms_arr
-    cntms = cn_arr * tms_arr
-    ohtms = oh_arr * tms_arr
 
-    bad_reag = np.isnan(cn_arr) | np.isnan(oh_arr)
+def dist_to_band_vec(x: np.ndarray, lo: float, hi: float) -> np.ndarray:
+    out = np.zeros_like(x, dtype=float)
+    nanmask = np.isnan(x)
+    if nanmask.any():
+        out[nanmask] = 1e9
+    lo_mask = (~nanmask) & (x < lo)
+    hi_mask = (~nanmask) & (x > hi)
+    out[lo_mask] = (lo - x[lo_mask])
+    out[hi_mask] = (x[hi_mask] - hi)
+    return out
 
-    is_lowrec = (r_arr < rec_min).astype(np.int8)
-    order0 = np.lexsort((-tms_arr, -r_arr, is_lowrec))
-    base = d.iloc[order0].reset_index(drop=True)
 
-    # reorder arrays to base order
-    tms_arr = tms_arr[order0]
-    g_arr   = g_arr[order0]
-    r_arr   = r_arr[order0]
-    cn_arr  = cn_arr[order0]
-    oh_arr  = oh_arr[order0]
-    tmh_arr = tmh_arr[order0]
-    gtms    = gtms[order0]
-    rtms    = rtms[order0]
-    cntms   = cntms[order0]
-    ohtms   = ohtms[order0]
-    bad_reag = bad_reag[order0]
+LAW_BONUS = 8.0
+FINE_BONUS = 0.002
 
-    n = len(base)
-    idx_all = np.arange(n)
-    rng = np.random.default_rng(seed)
 
-    best_picked = None
-    best_key = None
+# las keys se comparan exacto: se cuantizan para que el ruido de sumas float (orden de suma
+# distinto en greedy / exacto) no decida entre pilas iguales (gap 1e-14 vs 0)
+KEY_QUANTUM_DIGITS = 6
 
-    def grade_pen_vec(new_g: np.ndarray) -> np.ndarray:
-        pen = np.zeros_like(new_g, dtype=float)
-        nanmask = np.isnan(new_g)
-        if nanmask.any():
-            pen[nanmask] = 1e6
 
-        if gmin_exclusive:
-            m = (~nanmask) & (new_g <= gmin + 1e-9)
-            pen[m] = (gmin - new_g[m]) + 1e-6
-        else:
-            m = (~nanmask) & (new_g < gmin - 1e-9)
-            pen[m] = (gmin - new_g[m])
+def _q(x: float) -> float:
+    return round(float(x), KEY_QUANTUM_DIGITS) + 0.0
 
-        if gmax_inclusive:
-            m = (~nanmask) & (new_g > gmax + 1e-9)
-            pen[m] = np.maximum(pen[m], (new_g[m] - gmax))
-        else:
-            m = (~nanmask) & (new_g >= gmax - 1e-9)
-            pen[m] = np.maximum(pen[m], (new_g[m] - gmax) + 1e-6)
-
-        return pen
-
-    def dist_to_band_vec(x: np.ndarray, lo: float, hi: float) -> np.ndarray:
-        out = np.zeros_like(x, dtype=float)
-        nanmask = np.isnan(x)
-        if nanmask.any():
-            out[nanmask] = 1e9
-        lo_mask = (~nanmask) & (x < lo)
-        hi_mask = (~nanmask) & (x > hi)
-        out[lo_mask] = (lo - x[lo_mask])
-        out[hi_mask] = (x[hi_mask] - hi)
-        return out
 
-    LAW_BONUS = 8.0
-    FINE_BONUS = 0.002
+def _rank_key(cfg: Dict[str, Any], tms_sum: float, au_fino: float, rtms_sum: float) -> tuple:
+    """
+    Key (menor = mejor) de una pila factible; la usan _pile_key y el motor exacto.
+    Los promedios salen de las sumas ya cuantizadas (misma pila => misma key en los 2 motores).
+    """
+    t = _q(tms_sum) or float(tms_sum)
+    f = _q(au_fino)
+    under = _q(max(0.0, cfg["tms_min"] - tms_sum))
+    gap = _q(abs(tms_sum - cfg["tms_target"]))
+    return (under, gap, -f, -(f / t), -t, -(_q(rtms_sum) / t))
+
+
+def _pile_key(arr: Dict[str, np.ndarray], cfg: Dict[str, Any], picked: List[int]) -> Optional[tuple]:
+    """Key de una pila (posiciones en orden base); None si no cumple tms_max / ley / rec / reactivos."""
+    tms_max = cfg["tms_max"]
+    rec_min = cfg["rec_min"]
+    gtms = arr["gtms"]
+
+    # métricas rápidas (SPEED: sin DataFrame conversions)
+    picked_np = np.array(picked, dtype=int)
+    tms_sum = float(arr["tms"][picked_np].sum())
+    if tms_sum <= 0 or tms_sum > tms_max + 1e-9:
+        return None
+
+    au_fino_sum = float(gtms[picked_np].sum())
+    rtms_sum = float(arr["rtms"][picked_np].sum())
+    g_avg = au_fino_sum / tms_sum
+    r_avg = rtms_sum / tms_sum
+    if r_avg < rec_min - 1e-9:
+        return None
+    if not grade_ok(g_avg, cfg["gmin"], cfg["gmax"], cfg["gmin_exclusive"], cfg["gmax_inclusive"]):
+        return None
+
+    if cfg["enforce_reagents"]:
+        cn_avg = float(arr["cntms"][picked_np].sum() / tms_sum)
+        oh_avg = float(arr["ohtms"][picked_np].sum() / tms_sum)
+        if (not reag_ok(cn_avg, cfg["reag_min"], cfg["reag_max"])) or (not reag_ok(oh_avg, cfg["reag_min"], cfg["reag_max"])):
+            return None
+
+    return _rank_key(cfg, tms_sum, au_fino_sum, rtms_sum)
+
+
+def _restarts_chunk(arr: Dict[str, np.ndarray], cfg: Dict[str, Any], n_iters: int, seed: Any) -> Tuple[Optional[tuple], Optional[List[int]], int, bool]:
+    """
+    Corre hasta `n_iters` construcciones greedy aleatorias sobre los arrays (ya en orden base)
+    y retorna (best_key, best_picked, restarts_usados, cortado_por_deadline). Es module-level
+    para poder mandarlo a un worker.
+    Con cfg["warm"] (posiciones de la pila anterior) el primer restart arranca con esos lotes
+    ya puestos y el greedy solo completa lo que falta (reparación).
+    """
+    tms_arr = arr["tms"]
+    r_arr = arr["r"]
+    gtms = arr["gtms"]
+    rtms = arr["rtms"]
+    cntms = arr["cntms"]
+    ohtms = arr["ohtms"]
+    tmh_arr = arr["tmh"]
+    bad_reag = arr["bad_reag"]
+    lowrec_f = arr["lowrec_f"]
+
+    tms_max = cfg["tms_max"]
+    tms_target = cfg["tms_target"]
+    tms_min = cfg["tms_min"]
+    gmin = cfg["gmin"]
+    gmax = cfg["gmax"]
+    gmin_exclusive = cfg["gmin_exclusive"]
+    gmax_inclusive = cfg["gmax_inclusive"]
+    rec_min = cfg["rec_min"]
+    enforce_reagents = cfg["enforce_reagents"]
+    reag_min = cfg["reag_min"]
+    reag_max = cfg["reag_max"]
+    max_steps = cfg["max_steps"]
+    cand_sample = cfg["cand_sample"]
+    pair_topk = cfg["pair_topk"]
+    pair_pool = cfg["pair_pool"]
+
+    n = len(tms_arr)
+    rng = np.random.default_rng(seed)
+
+    # índice de candidatos ordenado por TMS (SPEED: evita escanear permutaciones de n lotes por paso).
+    # Con `cap` chico solo el prefijo tms <= cap es factible; `used_pos` marca los muertos del prefijo.
+    valid = tms_arr > 0
+    if enforce_reagents:
+        valid &= ~bad_reag
+    by_tms = np.where(valid)[0]
+    by_tms = by_tms[np.argsort(tms_arr[by_tms], kind="stable")]
+    tms_sorted = tms_arr[by_tms]
+    pos_of = np.full(n, -1, dtype=np.int64)
+    pos_of[by_tms] = np.arange(by_tms.size)
+
+    best_picked = None
+    best_key = None
+
+    patience = int(cfg.get("patience", 0))
+    stop_gap = float(cfg.get("stop_gap", -1.0))
+    deadline = cfg.get("deadline")
+    warm = cfg.get("warm") or []
+    n_done = 0
+    since_best = 0
+    timed_out = False
 
     for _ in range(int(n_iters)):
+        # convergencia: sin mejora en `patience` restarts, o key ya "óptima suficiente"
+        if patience > 0 and since_best >= patience:
+            break
+        if best_key is not None and stop_gap >= 0 and best_key[0] <= 0 and best_key[1] <= stop_gap + 1e-6:
+            break
+        if _job_cancelled():
+            break
+        if _past_deadline(deadline):
+            timed_out = True
+            break
+        n_done += 1
+        since_best += 1
+
         used = np.zeros(n, dtype=bool)
         picked: list[int] = []
 
@@ -1049,41 +1403,45 @@ def solve_one_pile(
         cur_ohtms = 0.0
         cur_tmh = 0.0
 
-        order = rng.permutation(idx_all)
-        ptr = 0
-        reseeds_left = int(reseeds_per_iter)
+        used_pos: List[int] = []
+
+        if n_done == 1:
+            for j in warm:
+                if pos_of[j] < 0 or cur_tms + tms_arr[j] > tms_max + 1e-9:
+                    continue
+                used[j] = True
+                used_pos.append(int(pos_of[j]))
+                picked.append(j)
+                cur_tms += tms_arr[j]
+                cur_gtms += gtms[j]
+                cur_rtms += rtms[j]
+                cur_cntms += cntms[j]
+                cur_ohtms += ohtms[j]
+                cur_tmh += tmh_arr[j]
 
         for _step in range(int(max_steps)):
-            if cur_tms >= tms_max - 1e-9:
+            if cur_tms >= tms_max - 1e-9 or (picked and cur_tms >= min(tms_target, tms_max) - 1e-9):
                 break
 
             cap = tms_max - cur_tms
             need = max(0.0, min(tms_target, tms_max) - cur_tms)
 
-            cand = []
-            while ptr < n and len(cand) < int(cand_sample):
-                j = int(order[ptr]); ptr += 1
-                if used[j]:
-                    continue
-                if tms_arr[j] <= 0 or tms_arr[j] > cap + 1e-9:
-                    continue
-                cand.append(j)
-
-            if not cand:
-                if reseeds_left > 0:
-                    order = rng.permutation(idx_all)
-                    ptr = 0
-                    reseeds_left -= 1
-                    continue
+            # candidatos: muestra aleatoria de lotes vivos con tms <= cap (prefijo del índice)
+            hi = int(np.searchsorted(tms_sorted, cap + 1e-9, side="right"))
+            n_dead = sum(1 for q in used_pos if q < hi)
+            n_alive = hi - n_dead
+            if n_alive <= 0:
                 break
+            k_want = min(int(cand_sample), n_alive)
 
-            cand_np = np.array(cand, dtype=int)
-
-            if enforce_reagents:
-                # ya filtramos dropna, pero por seguridad
-                cand_np = cand_np[~bad_reag[cand_np]]
-                if cand_np.size == 0:
-                    continue
+            if hi <= 4 * (k_want + n_dead):
+                pref = by_tms[:hi]
+                pref = pref[~used[pref]]
+                cand_np = pref[rng.permutation(pref.size)[:k_want]]
+            else:
+                # sobre-muestrea n_dead posiciones: quedan >= k_want vivas sin reintentos
+                cj = by_tms[rng.choice(hi, size=k_want + n_dead, replace=False)]
+                cand_np = cj[~used[cj]][:k_want]
 
             add_tms = tms_arr[cand_np]
             new_tms = cur_tms + add_tms
@@ -1096,7 +1454,7 @@ def solve_one_pile(
 
             fill = np.minimum(add_tms, need)
 
-            g_pen = grade_pen_vec(new_g)
+            g_pen = grade_pen_vec(new_g, gmin, gmax, gmin_exclusive, gmax_inclusive)
             rec_pen = np.maximum(0.0, rec_min - new_r)
 
             cn_dist = dist_to_band_vec(new_cn, reag_min, reag_max)
@@ -1135,77 +1493,64 @@ def solve_one_pile(
                 topk_cands = cand_np[topk_idx]
                 partner_pool = cand_np[:pool]
 
-                for j in topk_cands:
-                    tj = tms_arr[j]
-                    for kk in partner_pool:
-                        if kk == j:
-                            continue
-                        if tj + tms_arr[kk] > cap + 1e-9:
-                            continue
-                        if enforce_reagents and (bad_reag[j] or bad_reag[kk]):
-                            continue
-
-                        add_tms2 = tj + tms_arr[kk]
-                        if add_tms2 <= 0:
-                            continue
-
-                        new_tms2 = cur_tms + add_tms2
-                        new_g2  = (cur_gtms + gtms[j] + gtms[kk]) / new_tms2
-                        new_r2  = (cur_rtms + rtms[j] + rtms[kk]) / new_tms2
-                        new_cn2 = (cur_cntms + cntms[j] + cntms[kk]) / new_tms2
-                        new_oh2 = (cur_ohtms + ohtms[j] + ohtms[kk]) / new_tms2
-
-                        fill2 = min(add_tms2, need)
-
-                        g_pen2 = 0.0
-                        if math.isnan(new_g2):
-                            g_pen2 = 1e6
-                        else:
-                            if gmin_exclusive:
-                                if new_g2 <= gmin + 1e-9:
-                                    g_pen2 = (gmin - new_g2) + 1e-6
-                            else:
-                                if new_g2 < gmin - 1e-9:
-                                    g_pen2 = (gmin - new_g2)
-                            if gmax_inclusive:
-                                if new_g2 > gmax + 1e-9:
-                                    g_pen2 = max(g_pen2, (new_g2 - gmax))
-                            else:
-                                if new_g2 >= gmax - 1e-9:
-                                    g_pen2 = max(g_pen2, (new_g2 - gmax) + 1e-6)
-
-                        rec_pen2 = max(0.0, rec_min - new_r2)
-
-                        cn_dist2 = dist_to_band_scalar(new_cn2, reag_min, reag_max)
-                        oh_dist2 = dist_to_band_scalar(new_oh2, reag_min, reag_max)
-                        lowrec2 = (1.0 if r_arr[j] < rec_min else 0.0) + (1.0 if r_arr[kk] < rec_min else 0.0)
-
-                        if enforce_reagents:
-                            if (not reag_ok(new_cn2, reag_min, reag_max)) or (not reag_ok(new_oh2, reag_min, reag_max)):
-                                continue
-                            reag_pen2 = 120.0 * (cn_dist2 + oh_dist2)
-                        else:
-                            reag_pen2 = 18.0 * (cn_dist2 + oh_dist2)
-
-                        fine_add2 = gtms[j] + gtms[kk]
-
-                        sc = (
-                            18.0 * fill2
-                            - 250.0 * g_pen2
-                            - 90.0  * rec_pen2
-                            - 25.0  * lowrec2
-                            - reag_pen2
-                            + 0.15 * add_tms2
-                            + LAW_BONUS * new_g2
-                            + FINE_BONUS * fine_add2
-                        )
-
-                        if sc > best_score:
-                            best_score = sc
-                            best_choice = (int(j), int(kk))
+                # SPEED: todas las parejas (j, kk) del paso en un solo broadcast 2-D
+                # (filas = topk_cands, columnas = partner_pool; mismo scoring que el loop escalar)
+                jj = topk_cands[:, None]
+                kk = partner_pool[None, :]
+
+                add_tms2 = tms_arr[jj] + tms_arr[kk]
+                valid = (jj != kk) & (add_tms2 <= cap + 1e-9) & (add_tms2 > 0)
+                if enforce_reagents:
+                    valid &= ~(bad_reag[jj] | bad_reag[kk])
+
+                new_tms2 = cur_tms + add_tms2
+                new_g2  = (cur_gtms + gtms[jj] + gtms[kk]) / new_tms2
+                new_r2  = (cur_rtms + rtms[jj] + rtms[kk]) / new_tms2
+                new_cn2 = (cur_cntms + cntms[jj] + cntms[kk]) / new_tms2
+                new_oh2 = (cur_ohtms + ohtms[jj] + ohtms[kk]) / new_tms2
+
+                fill2 = np.minimum(add_tms2, need)
+
+                g_pen2 = grade_pen_vec(new_g2, gmin, gmax, gmin_exclusive, gmax_inclusive)
+                rec_pen2 = np.maximum(0.0, rec_min - new_r2)
+
+                cn_dist2 = dist_to_band_vec(new_cn2, reag_min, reag_max)
+                oh_dist2 = dist_to_band_vec(new_oh2, reag_min, reag_max)
+                lowrec2 = lowrec_f[jj] + lowrec_f[kk]
+
+                if enforce_reagents:
+                    valid &= (
+                        (new_cn2 >= reag_min - 1e-9) & (new_cn2 <= reag_max + 1e-9)
+                        & (new_oh2 >= reag_min - 1e-9) & (new_oh2 <= reag_max + 1e-9)
+                    )
+                    reag_pen2 = 120.0 * (cn_dist2 + oh_dist2)
+                else:
+                    reag_pen2 = 18.0 * (cn_dist2 + oh_dist2)
+
+                fine_add2 = gtms[jj] + gtms[kk]
+
+                sc = (
+                    18.0 * fill2
+                    - 250.0 * g_pen2
+                    - 90.0  * rec_pen2
+                    - 25.0  * lowrec2
+                    - reag_pen2
+                    + 0.15 * add_tms2
+                    + LAW_BONUS * new_g2
+                    + FINE_BONUS * fine_add2
+                )
+                sc[~valid | np.isnan(sc)] = -np.inf
+
+                # argmax = primer máximo en orden fila-mayor (mismo desempate que el loop con '>')
+                flat = int(np.argmax(sc))
+                a, b = divmod(flat, sc.shape[1])
+                if sc[a, b] > best_score:
+                    best_score = float(sc[a, b])
+                    best_choice = (int(topk_cands[a]), int(partner_pool[b]))
 
             for j in best_choice:
                 used[j] = True
+                used_pos.append(int(pos_of[j]))
                 picked.append(j)
                 cur_tms += tms_arr[j]
                 cur_gtms += gtms[j]
@@ -1220,189 +1565,496 @@ def solve_one_pile(
         if not picked:
             continue
 
-        # métricas rápidas (SPEED: sin DataFrame conversions)
-        picked_np = np.array(picked, dtype=int)
-        tms_sum = float(tms_arr[picked_np].sum())
-        if tms_sum <= 0 or tms_sum > tms_max + 1e-9:
+        key = _pile_key(arr, cfg, picked)
+        if key is None:
             continue
+        if best_key is None or key < best_key:
+            best_key = key
+            best_picked = picked
+            since_best = 0
+
+    return best_key, best_picked, n_done, timed_out
+
+
+# =========================
+# MOTOR EXACTO (branch-and-bound para pilas chicas)
+# =========================
+def _exact_pile(arr: Dict[str, np.ndarray], cfg: Dict[str, Any], max_nodes: int) -> Tuple[Optional[tuple], Optional[List[int]], int, bool, bool]:
+    """
+    Branch-and-bound sobre subconjuntos de lotes (mismas restricciones y misma key que
+    _restarts_chunk). Las restricciones de promedio ponderado son lineales en la selección:
+    avg(x) >= lo  <=>  sum(t_i * (x_i - lo)) >= 0, así que se podan con sumas de aportes positivos.
+    Retorna (best_key, best_picked, nodos, completo, cortado_por_deadline); completo=False si se
+    cortó por max_nodes o por cfg["deadline"].
+    """
+    tms_max = cfg["tms_max"]
+    tms_target = cfg["tms_target"]
+    tms_min = cfg["tms_min"]
+    gmin = cfg["gmin"]
+    gmax = cfg["gmax"]
+    gmin_exclusive = cfg["gmin_exclusive"]
+    gmax_inclusive = cfg["gmax_inclusive"]
+    rec_min = cfg["rec_min"]
+    enforce_reagents = cfg["enforce_reagents"]
+    reag_min = cfg["reag_min"]
+    reag_max = cfg["reag_max"]
+
+    ok_idx = np.where(arr["tms"] <= tms_max + 1e-9)[0]
+    if enforce_reagents:
+        ok_idx = ok_idx[~arr["bad_reag"][ok_idx]]
+    if ok_idx.size == 0:
+        return None, None, 0, True, False
+
+    # tms desc: llena capacidad rápido y hace efectivas las cotas de gap
+    ok_idx = ok_idx[np.argsort(-arr["tms"][ok_idx], kind="stable")]
+    m = int(ok_idx.size)
+
+    t = arr["tms"][ok_idx].tolist()
+    gt = arr["gtms"][ok_idx].tolist()
+    rt = arr["rtms"][ok_idx].tolist()
+    cnt = arr["cntms"][ok_idx].tolist()
+    oht = arr["ohtms"][ok_idx].tolist()
+    g = (arr["gtms"][ok_idx] / arr["tms"][ok_idx]).tolist()
+
+    # aportes lineales por restricción (>= 0 en la pila final)
+    cons = [arr["rtms"][ok_idx] - rec_min * arr["tms"][ok_idx],
+            arr["gtms"][ok_idx] - gmin * arr["tms"][ok_idx]]
+    if gmax < 1e8:
+        cons.append(gmax * arr["tms"][ok_idx] - arr["gtms"][ok_idx])
+    if enforce_reagents:
+        cons += [arr["cntms"][ok_idx] - reag_min * arr["tms"][ok_idx],
+                 reag_max * arr["tms"][ok_idx] - arr["cntms"][ok_idx],
+                 arr["ohtms"][ok_idx] - reag_min * arr["tms"][ok_idx],
+                 reag_max * arr["tms"][ok_idx] - arr["ohtms"][ok_idx]]
+    coef = [c.tolist() for c in cons]
+    # suffix de aportes positivos: máximo que todavía se puede sumar desde la posición i
+    pos_suffix = [np.concatenate([np.cumsum(np.maximum(c, 0.0)[::-1])[::-1], [0.0]]).tolist() for c in cons]
+    tms_suffix = np.concatenate([np.cumsum(np.asarray(t)[::-1])[::-1], [0.0]]).tolist()
+    n_cons = len(coef)
+    tol = 1e-6
+
+    # orden por ley (densidad de fino) para la cota fraccional de au_fino
+    by_g = sorted(range(m), key=lambda i: -g[i])
+
+    state = {"best_key": None, "best": None, "nodes": 0}
+    deadline = cfg.get("deadline")
+    chosen: List[int] = []
+
+    def fino_ub(pos: int, cur_t: float, cur_f: float) -> float:
+        cap = tms_max - cur_t
+        ub = cur_f
+        for i in by_g:
+            if i < pos:
+                continue
+            if cap <= 0:
+                break
+            if t[i] <= cap:
+                ub += gt[i]
+                cap -= t[i]
+            else:
+                ub += g[i] * cap
+                break
+        return ub
 
-        g_avg = float(gtms[picked_np].sum() / tms_sum)
-        r_avg = float(rtms[picked_np].sum() / tms_sum)
+    def evaluate(cur_t: float, cur_g: float, cur_r: float, cur_cn: float, cur_oh: float) -> None:
+        if cur_t <= 0 or cur_t > tms_max + 1e-9:
+            return
+        g_avg = cur_g / cur_t
+        r_avg = cur_r / cur_t
         if r_avg < rec_min - 1e-9:
-            continue
+            return
         if not grade_ok(g_avg, gmin, gmax, gmin_exclusive, gmax_inclusive):
+            return
+        if enforce_reagents:
+            if (not reag_ok(cur_cn / cur_t, reag_min, reag_max)) or (not reag_ok(cur_oh / cur_t, reag_min, reag_max)):
+                return
+        key = _rank_key(cfg, cur_t, cur_g, cur_r)
+        if state["best_key"] is None or key < state["best_key"]:
+            state["best_key"] = key
+            state["best"] = list(chosen)
+
+    def bound_prune(pos: int, cur_t: float, cur_g: float, sl: List[float]) -> bool:
+        # factibilidad: cada restricción debe poder volver a >= 0 con lo que queda
+        for c in range(n_cons):
+            if sl[c] + pos_suffix[c][pos] < -tol:
+                return True
+
+        bk = state["best_key"]
+        if bk is not None:
+            reach = min(tms_max, cur_t + tms_suffix[pos])
+            under_lb = _q(max(0.0, tms_min - reach))
+            if cur_t >= tms_target:
+                gap_lb = _q(cur_t - tms_target)
+            else:
+                gap_lb = _q(max(0.0, tms_target - reach))
+            if (under_lb, gap_lb) > (bk[0], bk[1]):
+                return True
+            if (under_lb, gap_lb) == (bk[0], bk[1]) and -_q(fino_ub(pos, cur_t, cur_g)) > bk[2]:
+                return True
+        return False
+
+    # DFS iterativo (pila explícita: con engine="exact" puede haber miles de lotes => sin RecursionError).
+    # Mismo orden que la recursión: rama incluir primero, después excluir.
+    # Frames: (pos, t, g, r, cn, oh, sl) = visitar nodo; None = sacar el último lote de `chosen`.
+    stack: List[Any] = [(0, 0.0, 0.0, 0.0, 0.0, 0.0, [0.0] * n_cons)]
+    complete = True
+    timed_out = False
+    while stack:
+        fr = stack.pop()
+        if fr is None:
+            chosen.pop()
             continue
+        pos, cur_t, cur_g, cur_r, cur_cn, cur_oh, sl = fr
 
-        if enforce_reagents:
-            cn_avg = float(cntms[picked_np].sum() / tms_sum)
-            oh_avg = float(ohtms[picked_np].sum() / tms_sum)
-            if (not reag_ok(cn_avg, reag_min, reag_max)) or (not reag_ok(oh_avg, reag_min, reag_max)):
-                continue
+        state["nodes"] += 1
+        if state["nodes"] > max_nodes:
+            complete = False
+            break
+        if (state["nodes"] & 1023) == 0:
+            # job especulativo cancelado (ganó el otro) o deadline vencido
+            if _job_cancelled():
+                complete = False
+                break
+            if _past_deadline(deadline):
+                complete = False
+                timed_out = True
+                break
+
+        if bound_prune(pos, cur_t, cur_g, sl) or pos >= m:
+            continue
 
-        au_fino_sum = float(gtms[picked_np].sum())
-        under = max(0.0, tms_min - tms_sum)
-        gap = abs(tms_sum - tms_target)
+        # rama excluir (se procesa después de todo el subárbol de incluir)
+        stack.append((pos + 1, cur_t, cur_g, cur_r, cur_cn, cur_oh, sl))
 
-        key = (under, gap, -au_fino_sum, -g_avg, -tms_sum, -r_avg)
+        # rama incluir
+        ti = t[pos]
+        if cur_t + ti <= tms_max + 1e-9:
+            nt = cur_t + ti
+            ng = cur_g + gt[pos]
+            nr = cur_r + rt[pos]
+            ncn = cur_cn + cnt[pos]
+            noh = cur_oh + oht[pos]
+            nsl = [sl[c] + coef[c][pos] for c in range(n_cons)]
+            chosen.append(int(ok_idx[pos]))
+            evaluate(nt, ng, nr, ncn, noh)
+            stack.append(None)
+            stack.append((pos + 1, nt, ng, nr, ncn, noh, nsl))
+
+    return state["best_key"], state["best"], int(state["nodes"]), bool(complete), timed_out
+
+
+# =========================
+# POOL DE PROCESOS (multi-start paralelo)
+# =========================
+_EXECUTOR: Optional[ProcessPoolExecutor] = None
+_EXECUTOR_LOCK = threading.Lock()
+_IN_WORKER = False
+
+# flags de cancelación compartidos con los workers (1 slot por job en vuelo)
+_CANCEL_SLOTS = 64
+_CANCEL: Any = None
+_CANCEL_FREE: List[int] = []
+_JOB_SLOT = -1
+
+
+def _worker_init(cancel: Any = None) -> None:
+    # dentro de un worker no se vuelve a abrir otro pool (evita pools anidados)
+    global _IN_WORKER, _CANCEL
+    _IN_WORKER = True
+    _CANCEL = cancel
+
+
+def _job_cancelled() -> bool:
+    return _JOB_SLOT >= 0 and _CANCEL is not None and bool(_CANCEL[_JOB_SLOT])
+
+
+def _get_executor() -> Optional[ProcessPoolExecutor]:
+    global _EXECUTOR, _CANCEL, _CANCEL_FREE
+    if _IN_WORKER:
+        return None
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is None:
+            methods = mp.get_all_start_methods()
+            ctx = mp.get_context("forkserver" if "forkserver" in methods else "spawn")
+            _CANCEL = ctx.Array("b", _CANCEL_SLOTS, lock=False)
+            _CANCEL_FREE = list(range(_CANCEL_SLOTS))
+            _EXECUTOR = ProcessPoolExecutor(
+                max_workers=max(1, os.cpu_count() or 1),
+                mp_context=ctx,
+                initializer=_worker_init,
+                initargs=(_CANCEL,),
+            )
+        return _EXECUTOR
+
+
+def _split_restarts(n_iters: int, workers: int) -> List[int]:
+    n_iters = max(0, int(n_iters))
+    workers = max(1, min(int(workers), n_iters)) if n_iters > 0 else 1
+    q, r = divmod(n_iters, workers)
+    return [q + (1 if i < r else 0) for i in range(workers)]
+
+
+def _run_restarts(arr: Dict[str, np.ndarray], cfg: Dict[str, Any], n_iters: int, seed: int, workers: int) -> Tuple[Optional[tuple], Optional[List[int]], int, bool]:
+    """
+    workers <= 1: una sola secuencia rng(seed) (comportamiento original).
+    workers > 1: n_iters se reparte en `workers` bloques con seed [seed, i] cada uno;
+    el resultado solo depende de (seed, workers), corra en paralelo o en serie.
+    """
+    if int(workers) <= 1:
+        return _restarts_chunk(arr, cfg, n_iters, seed)
+
+    sizes = _split_restarts(n_iters, workers)
+    seeds = [[int(seed), i] for i in range(len(sizes))]
+
+    ex = _get_executor()
+    if ex is not None:
+        futs = [ex.submit(_restarts_chunk, arr, cfg, sz, sd) for sz, sd in zip(sizes, seeds)]
+        results = [f.result() for f in futs]
+    else:
+        results = [_restarts_chunk(arr, cfg, sz, sd) for sz, sd in zip(sizes, seeds)]
+
+    # reduce en orden de bloque (empate -> gana el bloque menor, igual que en serie)
+    best_key = None
+    best_picked = None
+    n_done = 0
+    timed_out = False
+    for key, picked, done, cut in results:
+        n_done += int(done)
+        timed_out = timed_out or bool(cut)
+        if key is None:
+            continue
         if best_key is None or key < best_key:
             best_key = key
             best_picked = picked
+    return best_key, best_picked, n_done, timed_out
 
-    if best_picked is None:
-        return pd.DataFrame()
 
-    out = base.iloc[best_picked].copy()
-    out["pile_type"] = pile_type
-    return out
+def _cancellable_job(slot: int, fn: Callable[..., np.ndarray], args: tuple, kw: Dict[str, Any]) -> Tuple[np.ndarray, Dict[str, Any]]:
+    # corre en un worker; si el padre marca el slot, los restarts cortan en la próxima vuelta
+    global _JOB_SLOT
+    _JOB_SLOT = int(slot)
+    try:
+        st: Dict[str, Any] = {}
+        return fn(*args, stats=st, **kw), st
+    finally:
+        _JOB_SLOT = -1
 
 
-def build_batch(lots: pd.DataFrame, params: Dict[str, Any], seed: int) -> pd.DataFrame:
-    pile_rec_min = float(params["pile_rec_min"])
-    bat_lot_g_min = float(params.get("bat_lot_g_min", 0.0) or 0.0)
+def _release_slot(slot: int) -> None:
+    with _EXECUTOR_LOCK:
+        _CANCEL[slot] = 0
+        _CANCEL_FREE.append(slot)
 
-    eligible = lots.copy()
-    m = (
-        eligible["codigo"].notna()
-        & eligible["tms"].notna()
-        & eligible["au_gr_ton"].notna()
-        & eligible["rec_pct"].notna()
-        & eligible["tmh_eff"].notna()
-        & (eligible["tms"] > 0)
-        & (eligible["tmh_eff"] > 0)
-    )
-    eligible = eligible[m].copy()
-    if eligible.empty:
-        return pd.DataFrame()
 
-    if bat_lot_g_min > 0:
-        eligible = eligible[eligible["au_gr_ton"] >= bat_lot_g_min].copy()
-        if eligible.empty:
-            return pd.DataFrame()
+def _submit_job(ex: ProcessPoolExecutor, fn: Callable[..., np.ndarray], args: tuple, kw: Dict[str, Any]) -> Future:
+    """`fn(*args, stats=..., **kw)` en un worker (cancelable); el Future da (resultado, stats)."""
+    with _EXECUTOR_LOCK:
+        slot = _CANCEL_FREE.pop() if _CANCEL_FREE else -1
+    fut = ex.submit(_cancellable_job, slot, fn, args, kw)
+    fut.cancel_slot = slot
+    if slot >= 0:
+        fut.add_done_callback(lambda _f, _s=slot: _release_slot(_s))
+    return fut
 
-    def _try(eligible_in: pd.DataFrame, seed_in: int) -> Tuple[pd.DataFrame, bool]:
-        if eligible_in is None or eligible_in.empty:
-            return pd.DataFrame(), True
 
-        p = solve_one_pile(
-            lots=eligible_in,
-            pile_type="batch",
-            tms_max=float(params["bat_tms_max"]),
-            tms_target=float(params["bat_tms_target"]),
-            tms_min=float(params["bat_tms_min"]),
-            gmin=float(params["bat_pile_g_min"]),
-            gmax=1e9,
-            gmin_exclusive=False,
-            gmax_inclusive=True,
-            rec_min=pile_rec_min,
-            enforce_reagents=True,
-            reag_min=float(params["reag_min"]),
-            reag_max=float(params["reag_max"]),
-            n_iters=int(params["batch_n_iters_hard"]),
-            max_steps=int(params["batch_max_steps"]),
-            cand_sample=int(params["batch_cand_sample"]),
-            reseeds_per_iter=int(params["batch_reseeds"]),
-            seed=seed_in,
-            pair_topk=int(params["batch_pair_topk"]),
-            pair_pool=int(params["batch_pair_pool"]),
-        )
-        if not p.empty and float(p["tms"].sum()) >= float(params["bat_tms_min"]) - 1e-9:
-            return p, True
+def _cancel_job(fut: Future) -> None:
+    if fut.cancel():
+        return
+    slot = getattr(fut, "cancel_slot", -1)
+    if slot < 0:
+        return
+    # bajo el lock: si el job ya terminó el slot pudo volver a la lista libre
+    with _EXECUTOR_LOCK:
+        if not fut.done():
+            _CANCEL[slot] = 1
 
-        p = solve_one_pile(
-            lots=eligible_in,
-            pile_type="batch",
-            tms_max=float(params["bat_tms_max"]),
-            tms_target=float(params["bat_tms_target"]),
-            tms_min=float(params["bat_tms_min"]),
-            gmin=float(params["bat_pile_g_min"]),
-            gmax=1e9,
-            gmin_exclusive=False,
-            gmax_inclusive=True,
-            rec_min=pile_rec_min,
-            enforce_reagents=False,
-            reag_min=float(params["reag_min"]),
-            reag_max=float(params["reag_max"]),
-            n_iters=int(params["batch_n_iters_soft"]),
-            max_steps=int(params["batch_max_steps"]),
-            cand_sample=int(params["batch_cand_sample"]),
-            reseeds_per_iter=int(params["batch_reseeds"]),
-            seed=seed_in + 1000,
-            pair_topk=int(params["batch_pair_topk"]),
-            pair_pool=int(params["batch_pair_pool"]),
-        )
-        if not p.empty and float(p["tms"].sum()) >= float(params["bat_tms_min"]) - 1e-9:
-            return p, False
 
-        return pd.DataFrame(), True
+def _merge_stats(dst: Optional[Dict[str, Any]], src: Dict[str, Any]) -> None:
+    if dst is None:
+        return
+    for k, v in src.items():
+        dst[k] = int(dst.get(k, 0)) + int(v)
 
-    pref_rec = max(float(DEFAULT_PARAMS["pile_rec_min"]), float(pile_rec_min))
-    eligible_pref = eligible[eligible["rec_pct"] >= pref_rec].copy()
 
-    p, enf_used = _try(eligible_pref, seed)
-    if not p.empty:
-        pool_poor = eligible[(eligible["rec_pct"] >= pile_rec_min) & (eligible["rec_pct"] < pref_rec)].copy()
-        p = top_up_pile(
-            p, pool_poor,
-            rec_min=pile_rec_min,
-            tms_max=float(params["bat_tms_max"]),
-            tms_target=float(params["bat_tms_target"]),
-            gmin=float(params["bat_pile_g_min"]),
-            gmax=1e9,
-            gmin_exclusive=False,
-            gmax_inclusive=True,
-            enforce_reagents=bool(enf_used),
-            reag_min=float(params["reag_min"]),
-            reag_max=float(params["reag_max"]),
-        )
-        return p
+def solve_one_pile(
+    pool: "LotPool",
+    idx: np.ndarray,
+    tms_max: float,
+    tms_target: float,
+    tms_min: float,
+    gmin: float,
+    gmax: float,
+    gmin_exclusive: bool,
+    gmax_inclusive: bool,
+    rec_min: float,
+    enforce_reagents: bool,
+    reag_min: float,
+    reag_max: float,
+    n_iters: int,
+    max_steps: int,
+    cand_sample: int,
+    reseeds_per_iter: int,  # sin efecto con el índice por TMS (cada paso ve todos los lotes vivos)
+    seed: int,
+    pair_topk: int,
+    pair_pool: int,
+    workers: int = 1,
+    patience: int = 0,
+    stop_gap: float = -1.0,
+    engine: str = "greedy",
+    exact_max_lots: int = 0,
+    exact_max_nodes: int = 100000,
+    deadline: Optional[float] = None,
+    warm_codes: Optional[np.ndarray] = None,
+    stats: Optional[Dict[str, Any]] = None,
+) -> np.ndarray:
+    """
+    Arma 1 pila sobre los lotes `idx` del pool; retorna los índices elegidos (vacío si no hay pila).
+    `warm_codes`: códigos de la pila anterior; siembran el primer restart (ver _restarts_chunk).
+    """
+    if idx is None or len(idx) == 0:
+        return _EMPTY_IDX
+
+    idx = np.asarray(idx, dtype=np.int64)
+    idx = idx[pool.valid[idx]]
+    if idx.size == 0:
+        return _EMPTY_IDX
 
-    eligible_hi = eligible[eligible["rec_pct"] >= pile_rec_min].copy()
-    p, _ = _try(eligible_hi, seed)
-    if not p.empty:
-        return p
+    if enforce_reagents:
+        idx = idx[pool.has_reag[idx]]
+        if idx.size == 0:
+            return _EMPTY_IDX
 
-    p, _ = _try(eligible, seed)
-    return p
+    # arrays base
+    tms_arr = pool.tms[idx]
+    g_arr   = pool.g[idx]
+    r_arr   = pool.r[idx]
+    cn_arr  = pool.cn[idx]
+    oh_arr  = pool.oh[idx]
+    tmh_arr = pool.tmh[idx]
+
+    gtms  = g_arr  * tms_arr
+    rtms  = r_arr  * tms_arr
+    cntms = cn_arr * tms_arr
+    ohtms = oh_arr * tms_arr
+
+    bad_reag = np.isnan(cn_arr) | np.isnan(oh_arr)
+
+    is_lowrec = (r_arr < rec_min).astype(np.int8)
+    order0 = np.lexsort((-tms_arr, -r_arr, is_lowrec))
+    base = idx[order0]
+
+    # reorder arrays to base order
+    tms_arr = tms_arr[order0]
+    g_arr   = g_arr[order0]
+    r_arr   = r_arr[order0]
+    cn_arr  = cn_arr[order0]
+    oh_arr  = oh_arr[order0]
+    tmh_arr = tmh_arr[order0]
+    gtms    = gtms[order0]
+    rtms    = rtms[order0]
+    cntms   = cntms[order0]
+    ohtms   = ohtms[order0]
+    bad_reag = bad_reag[order0]
+    lowrec_f = (r_arr < rec_min).astype(float)
+
+    arr = {
+        "tms": tms_arr, "r": r_arr, "tmh": tmh_arr,
+        "gtms": gtms, "rtms": rtms, "cntms": cntms, "ohtms": ohtms,
+        "bad_reag": bad_reag, "lowrec_f": lowrec_f,
+    }
+    cfg = {
+        "tms_max": float(tms_max), "tms_target": float(tms_target), "tms_min": float(tms_min),
+        "gmin": float(gmin), "gmax": float(gmax),
+        "gmin_exclusive": bool(gmin_exclusive), "gmax_inclusive": bool(gmax_inclusive),
+        "rec_min": float(rec_min), "enforce_reagents": bool(enforce_reagents),
+        "reag_min": float(reag_min), "reag_max": float(reag_max),
+        "max_steps": int(max_steps), "cand_sample": int(cand_sample),
+        "pair_topk": int(pair_topk), "pair_pool": int(pair_pool),
+        "patience": int(patience), "stop_gap": float(stop_gap),
+        "deadline": deadline,
+    }
+    if warm_codes is not None and len(warm_codes):
+        cfg["warm"] = np.flatnonzero(np.isin(pool.cod[base], warm_codes)).tolist()
+
+    eng = str(engine or "greedy").strip().lower()
+    use_exact = (eng == "exact") or (eng == "auto" and base.size <= int(exact_max_lots))
+
+    best_key = None
+    best_picked = None
+    run_greedy = True
+    if use_exact:
+        ex_key, ex_picked, nodes, complete, timed_out = _exact_pile(arr, cfg, int(exact_max_nodes))
+        if stats is not None:
+            stats["exact_nodes"] = int(stats.get("exact_nodes", 0)) + nodes
+        if timed_out:
+            _note_deadline_stop(stats)
+        best_key, best_picked = ex_key, ex_picked
+        # búsqueda completa => óptimo probado (o infactible); si se cortó, compite con el greedy
+        run_greedy = not complete
+
+    if run_greedy:
+        gr_key, gr_picked, n_done, timed_out = _run_restarts(arr, cfg, int(n_iters), seed, int(workers))
+        if stats is not None:
+            stats["restarts"] = int(stats.get("restarts", 0)) + n_done
+            # el resultado depende del seed (sin greedy: exacto completo => mismo resultado con cualquier seed)
+            stats["greedy_runs"] = int(stats.get("greedy_runs", 0)) + 1
+        if timed_out:
+            _note_deadline_stop(stats)
+        if gr_key is not None and (best_key is None or gr_key < best_key):
+            best_key, best_picked = gr_key, gr_picked
+
+    if best_picked is None:
+        return _EMPTY_IDX
+
+    return base[np.asarray(best_picked, dtype=np.int64)]
+
+
+def build_batch(
+    pool: "LotPool",
+    idx: np.ndarray,
+    params: Dict[str, Any],
+    seed: int,
+    *,
+    stats: Optional[Dict[str, Any]] = None,
+) -> np.ndarray:
+    return build_batch_with_limits(
+        pool, idx, params, seed,
+        tms_max=float(params["bat_tms_max"]),
+        tms_target=float(params["bat_tms_target"]),
+        tms_min=float(params["bat_tms_min"]),
+        stats=stats,
+    )
 
 
 def build_batch_with_limits(
-    lots: pd.DataFrame,
+    pool: "LotPool",
+    idx: np.ndarray,
     params: Dict[str, Any],
     seed: int,
     *,
     tms_max: float,
     tms_target: float,
     tms_min: float,
-) -> pd.DataFrame:
+    stats: Optional[Dict[str, Any]] = None,
+) -> np.ndarray:
+    if idx is None or len(idx) == 0:
+        return _EMPTY_IDX
+
     pile_rec_min = float(params["pile_rec_min"])
     bat_lot_g_min = float(params.get("bat_lot_g_min", 0.0) or 0.0)
 
-    eligible = lots.copy()
-    m = (
-        eligible["codigo"].notna()
-        & eligible["tms"].notna()
-        & eligible["au_gr_ton"].notna()
-        & eligible["rec_pct"].notna()
-        & eligible["tmh_eff"].notna()
-        & (eligible["tms"] > 0)
-        & (eligible["tmh_eff"] > 0)
-    )
-    eligible = eligible[m].copy()
-    if eligible.empty:
-        return pd.DataFrame()
+    eligible = np.asarray(idx, dtype=np.int64)
+    eligible = eligible[pool.valid[eligible]]
+    if eligible.size == 0:
+        return _EMPTY_IDX
 
     if bat_lot_g_min > 0:
-        eligible = eligible[eligible["au_gr_ton"] >= bat_lot_g_min].copy()
-        if eligible.empty:
-            return pd.DataFrame()
+        eligible = eligible[pool.g[eligible] >= bat_lot_g_min]
+        if eligible.size == 0:
+            return _EMPTY_IDX
 
-    def _try(eligible_in: pd.DataFrame, seed_in: int) -> Tuple[pd.DataFrame, bool]:
-        if eligible_in is None or eligible_in.empty:
-            return pd.DataFrame(), True
-
-        p = solve_one_pile(
-            lots=eligible_in,
-            pile_type="batch",
+    def _phase_kw(enforce: bool, seed_in: int) -> Dict[str, Any]:
+        return dict(
             tms_max=float(tms_max),
             tms_target=float(tms_target),
             tms_min=float(tms_min),
@@ -1411,55 +2063,78 @@ def build_batch_with_limits(
             gmin_exclusive=False,
             gmax_inclusive=True,
             rec_min=pile_rec_min,
-            enforce_reagents=True,
+            enforce_reagents=bool(enforce),
             reag_min=float(params["reag_min"]),
             reag_max=float(params["reag_max"]),
-            n_iters=int(params["batch_n_iters_hard"]),
+            n_iters=int(params["batch_n_iters_hard" if enforce else "batch_n_iters_soft"]),
             max_steps=int(params["batch_max_steps"]),
             cand_sample=int(params["batch_cand_sample"]),
             reseeds_per_iter=int(params["batch_reseeds"]),
             seed=seed_in,
             pair_topk=int(params["batch_pair_topk"]),
             pair_pool=int(params["batch_pair_pool"]),
+            workers=int(params["batch_workers"]),
+            patience=int(params["batch_patience"]),
+            stop_gap=float(params["batch_stop_gap"]),
+            engine=str(params["batch_engine"]),
+            exact_max_lots=int(params["batch_exact_max_lots"]),
+            exact_max_nodes=int(params["batch_exact_max_nodes"]),
+            deadline=params.get("deadline"),
+            warm_codes=params.get("warm_codes"),
         )
-        if not p.empty and float(p["tms"].sum()) >= float(tms_min) - 1e-9:
+
+    def _feasible(p: np.ndarray) -> bool:
+        return bool(p.size) and float(pool.tms[p].sum()) >= float(tms_min) - 1e-9
+
+    def _try(eligible_in: np.ndarray, seed_in: int) -> Tuple[np.ndarray, bool]:
+        if eligible_in is None or eligible_in.size == 0:
+            return _EMPTY_IDX, True
+
+        kw_hard = _phase_kw(True, seed_in)
+        kw_soft = _phase_kw(False, seed_in + 1000)
+
+        ex = _get_executor() if int(params.get("batch_speculative", 0)) else None
+        if ex is not None:
+            # especulativo: hard y soft a la vez; mismo resultado que en serie
+            # (hard factible gana y soft se cancela; si no, se usa soft)
+            sub = pool.subset(eligible_in)
+            loc = np.arange(eligible_in.size, dtype=np.int64)
+            f_hard = _submit_job(ex, solve_one_pile, (sub, loc), kw_hard)
+            f_soft = _submit_job(ex, solve_one_pile, (sub, loc), kw_soft)
+            try:
+                p_loc, st = f_hard.result()
+                _merge_stats(stats, st)
+                p = eligible_in[p_loc]
+                if _feasible(p):
+                    return p, True
+                p_loc, st = f_soft.result()
+                _merge_stats(stats, st)
+                p = eligible_in[p_loc]
+                if _feasible(p):
+                    return p, False
+                return _EMPTY_IDX, True
+            finally:
+                _cancel_job(f_soft)
+
+        p = solve_one_pile(pool, eligible_in, stats=stats, **kw_hard)
+        if _feasible(p):
             return p, True
 
-        p = solve_one_pile(
-            lots=eligible_in,
-            pile_type="batch",
-            tms_max=float(tms_max),
-            tms_target=float(tms_target),
-            tms_min=float(tms_min),
-            gmin=float(params["bat_pile_g_min"]),
-            gmax=1e9,
-            gmin_exclusive=False,
-            gmax_inclusive=True,
-            rec_min=pile_rec_min,
-            enforce_reagents=False,
-            reag_min=float(params["reag_min"]),
-            reag_max=float(params["reag_max"]),
-            n_iters=int(params["batch_n_iters_soft"]),
-            max_steps=int(params["batch_max_steps"]),
-            cand_sample=int(params["batch_cand_sample"]),
-            reseeds_per_iter=int(params["batch_reseeds"]),
-            seed=seed_in + 1000,
-            pair_topk=int(params["batch_pair_topk"]),
-            pair_pool=int(params["batch_pair_pool"]),
-        )
-        if not p.empty and float(p["tms"].sum()) >= float(tms_min) - 1e-9:
+        p = solve_one_pile(pool, eligible_in, stats=stats, **kw_soft)
+        if _feasible(p):
             return p, False
 
-        return pd.DataFrame(), True
+        return _EMPTY_IDX, True
 
+    r_el = pool.r[eligible]
     pref_rec = max(float(DEFAULT_PARAMS["pile_rec_min"]), float(pile_rec_min))
-    eligible_pref = eligible[eligible["rec_pct"] >= pref_rec].copy()
+    eligible_pref = eligible[r_el >= pref_rec]
 
     p, enf_used = _try(eligible_pref, seed)
-    if not p.empty:
-        pool_poor = eligible[(eligible["rec_pct"] >= pile_rec_min) & (eligible["rec_pct"] < pref_rec)].copy()
-        p = top_up_pile(
-            p, pool_poor,
+    if p.size:
+        pool_poor = eligible[(r_el >= pile_rec_min) & (r_el < pref_rec)]
+        return top_up_pile(
+            pool, p, pool_poor,
             rec_min=pile_rec_min,
             tms_max=float(tms_max),
             tms_target=float(tms_target),
@@ -1471,41 +2146,272 @@ def build_batch_with_limits(
             reag_min=float(params["reag_min"]),
             reag_max=float(params["reag_max"]),
         )
-        return p
 
-    eligible_hi = eligible[eligible["rec_pct"] >= pile_rec_min].copy()
+    eligible_hi = eligible[r_el >= pile_rec_min]
     p, _ = _try(eligible_hi, seed)
-    if not p.empty:
+    if p.size:
         return p
 
     p, _ = _try(eligible, seed)
     return p
 
 
+def _batch_seed_tries(
+    pool: "LotPool",
+    idx: np.ndarray,
+    params: Dict[str, Any],
+    seeds: List[int],
+    stats: Dict[str, Any],
+    tries_ms: Optional[List[float]] = None,
+) -> np.ndarray:
+    """
+    build_batch con cada seed hasta que uno arme pila. Con batch_seed_workers > 1 los
+    intentos corren en workers: gana el de menor índice que arma pila (igual que en serie)
+    y los de índice mayor se cancelan. stats suma solo los intentos que la serie habría corrido.
+    Un intento que no corrió greedy (motor exacto completo) no depende del seed: no se prueban más.
+    tries_ms (opcional) recibe los ms de cada intento consumido (en paralelo: desde el submit).
+    """
+    if tries_ms is None:
+        tries_ms = []
+
+    def _serial_try(sd: int) -> Tuple[np.ndarray, bool]:
+        # (pila, otro seed podría dar otra cosa): sin greedy el intento no depende del seed
+        st: Dict[str, Any] = {}
+        t0 = time.perf_counter()
+        p = build_batch(pool, idx, params, seed=sd, stats=st)
+        tries_ms.append(round((time.perf_counter() - t0) * 1000.0, 3))
+        _merge_stats(stats, st)
+        return p, bool(st.get("greedy_runs"))
+
+    ex = _get_executor() if int(params.get("batch_seed_workers", 1)) > 1 and len(seeds) > 1 else None
+    if ex is None:
+        for sd in seeds:
+            if _past_deadline(params.get("deadline")):
+                _note_deadline_stop(stats)
+                break
+            p, seeded = _serial_try(sd)
+            if p.size or not seeded:
+                return p
+        return _EMPTY_IDX
+
+    # motor exacto probable: el 1er intento va solo; si el exacto completó, los demás seeds
+    # darían lo mismo y no se reparten a los workers
+    eng = str(params.get("batch_engine") or "").strip().lower()
+    if eng == "exact" or (eng == "auto" and len(idx) <= int(params.get("batch_exact_max_lots", 0))):
+        if _past_deadline(params.get("deadline")):
+            _note_deadline_stop(stats)
+            return _EMPTY_IDX
+        p, seeded = _serial_try(seeds[0])
+        if p.size or not seeded:
+            return p
+        seeds = seeds[1:]
+        if not seeds:
+            return _EMPTY_IDX
+
+    idx = np.asarray(idx, dtype=np.int64)
+    sub = pool.subset(idx)
+    loc = np.arange(idx.size, dtype=np.int64)
+    n_par = min(int(params["batch_seed_workers"]), len(seeds))
+
+    futs: List[Future] = []
+    t_sub: List[float] = []
+    try:
+        for t in range(len(seeds)):
+            # ventana de n_par intentos en vuelo
+            while len(futs) < min(len(seeds), t + n_par) and not _past_deadline(params.get("deadline")):
+                t_sub.append(time.perf_counter())
+                futs.append(_submit_job(ex, build_batch, (sub, loc, params), {"seed": seeds[len(futs)]}))
+            if t >= len(futs):
+                # no se lanzó el intento t: se venció el deadline
+                _note_deadline_stop(stats)
+                break
+            p_loc, st = futs[t].result()
+            tries_ms.append(round((time.perf_counter() - t_sub[t]) * 1000.0, 3))
+            _merge_stats(stats, st)
+            if p_loc.size:
+                return idx[p_loc]
+            if not st.get("greedy_runs"):
+                # falló sin depender del seed: los demás intentos fallan igual
+                return _EMPTY_IDX
+        return _EMPTY_IDX
+    finally:
+        for f in futs:
+            _cancel_job(f)
+
+
+# =========================
+# TIMINGS (diagnóstico por fase)
+# =========================
+class Timings:
+    """
+    Cronómetro liviano: `lap(fase)` suma en ms[fase] lo que pasó desde el lap anterior.
+    `ms` es un dict plano {fase: ms} (JSON-safe) que se puede exponer tal cual.
+    """
+
+    def __init__(self) -> None:
+        self.ms: Dict[str, float] = {}
+        self._t0 = time.perf_counter()
+        self._last = self._t0
+
+    def lap(self, name: str) -> float:
+        now = time.perf_counter()
+        dt = (now - self._last) * 1000.0
+        self._last = now
+        self.ms[name] = round(self.ms.get(name, 0.0) + dt, 3)
+        return dt
+
+    def total(self) -> float:
+        return round((time.perf_counter() - self._t0) * 1000.0, 3)
+
+
+# =========================
+# WARM START (pilas del run anterior)
+# =========================
+def _prev_piles(prev_out: Any) -> Dict[int, np.ndarray]:
+    """{pile_code: códigos} de una salida anterior (DataFrame o filas con pile_code + codigo)."""
+    if prev_out is None:
+        return {}
+    d = prev_out if isinstance(prev_out, pd.DataFrame) else pd.DataFrame(list(prev_out))
+    if d.empty or "pile_code" not in d.columns or "codigo" not in d.columns:
+        return {}
+    d = d[d["codigo"].notna()]
+    pc = pd.to_numeric(d["pile_code"], errors="coerce")
+    d = d[pc.notna()]
+    out: Dict[int, np.ndarray] = {}
+    for code, g in d.groupby(pc[pc.notna()].astype(int)):
+        out[int(code)] = g["codigo"].astype(str).unique()
+    return out
+
+
+def _keep_batch_pile(pool: "LotPool", codes: np.ndarray, params: Dict[str, Any], enforce_reagents: bool = True) -> np.ndarray:
+    """
+    Índices de una pila batch anterior si todos sus lotes siguen vivos y la pila todavía
+    cumple TMS / ley / rec de batch (los mismos chequeos con que build_batch la acepta); si no, vacío.
+    Con enforce_reagents (fase hard de build_batch) también NaCN / NaOH dentro de [reag_min, reag_max].
+    """
+    idx = np.flatnonzero(pool.alive & pool.valid & np.isin(pool.cod, codes))
+    if idx.size == 0 or np.unique(pool.cod[idx]).size != len(codes):
+        return _EMPTY_IDX
+
+    bat_lot_g_min = float(params.get("bat_lot_g_min", 0.0) or 0.0)
+    if bat_lot_g_min > 0 and bool((pool.g[idx] < bat_lot_g_min).any()):
+        return _EMPTY_IDX
+
+    tms = pool.tms[idx]
+    tms_sum = float(tms.sum())
+    if tms_sum < float(params["bat_tms_min"]) - 1e-9 or tms_sum > float(params["bat_tms_max"]) + 1e-9:
+        return _EMPTY_IDX
+
+    g_avg = float((pool.g[idx] * tms).sum() / tms_sum)
+    r_avg = float((pool.r[idx] * tms).sum() / tms_sum)
+    if not grade_ok(g_avg, float(params["bat_pile_g_min"]), 1e9, gmin_exclusive=False, gmax_inclusive=True):
+        return _EMPTY_IDX
+    if r_avg < float(params["pile_rec_min"]) - 1e-9:
+        return _EMPTY_IDX
+
+    if enforce_reagents:
+        if not bool(pool.has_reag[idx].all()):
+            return _EMPTY_IDX
+        reag_min = float(params["reag_min"])
+        reag_max = float(params["reag_max"])
+        cn_avg = float((pool.cn[idx] * tms).sum() / tms_sum)
+        oh_avg = float((pool.oh[idx] * tms).sum() / tms_sum)
+        if (not reag_ok(cn_avg, reag_min, reag_max)) or (not reag_ok(oh_avg, reag_min, reag_max)):
+            return _EMPTY_IDX
+    return idx
+
+
+def _with_warm(params: Dict[str, Any], codes: Optional[np.ndarray]) -> Dict[str, Any]:
+    return params if codes is None else dict(params, warm_codes=codes)
+
+
 # =========================
 # SOLVE (SPEED: usa _cod y evita astype(str) repetido en loops)
 # =========================
+# parte del tiempo restante que recibe cada fase con time_budget_ms (mix se lleva el resto)
+_BUDGET_SHARES = {"varios": 0.2, "batch": 0.7, "mix": 1.0}
+
 def solve(
     df_raw: pd.DataFrame,
-    payload: Optional[Dict[str, Any]] = None
+    payload: Optional[Dict[str, Any]] = None,
+    info: Optional[Dict[str, Any]] = None,
+    prev: Optional[Dict[str, Any]] = None,
+    base: Optional[pd.DataFrame] = None,
 ) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame]:
-    params = resolve_params(payload)
+    """
+    `prev` (opcional, con warm_start=1): salidas del run anterior {"p2": ..., "p3": ...}
+    (DataFrame o filas con pile_code + codigo, p.ej. lo leído de res_pila_2/3).
+
+    `base` (opcional): salida de prep_shared(df_raw), compartida entre variantes (sweep);
+    en ese caso df_raw no se usa.
+
+    `info` (opcional) se llena con datos de diagnóstico del run:
+      info["prep"] = {"rows": {etapa: n}, "ms": {etapa: ms}}
+      info["restarts"] = {"batch": [{"pile_code", "restarts"}], "mix": [...], "failed": n, "total": n}
+      info["truncated"] = {"varios": bool, "batch": bool, "mix": bool}  (fase cortada por time_budget_ms)
+      info["warm"] = {"kept": n, "repaired": n}  (pilas batch conservadas / rehechas desde la anterior)
+      info["timings"] = {"ms": {fase: ms}, "batch_piles": [{"pile_code", "ms", "tries_ms"}], "mix_piles": [...], "total_ms"}
+    """
+    tm = Timings()
+    timing: Dict[str, Any] = {"ms": tm.ms, "batch_piles": [], "mix_piles": [], "total_ms": 0.0}
+    if info is not None:
+        info["timings"] = timing
 
-    rej_lowrec = build_rejects_lowrec(df_raw, params)
+    params = resolve_params(payload)
 
-    df = preprocess(df_raw, params)
+    # presupuesto: cada fase recibe su parte de lo que queda (lo que no usa pasa a la siguiente)
+    budget_ms = float(params.get("time_budget_ms", 0.0) or 0.0)
+    t_end = (time.monotonic() + budget_ms / 1000.0) if budget_ms > 0 else None
+    truncated = {"varios": False, "batch": False, "mix": False}
+    if info is not None:
+        info["truncated"] = truncated
+
+    warm_log = {"kept": 0, "repaired": 0}
+    prev_batch: Dict[int, np.ndarray] = {}
+    prev_mix: Dict[int, np.ndarray] = {}
+    if prev and int(params["warm_start"]):
+        prev_batch = _prev_piles(prev.get("p2"))
+        prev_mix = _prev_piles(prev.get("p3"))
+        if info is not None:
+            info["warm"] = warm_log
+
+    def _phase_params(phase: str) -> Dict[str, Any]:
+        if t_end is None:
+            return params
+        now = time.monotonic()
+        return dict(params, deadline=now + max(0.0, t_end - now) * _BUDGET_SHARES[phase])
+
+    restarts_log: Dict[str, Any] = {"batch": [], "mix": [], "failed": 0, "total": 0}
+    if info is not None:
+        info["restarts"] = restarts_log
+
+    # SPEED: 1 sola pasada de preprocesamiento para elegibles + rechazos
+    prep_stats: Dict[str, Any] = {}
+    if info is not None:
+        info["prep"] = prep_stats
+    df, rej_lowrec = preprocess_all(df_raw, params, stats=prep_stats, base=base)
+    tm.lap("prep")
     if df.empty:
+        timing["total_ms"] = tm.total()
         return pd.DataFrame(), pd.DataFrame(), pd.DataFrame(), rej_lowrec
 
+    # SPEED: arrays 1 sola vez; los builders trabajan por índice y solo se materializa al final
+    pool = LotPool(df)
+    tm.lap("pool")
+
     # OUTPUT 1: 1 pila varios
-    p1 = build_varios(df, params).copy()
+    pp = _phase_params("varios")
+    st_varios: Dict[str, Any] = {}
+    varios_idx = build_varios(pool, pool.live_idx(), pp, stats=st_varios)
+    truncated["varios"] = bool(st_varios.get("deadline_stops"))
+    p1 = pool.take(varios_idx, "varios")
     if not p1.empty:
         p1["pile_code"] = 1
+    tm.lap("varios")
 
     # =========================
     # OUTPUT 2: N pilas batch (OPTIMIZADO)
     # =========================
-    remaining = df.copy()
     batch_piles: List[pd.DataFrame] = []
     pile_idx = 1
     seed_batch_base = int(params["seed_batch_base"])
@@ -1515,109 +2421,165 @@ def solve(
     MAX_SEED_TRIES = 6  # igual que antes
 
     # ✅ cache de TMS restante para cortar temprano
-    remaining_tms_sum = float(remaining["tms"].fillna(0).sum())
+    remaining_tms_sum = float(np.nansum(pool.tms))
+
+    pp = _phase_params("batch")
+
+    # warm start: primero se reservan las pilas anteriores que siguen válidas tal cual
+    # (conservan su código); solo se re-arman los huecos que dejaron las que cambiaron
+    kept: Dict[int, np.ndarray] = {}
+    for code in sorted(prev_batch):
+        k = _keep_batch_pile(pool, prev_batch[code], pp)
+        if k.size:
+            kept[code] = k
+            pool.kill_codes(k)
+            remaining_tms_sum = max(0.0, remaining_tms_sum - float(np.nansum(pool.tms[k])))
+    warm_log["kept"] = len(kept)
+
+    def _emit(p: np.ndarray, code: int, restarts: int, ms: float = 0.0, tries_ms: Optional[List[float]] = None) -> None:
+        restarts_log["batch"].append({"pile_code": code, "restarts": int(restarts)})
+        timing["batch_piles"].append({"pile_code": code, "ms": round(ms, 3), "tries_ms": tries_ms or []})
+
+        # ✅ asigna código de pila
+        p_df = pool.take(p, "batch")
+        p_df["pile_code"] = code
+        batch_piles.append(p_df)
 
     while True:
+        if pile_idx in kept:
+            _emit(kept.pop(pile_idx), pile_idx, 0)
+            pile_idx += 1
+            continue
+        if _past_deadline(pp.get("deadline")):
+            truncated["batch"] = True
+            break
         # ✅ corte temprano: ya no alcanza para un batch
         if remaining_tms_sum < bat_tms_min - 1e-9:
             break
-        if remaining is None or remaining.empty:
+        remaining = pool.live_idx()
+        if remaining.size == 0:
             break
 
-        p = pd.DataFrame()
+        st: Dict[str, Any] = {}
+        tries: List[float] = []
+        t_pile = time.perf_counter()
 
         # 🔁 reintentos con seeds distintos
         # (mismo comportamiento: si un seed falla, pruebas otros; si todos fallan, cortas)
-        for t in range(MAX_SEED_TRIES):
-            seed_try = seed_batch_base + pile_idx + (t * 1000)
-            p_try = build_batch(remaining, params, seed=seed_try)
-            if p_try is not None and not p_try.empty:
-                p = p_try
-                break
-
-        if p.empty:
+        # warm start: la pila anterior con este código siembra el primer restart
+        warm = prev_batch.get(pile_idx)
+        seeds = [seed_batch_base + pile_idx + (t * 1000) for t in range(MAX_SEED_TRIES)]
+        p = _batch_seed_tries(pool, remaining, _with_warm(pp, warm), seeds, st, tries_ms=tries)
+        ms_pile = (time.perf_counter() - t_pile) * 1000.0
+        truncated["batch"] = truncated["batch"] or bool(st.get("deadline_stops"))
+
+        if p.size == 0:
+            restarts_log["failed"] += int(st.get("restarts", 0))
+            timing["batch_piles"].append({"pile_code": None, "ms": round(ms_pile, 3), "tries_ms": tries})
             break
+        if warm is not None:
+            warm_log["repaired"] += 1
+        _emit(p, pile_idx, int(st.get("restarts", 0)), ms_pile, tries)
 
-        # ✅ asigna código de pila
-        p = p.copy()
-        p["pile_code"] = pile_idx
-        batch_piles.append(p)
+        # ✅ quita usados del pool (máscara alive por _cod, incluye lo agregado en top-up)
+        pool.kill_codes(p)
 
-        # ✅ usar _cod (ya existe) para quitar usados rápido y sin astype/sets
-        if "_cod" in p.columns and p["_cod"].notna().any():
-            used_codes = p["_cod"].to_numpy(object, copy=False)
-        else:
-            used_codes = p["codigo"].astype(str).to_numpy(object, copy=False)
+        # ✅ actualiza suma de TMS restante sin recalcular todo el pool
+        remaining_tms_sum = max(0.0, remaining_tms_sum - float(np.nansum(pool.tms[p])))
 
-        # ✅ filtra remaining por _cod
-        # (pandas isin ya usa hash internamente; pasar array evita set() + tolist())
-        keep_mask = ~remaining["_cod"].isin(used_codes)
-        remaining = remaining.loc[keep_mask].copy()
-
-        # ✅ actualiza suma de TMS restante sin recalcular todo el DF
-        # (aprox exacta: restas lo que realmente usaste)
-        used_tms = float(p["tms"].fillna(0).sum()) if "tms" in p.columns else 0.0
-        remaining_tms_sum = max(0.0, remaining_tms_sum - used_tms)
+        pile_idx += 1
 
+    # pilas conservadas que quedaron después del corte: siguen con códigos consecutivos
+    for code in sorted(kept):
+        _emit(kept[code], pile_idx, 0)
         pile_idx += 1
 
+
     p2 = pd.concat(batch_piles, ignore_index=True) if batch_piles else pd.DataFrame()
+    tm.lap("batch")
 
     # OUTPUT 3: mix (varios + batch)
-    rem_mix = df.copy()
+    pool.reset()
 
-    mix_varios = build_varios(rem_mix, params).copy()
+    # build_varios es determinístico sobre el mismo pool => misma pila que OUTPUT 1
+    mix_varios = pool.take(varios_idx, "varios")
     if not mix_varios.empty:
         mix_varios["pile_code"] = 1
-        used_codes = set(mix_varios.get("_cod", mix_varios["codigo"].astype(str)).tolist())
-        rem_mix = rem_mix[~rem_mix["_cod"].isin(used_codes)].copy()
+        pool.kill_codes(varios_idx)
 
     seed_mix_base = int(params["seed_mix_batch"])
     pile_code = 2 if not mix_varios.empty else 1
 
+    pp = _phase_params("mix")
+
     # intenta 1 sola pila batch si entra
     mix_batch_piles = []
 
-    if rem_mix is not None and not rem_mix.empty:
-        total_tms = float(rem_mix["tms"].fillna(0).sum())
+    rem_mix = pool.live_idx()
+    if rem_mix.size:
+        total_tms = float(np.nansum(pool.tms[rem_mix]))
 
         big_max = min(float(params["var_tms_max"]), max(float(params["bat_tms_max"]), total_tms))
         big_target = min(big_max, total_tms)
         big_min = min(float(params["bat_tms_min"]), big_target)
 
+        st = {}
+        t_pile = time.perf_counter()
         p_big = build_batch_with_limits(
-            rem_mix, params, seed=seed_mix_base + 999,
-            tms_max=big_max, tms_target=big_target, tms_min=big_min
+            pool, rem_mix, _with_warm(pp, prev_mix.get(pile_code)), seed=seed_mix_base + 999,
+            tms_max=big_max, tms_target=big_target, tms_min=big_min, stats=st
         )
+        truncated["mix"] = bool(st.get("deadline_stops"))
 
-        if p_big is not None and not p_big.empty:
-            m_big_tms = float(p_big["tms"].sum())
+        big_ok = False
+        if p_big.size:
+            m_big_tms = float(pool.tms[p_big].sum())
             if total_tms > 0 and (m_big_tms >= 0.98 * min(total_tms, big_max)):
-                p_big = p_big.copy()
-                p_big["pile_code"] = pile_code
-                mix_batch_piles.append(p_big)
+                big_ok = True
+                p_df = pool.take(p_big, "batch")
+                p_df["pile_code"] = pile_code
+                mix_batch_piles.append(p_df)
+                restarts_log["mix"].append({"pile_code": pile_code, "restarts": int(st.get("restarts", 0))})
 
-                used_codes = set(p_big.get("_cod", p_big["codigo"].astype(str)).tolist())
-                rem_mix = rem_mix[~rem_mix["_cod"].isin(used_codes)].copy()
+                pool.kill_codes(p_big)
                 pile_code += 1
+        if not big_ok:
+            restarts_log["failed"] += int(st.get("restarts", 0))
+        timing["mix_piles"].append({
+            "pile_code": (pile_code - 1) if big_ok else None,
+            "ms": round((time.perf_counter() - t_pile) * 1000.0, 3),
+            "big": True,
+        })
 
     # fallback: N pilas batch normal
     if not mix_batch_piles:
         while True:
-            p = build_batch(rem_mix, params, seed=seed_mix_base + pile_code)
-            if p.empty:
+            if _past_deadline(pp.get("deadline")):
+                truncated["mix"] = True
+                break
+            st = {}
+            t_pile = time.perf_counter()
+            p = build_batch(pool, pool.live_idx(), _with_warm(pp, prev_mix.get(pile_code)), seed=seed_mix_base + pile_code, stats=st)
+            ms_pile = round((time.perf_counter() - t_pile) * 1000.0, 3)
+            truncated["mix"] = truncated["mix"] or bool(st.get("deadline_stops"))
+            if p.size == 0:
+                restarts_log["failed"] += int(st.get("restarts", 0))
+                timing["mix_piles"].append({"pile_code": None, "ms": ms_pile})
                 break
+            timing["mix_piles"].append({"pile_code": pile_code, "ms": ms_pile})
 
-            p = p.copy()
-            p["pile_code"] = pile_code
-            mix_batch_piles.append(p)
+            p_df = pool.take(p, "batch")
+            p_df["pile_code"] = pile_code
+            mix_batch_piles.append(p_df)
+            restarts_log["mix"].append({"pile_code": pile_code, "restarts": int(st.get("restarts", 0))})
 
-            used_codes = set(p.get("_cod", p["codigo"].astype(str)).tolist())
-            rem_mix = rem_mix[~rem_mix["_cod"].isin(used_codes)].copy()
+            pool.kill_codes(p)
             pile_code += 1
 
+
     mix_batch = pd.concat(mix_batch_piles, ignore_index=True) if mix_batch_piles else pd.DataFrame()
     p3 = pd.concat([mix_varios, mix_batch], ignore_index=True)
+    tm.lap("mix")
 
     # remove used from rejects
     used_all = set()
@@ -1628,10 +2590,137 @@ def solve(
     if rej_lowrec is not None and not rej_lowrec.empty and used_all:
         rej_lowrec = rej_lowrec[~rej_lowrec["codigo"].astype(str).isin(used_all)].copy()
 
+    restarts_log["total"] = (
+        sum(x["restarts"] for x in restarts_log["batch"])
+        + sum(x["restarts"] for x in restarts_log["mix"])
+        + restarts_log["failed"]
+    )
+
     # NO CAMBIAR tu contrato: limpia columnas internas
     for _df in [p1, p2, p3]:
         if _df is not None and not _df.empty:
             _df.drop(columns=["_cod"], errors="ignore", inplace=True)
 
+    tm.lap("finalize")
+    timing["total_ms"] = tm.total()
     return p1, p2, p3, rej_lowrec
 
+
+
+# =========================
+# SWEEP (N variantes de params sobre 1 solo prep, sin escribir nada)
+# =========================
+SWEEP_MAX_VARIANTS = _env_int("SOLVER_SWEEP_MAX_VARIANTS", 64)
+
+# secciones anidadas del payload (se mezclan por clave, no se reemplazan enteras)
+_PAYLOAD_SECTIONS = ("filters", "varios", "batch", "reagents", "knobs", "seeds")
+
+
+def _merge_payload(base: Optional[Dict[str, Any]], over: Dict[str, Any]) -> Dict[str, Any]:
+    # "knobs.batch_n_iters_hard": 200 es lo mismo que {"knobs": {"batch_n_iters_hard": 200}}
+    out = {k: (dict(v) if isinstance(v, dict) else v) for k, v in (base or {}).items()}
+    for k, v in (over or {}).items():
+        sec, _, sub = str(k).partition(".")
+        if sub:
+            out[sec] = dict(out.get(sec) or {}, **{sub: v})
+        elif k in _PAYLOAD_SECTIONS and isinstance(v, dict):
+            out[k] = dict(out.get(k) or {}, **v)
+        else:
+            out[k] = v
+    return out
+
+
+def sweep_variants(
+    variants: Optional[List[Dict[str, Any]]] = None,
+    grid: Optional[Dict[str, List[Any]]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Lista de overrides: `variants` tal cual + producto cartesiano de `grid`
+    ({"pile_rec_min": [85, 87], "reag_min": [4, 5]} -> 4 variantes). Sin nada -> 1 variante vacía.
+    """
+    out = [dict(v) for v in (variants or []) if isinstance(v, dict)]
+    if grid:
+        keys = list(grid.keys())
+        combos: List[Dict[str, Any]] = [{}]
+        for k in keys:
+            vals = grid[k] if isinstance(grid[k], list) else [grid[k]]
+            combos = [dict(c, **{k: v}) for c in combos for v in vals]
+        out.extend(combos)
+    if not out:
+        out = [{}]
+    if len(out) > SWEEP_MAX_VARIANTS:
+        raise ValueError(f"sweep: {len(out)} variantes > máximo {SWEEP_MAX_VARIANTS}")
+    return out
+
+
+def summarize_output(d: pd.DataFrame) -> Dict[str, Any]:
+    # fila de la tabla comparativa: pilas, lotes, TMS, ley y rec ponderadas por TMS, finos
+    if d is None or d.empty:
+        return {"piles": 0, "lots": 0, "tms": 0.0, "au_gr_ton": None, "rec_pct": None, "au_fino": 0.0}
+    tms = d["tms"].astype(float).fillna(0.0)
+
+    def _w(col: str) -> Optional[float]:
+        v = wavg(d[col].astype(float).fillna(0.0), tms)
+        return None if math.isnan(v) else round(v, 4)
+
+    return {
+        "piles": int(d["pile_code"].nunique()) if "pile_code" in d.columns else 0,
+        "lots": int(len(d)),
+        "tms": round(float(tms.sum()), 3),
+        "au_gr_ton": _w("au_gr_ton"),
+        "rec_pct": _w("rec_pct"),
+        "au_fino": round(float(d["au_fino"].astype(float).fillna(0.0).sum()), 3),
+    }
+
+
+def _sweep_one(base: pd.DataFrame, payload: Dict[str, Any], stats: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    # corre en un worker (o en serie); solo devuelve el resumen, no los DataFrame
+    t0 = time.perf_counter()
+    info: Dict[str, Any] = {}
+    p1, p2, p3, rej = solve(None, payload, info=info, base=base)
+    if stats is not None:
+        stats["restarts"] = int((info.get("restarts") or {}).get("total", 0))
+    return {
+        "p1": summarize_output(p1),
+        "p2": summarize_output(p2),
+        "p3": summarize_output(p3),
+        "rej_lowrec": {"lots": int(len(rej))},
+        "restarts": int((info.get("restarts") or {}).get("total", 0)),
+        "truncated": info.get("truncated"),
+        "ms": round((time.perf_counter() - t0) * 1000.0, 3),
+    }
+
+
+def solve_sweep(
+    df_raw: pd.DataFrame,
+    overrides: List[Dict[str, Any]],
+    payload: Optional[Dict[str, Any]] = None,
+    info: Optional[Dict[str, Any]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Resuelve cada override (mezclado sobre `payload`) y retorna 1 fila de resumen por variante,
+    en el mismo orden. El prep común se hace 1 vez; las variantes corren en paralelo en el pool
+    de procesos (dentro de cada una el solve es serie: no hay pools anidados).
+    `info["ms"]` = {"prep", "solve"}.
+    """
+    tm = Timings()
+    base = prep_shared(df_raw)
+    tm.lap("prep")
+
+    payloads = [_merge_payload(payload, o) for o in overrides]
+    ex = _get_executor() if len(payloads) > 1 else None
+    if ex is not None:
+        futs = [_submit_job(ex, _sweep_one, (base, dict(p)), {}) for p in payloads]
+        try:
+            results = [f.result()[0] for f in futs]
+        except BaseException:
+            for f in futs:
+                _cancel_job(f)
+            raise
+    else:
+        results = [_sweep_one(base, dict(p)) for p in payloads]
+    tm.lap("solve")
+
+    if info is not None:
+        info["ms"] = tm.ms
+    return [{"variant": i, "overrides": o, **r} for i, (o, r) in enumerate(zip(overrides, results))]
@@ -0,0 +1,241 @@
+"""
+Tests de main.py sin Supabase real (necesita las dependencias del runner: fastapi, supabase).
+
+  cd runner && python -m pytest -q test_main.py
+"""
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("supabase")
+
+import main  # noqa: E402
+
+
+# =========================
+# SUPABASE EN MEMORIA (solo lo que usan select_all / diff_write / insert_chunks)
+# =========================
+class _Resp:
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+
+
+class _Query:
+    def __init__(self, db, table):
+        self.db, self.table = db, table
+        self.op, self.rows, self.cols, self.count = None, None, None, None
+        self.filters, self.orders, self.rng = [], [], None
+
+    def select(self, cols, count=None):
+        self.op, self.cols, self.count = "select", [c.strip() for c in cols.split(",")], count
+        return self
+
+    def insert(self, rows):
+        self.op, self.rows = "insert", rows
+        return self
+
+    def delete(self):
+        self.op = "delete"
+        return self
+
+    def neq(self, col, v):
+        self.filters.append(lambda r: r.get(col) != v)
+        return self
+
+    def gte(self, col, v):
+        self.filters.append(lambda r: r.get(col) is not None and str(r.get(col)) >= v)
+        return self
+
+    def in_(self, col, vals):
+        self.filters.append(lambda r: r.get(col) in vals)
+        return self
+
+    def order(self, col, desc=False):
+        self.orders.append(col)
+        return self
+
+    def range(self, a, b):
+        self.rng = (a, b)
+        return self
+
+    def execute(self):
+        rows = self.db.tables.setdefault(self.table, [])
+        if self.op == "insert":
+            for r in self.rows:
+                self.db.next_id += 1
+                rows.append(dict({c: self.db.store(self.table, c, v) for c, v in r.items()}, id=self.db.next_id))
+            return _Resp(list(self.rows))
+        hit = [r for r in rows if all(f(r) for f in self.filters)]
+        if self.op == "delete":
+            self.db.tables[self.table] = [r for r in rows if r not in hit]
+            return _Resp(hit)
+        for col in reversed(self.orders):
+            hit.sort(key=lambda r: (r.get(col) is None, r.get(col)))
+        total = len(hit)
+        if self.rng:
+            a, b = self.rng
+            hit = hit[a:min(b, a + self.db.max_rows - 1) + 1]
+        return _Resp([{c: r.get(c) for c in self.cols} for r in hit], total if self.count else None)
+
+
+class FakeSupabase:
+    """Tabla en memoria; `store(table, col, v)` imita cómo Postgres guarda cada columna."""
+
+    def __init__(self, float4=False, scales=None, max_rows=1000):
+        self.tables, self.next_id, self.max_rows = {}, 0, max_rows
+        self.float4, self.scales = float4, dict(scales or {})
+
+    def store(self, table, col, v):
+        if isinstance(v, float):
+            if col in self.scales:
+                return round(v, self.scales[col])
+            if self.float4:
+                return float(np.float32(v))
+        return v
+
+    def table(self, name):
+        return _Query(self, name)
+
+
+def _piles(n_piles=4, lots=6, seed=0):
+    rng = np.random.default_rng(seed)
+    rows = []
+    for code in range(1, n_piles + 1):
+        for k in range(lots):
+            tms = float(rng.uniform(5, 40))
+            g = float(rng.uniform(1, 80))
+            row = {c: None for c in main.OUTPUT_COLS}
+            row.update({
+                "pile_code": code, "pile_type": "batch", "codigo": f"L{code}-{k}", "zona": "Z1",
+                "tmh": tms / 0.93, "humedad_pct": 7.0, "tms": tms,
+                "au_gr_ton": g, "au_oz_tc": g / 34.2857, "au_fino": g * tms,
+                "rec_pct": float(rng.uniform(85, 99)), "nacn_kg_t": float(rng.uniform(1, 3)),
+            })
+            rows.append(row)
+    return rows
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    def make(**kw):
+        db = FakeSupabase(**kw)
+        monkeypatch.setattr(main, "supabase", db)
+        return db
+    return make
+
+
+# =========================
+# DIFF WRITE: escribir -> leer -> comparar
+# =========================
+def test_diff_write_round_trip_float4(fake_db):
+    # float4 no devuelve los floats bit a bit: el 2do write tiene que ser no-op igual
+    fake_db(float4=True)
+    rows = _piles()
+    main.diff_write("res_pila_1", rows)
+    st = main.diff_write("res_pila_1", rows)
+    assert st == {"rows": len(rows), "inserted": 0, "deleted": 0, "kept": len(rows), "full": False}
+
+
+def test_diff_write_round_trip_numeric_scale(fake_db, monkeypatch):
+    # numeric(p,2): fuera de la tolerancia relativa, se compara con la escala de la columna
+    fake_db(scales={"au_fino": 2, "tmh": 3})
+    monkeypatch.setattr(main, "DIFF_SCALES", {"au_fino": 2, "tmh": 3})
+    rows = _piles()
+    main.diff_write("res_pila_1", rows)
+    st = main.diff_write("res_pila_1", rows)
+    assert st["inserted"] == 0 and st["deleted"] == 0 and st["kept"] == len(rows)
+
+
+def test_diff_write_rewrites_only_changed_pile(fake_db):
+    db = fake_db(float4=True, max_rows=5)  # max-rows del servidor < SELECT_PAGE: select_all pagina igual
+    rows = _piles()
+    main.diff_write("res_pila_1", rows)
+
+    new = [dict(r) for r in rows]
+    for r in new:
+        if r["pile_code"] == 2:
+            r["tms"] += 1.0
+    st = main.diff_write("res_pila_1", new)
+    assert st["full"] is False
+    assert st["inserted"] == st["deleted"] == sum(r["pile_code"] == 2 for r in rows)
+
+    back = main.select_all("res_pila_1", ",".join(main.OUTPUT_COLS), ["id"])
+    assert sorted(r["codigo"] for r in back) == sorted(r["codigo"] for r in new)
+    assert len(db.tables["res_pila_1"]) == len(new)
+
+
+def test_parse_scales():
+    assert main._parse_scales("au_fino=2, tms = 3,bad,x=") == {"au_fino": 2, "tms": 3}
+    assert main._parse_scales("") == {}
+
+
+# =========================
+# ETL: parse_num_series == parse_num celda a celda
+# =========================
+PARSE_NUM_CASES = [
+    "12,34", "1.234,56", "1.234,5", "1,234.56", "1.234.567,89", "1,234,567.8", "1234", "0",
+    "-3,5", "-1.234,5", "+4.2", ".5", ",5", "5,", "5.", "1.2.3", "1,2,3", "1e3", "1,5e3",
+    "50%", " 7 %", "12,5 %", "%", "-", "--", "", "   ", "nan", "NaN", "NAN", "s/d", "abc",
+    "1 234,5", "\t8,25\n", "inf", None, np.nan, 12.5, 3,
+]
+
+
+def _same(ref: pd.Series, got: pd.Series) -> np.ndarray:
+    a = ref.astype(float).to_numpy()
+    b = got.astype(float).to_numpy()
+    return (a == b) | (np.isnan(a) & np.isnan(b))
+
+
+@pytest.mark.parametrize("v", PARSE_NUM_CASES, ids=repr)
+def test_parse_num_series_matches_scalar_single(v):
+    col = pd.Series([v], dtype=object)
+    assert _same(col.map(main.parse_num), main.parse_num_series(col)).all()
+
+
+def test_parse_num_series_matches_scalar_mixed_column():
+    # casos mezclados en 1 columna: la clasificación (europeo / US / solo coma) es por celda
+    col = pd.Series(PARSE_NUM_CASES * 3, dtype=object)
+    ok = _same(col.map(main.parse_num), main.parse_num_series(col))
+    assert ok.all(), [PARSE_NUM_CASES[i % len(PARSE_NUM_CASES)] for i in np.flatnonzero(~ok)]
+
+
+def test_parse_num_series_matches_scalar_generated_sheet():
+    import bench
+
+    sheet = bench.gen_sheet(3000, seed=1)
+    for c in sheet.columns:
+        ok = _same(sheet[c].map(main.parse_num), main.parse_num_series(sheet[c]))
+        assert ok.all(), (c, sheet[c][~ok].head().tolist())
+
+
+# =========================
+# JOBS: tope de cola
+# =========================
+def test_submit_job_rejects_when_queue_full(monkeypatch):
+    gate = threading.Event()
+
+    def blocked(payload, progress=None):
+        gate.wait(10)
+        return {"ok": True}
+
+    monkeypatch.setattr(main, "JOBS_MAX_QUEUED", 2)
+    monkeypatch.setitem(main._JOB_KINDS, "run", (blocked, main.RUN_STAGES))
+    try:
+        # JOB_WORKERS corriendo + JOBS_MAX_QUEUED en cola; el siguiente => 429
+        running = [main.submit_job("run", {})["id"] for _ in range(main.JOB_WORKERS)]
+        for _ in range(200):
+            if all(main.get_job(j)["status"] == "running" for j in running):
+                break
+            time.sleep(0.01)
+        for _ in range(2):
+            main.submit_job("run", {})
+        with pytest.raises(main.HTTPException) as e:
+            main.submit_job("run", {})
+        assert e.value.status_code == 429
+    finally:
+        gate.set()